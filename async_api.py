@@ -0,0 +1,142 @@
+# Asyncio facade over the habit store, for embedding the tracker behind an async front end
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import dataframe
+from dataschema import get_db, batch
+from habit import Habit
+from registry import evict_habit
+from storage import DEFAULT_USER
+
+
+class AsyncHabitTracker:
+    def __init__(self, name='main.db', backend='sqlite', max_pending=1000, max_batch=256):
+        """
+        AsyncHabitTracker class constructor designed to serve many concurrent coroutines from one database connection.
+        All database work runs on one dedicated thread, and concurrent mark_complete requests are coalesced
+        into group commits, so they do not each wait for their own commit.
+        Use it as an async context manager, or call start() and close() explicitly.
+        :param name: the name of the database file
+        :param backend: the storage backend, see dataschema.get_db
+        :param max_pending: the maximum number of queued writes and running reads before callers have to wait
+        :param max_batch: the maximum number of writes committed together
+        """
+        self.name = name
+        self.backend = backend
+        self.max_batch = max_batch
+        self.batches_committed = 0
+        self._write_queue = asyncio.Queue(maxsize=max_pending)
+        self._read_slots = asyncio.Semaphore(max_pending)
+        self._executor = None
+        self._writer = None
+        self._db = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def start(self):
+        """
+        Opens the database connection on the dedicated thread and starts coalescing writes.
+        """
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="habit-db")
+        self._db = await self._run(get_db, self.name, self.backend)
+        self._writer = asyncio.create_task(self._write_loop())
+
+    async def close(self):
+        """
+        Waits for the queued writes to be committed, then closes the database connection.
+        """
+        await self._write_queue.join()
+        self._writer.cancel()
+        await self._run(self._db.close)
+        self._executor.shutdown(wait=True)
+
+    async def _run(self, func, *args):
+        # Running blocking database work on the dedicated thread
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _read(self, func, *args, user_id=DEFAULT_USER):
+        async with self._read_slots:
+            return await self._run(partial(func, user_id=user_id), self._db, *args)
+
+    async def async_mark_complete(self, name, mark_date=None, user_id=DEFAULT_USER):
+        """
+        Marks a habit as complete, see Habit.mark_complete and Habit.add_event.
+        :param name: the name of the habit
+        :param mark_date: the date on which to mark the habit as complete (default is today)
+        :param user_id: the tenant the habit belongs to
+        :return: the date the habit was marked complete on, anchored to its period
+        """
+        future = asyncio.get_running_loop().create_future()
+        # Waiting here while the queue is full keeps the number of pending writes bounded
+        await self._write_queue.put((user_id, name, mark_date, future))
+        return await future
+
+    async def _write_loop(self):
+        while True:
+            requests = [await self._write_queue.get()]
+            while len(requests) < self.max_batch and not self._write_queue.empty():
+                requests.append(self._write_queue.get_nowait())
+            try:
+                results = await self._run(self._apply_writes, requests)
+            except Exception as e:
+                results = [e] * len(requests)
+            for (_, _, _, future), result in zip(requests, results):
+                if not future.done():
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+                self._write_queue.task_done()
+
+    def _apply_writes(self, requests):
+        # Runs on the dedicated thread and commits all requests of the batch in one transaction
+        results = []
+        try:
+            with batch(self._db):
+                for user_id, name, mark_date, _ in requests:
+                    habit = Habit.get_habit_by_name(self._db, name, user_id)
+                    if habit is None:
+                        results.append(LookupError(f"Habit '{name}' not found"))
+                        continue
+                    mark_date = habit.mark_complete(self._db, mark_date)
+                    habit.add_event(self._db, mark_date)
+                    results.append(mark_date)
+        except Exception:
+            # The batch was rolled back, but mark_complete already changed the cached habits, so dropping them
+            # makes the next read load them from the database again
+            for user_id, name, _, _ in requests:
+                evict_habit(self._db, name, user_id)
+            raise
+        self.batches_committed += 1
+        return results
+
+    async def async_get_habit(self, name, user_id=DEFAULT_USER):
+        """
+        :param name: the name of the habit
+        :param user_id: the tenant the habit belongs to
+        :return: Habit object or None if not found, see Habit.get_habit_by_name
+        """
+        return await self._read(Habit.get_habit_by_name, name, user_id=user_id)
+
+    async def async_display_all_habits_tracked(self, user_id=DEFAULT_USER):
+        return await self._read(dataframe.display_all_habits_tracked, user_id=user_id)
+
+    async def async_display_all_same_periodicity_habits_tracked(self, periodicity, user_id=DEFAULT_USER):
+        return await self._read(dataframe.display_all_same_periodicity_habits_tracked, periodicity, user_id=user_id)
+
+    async def async_calculate_longestrun_current_streak(self, user_id=DEFAULT_USER):
+        return await self._read(dataframe.calculate_longestrun_current_streak, user_id=user_id)
+
+    async def async_calculate_longest_historical_streak(self, user_id=DEFAULT_USER):
+        return await self._read(dataframe.calculate_longest_historical_streak, user_id=user_id)
+
+    async def async_calculate_lowest_and_largest_average_streak(self, user_id=DEFAULT_USER):
+        return await self._read(dataframe.calculate_lowest_and_largest_average_streak, user_id=user_id)
+
+    async def async_calculate_lowest_and_highest_resistance_ratio(self, user_id=DEFAULT_USER):
+        return await self._read(dataframe.calculate_lowest_and_highest_resistance_ratio, user_id=user_id)
@@ -0,0 +1,56 @@
+# Ingestion benchmark: check-offs per second written straight into SQLite versus through the event journal
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from dataschema import get_db, add_habit_to_db, increment_guilt, compact_journal, get_habit_data  # noqa: E402
+
+
+def ingest(journal, habit_count, events_per_habit):
+    """
+    Adds the habits, then checks them off one event at a time, the way Habit.add_event does.
+    :param journal: whether the check-offs go through the event journal
+    :param habit_count: the number of habits
+    :param events_per_habit: the number of check-off dates per habit
+    :return: tuple of the ingestion time and the time of the final compaction in seconds
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        db = get_db(os.path.join(directory, "bench.db"), journal=journal)
+        gen_date = date.today() - timedelta(days=events_per_habit)
+        for index in range(habit_count):
+            add_habit_to_db(db, f"Habit {index}", "", gen_date, "Daily")
+        start = time.perf_counter()
+        for offset in range(events_per_habit):
+            event_date = str(gen_date + timedelta(days=offset))
+            for index in range(habit_count):
+                increment_guilt(db, f"Habit {index}", event_date)
+        ingest_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        compact_journal(db)
+        compact_elapsed = time.perf_counter() - start
+        assert len(get_habit_data(db, "Habit 0")[0]['check_off_dates']) == events_per_habit
+        db.close()
+    return ingest_elapsed, compact_elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times check-off ingestion with and without the event journal.")
+    parser.add_argument("--habits", type=int, default=200)
+    parser.add_argument("--events", type=int, default=100)
+    args = parser.parse_args()
+
+    events = args.habits * args.events
+    print(f"{args.habits} habits, {args.events} check-offs each")
+    for journal in (False, True):
+        ingest_elapsed, compact_elapsed = ingest(journal, args.habits, args.events)
+        print(f"journal={journal!s:<6} {events / ingest_elapsed:10.1f} check-offs/s  "
+              f"final compaction {compact_elapsed:8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# Memory benchmark: bytes held per habit and per check-off after loading habit histories, with budget checks
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import pandas as pd  # noqa: E402
+from dataschema import get_db, get_habit_data, get_habit_names  # noqa: E402
+from generator import build_database  # noqa: E402
+from habit import Habit  # noqa: E402
+
+# The ways of loading all habits, each given a fresh connection and returning what a caller would keep
+LOADERS = {
+    'Habit.get_habit_by_name': lambda db: [Habit.get_habit_by_name(db, name) for name in get_habit_names(db)],
+    'Habit.get_all_habits': lambda db: Habit.get_all_habits(db),
+    'get_habit_data': lambda db: get_habit_data(db, None),
+    'pd.read_sql_query': lambda db: pd.read_sql_query("SELECT * FROM habit", db),
+}
+
+
+def held_bytes(loader, name):
+    """
+    Loads all habits of a database file with a fresh connection and measures the memory the result holds.
+    The connection stays open while measuring, as the habit registry of the connection is part of the cost.
+    :param loader: one of LOADERS
+    :param name: the name of the database file
+    :return: tuple of the bytes still held after loading and the peak bytes while loading
+    """
+    db = get_db(name)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        result = loader(db)
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    db.close()
+    return current - baseline, peak - baseline
+
+
+def measure(habit_count, history_days, args):
+    """
+    Measures every loader on two databases with the same number of habits but histories of different lengths,
+    so the memory can be split into a part per habit and a part per check-off.
+    :return: list of result dictionaries, one per loader
+    """
+    datasets = []
+    with tempfile.TemporaryDirectory() as directory:
+        for days in history_days:
+            name = os.path.join(directory, f"memory-{days}.db")
+            db, event_count = build_database(habit_count, name=name, seed=args.seed, history_days=days)
+            db.close()
+            datasets.append((name, event_count))
+        (short_name, short_events), (long_name, long_events) = datasets
+        if long_events <= short_events:
+            raise ValueError(f"The longer history has {long_events} check-off(s) and the shorter one "
+                             f"{short_events}, so the cost per check-off cannot be told apart; "
+                             f"choose history lengths further apart")
+        results = []
+        for loader_name, loader in LOADERS.items():
+            short_bytes, _ = held_bytes(loader, short_name)
+            long_bytes, long_peak = held_bytes(loader, long_name)
+            # The extra memory of the longer histories is what the extra check-offs cost
+            per_event = (long_bytes - short_bytes) / (long_events - short_events)
+            per_habit = (short_bytes - per_event * short_events) / habit_count
+            results.append({'loader': loader_name, 'habits': habit_count, 'events': long_events,
+                            'held_bytes': long_bytes, 'peak_bytes': long_peak,
+                            'bytes_per_habit': round(per_habit, 1), 'bytes_per_event': round(per_event, 1)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the memory held per habit and per check-off by each way "
+                                                 "of loading habits, and fails if a budget is exceeded.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 10000])
+    parser.add_argument("--history-days", type=int, nargs=2, default=[90, 365],
+                        help="the short and the long history the per-event cost is derived from")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--max-bytes-per-event", type=float, default=100.0)
+    parser.add_argument("--max-bytes-per-habit", type=float, default=None)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+    if args.history_days[0] >= args.history_days[1]:
+        parser.error("--history-days needs a short history followed by a longer one")
+    if min(args.sizes) < 1:
+        parser.error("--sizes needs at least one habit per database")
+
+    results = []
+    for habit_count in args.sizes:
+        try:
+            results.extend(measure(habit_count, args.history_days, args))
+        except ValueError as error:
+            parser.error(str(error))
+    failures = []
+    for result in results:
+        over = []
+        if result['bytes_per_event'] > args.max_bytes_per_event:
+            over.append("per event")
+        if args.max_bytes_per_habit is not None and result['bytes_per_habit'] > args.max_bytes_per_habit:
+            over.append("per habit")
+        if over:
+            failures.append(result)
+        print(f"{result['habits']:>7} habits {result['events']:>9} events  {result['loader']:<24}"
+              f"{result['bytes_per_habit']:10.1f} B/habit {result['bytes_per_event']:8.1f} B/event  "
+              f"held {result['held_bytes'] / 2 ** 20:8.2f} MiB  peak {result['peak_bytes'] / 2 ** 20:8.2f} MiB"
+              f"{'  OVER BUDGET ' + ', '.join(over) if over else ''}")
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'options': vars(args), 'results': results}, output_file, indent=2)
+    if failures:
+        print(f"{len(failures)} measurement(s) over budget.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
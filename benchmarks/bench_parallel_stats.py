@@ -0,0 +1,37 @@
+# Scaling benchmark for dataframe.calc_stats_in_parallel, the pool path of display_all_habits_tracked,
+# across worker process counts
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import dataframe  # noqa: E402
+from generator import build_database  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times the parallel all-habits stats with several worker counts.")
+    parser.add_argument("--habits", type=int, default=20000)
+    parser.add_argument("--history-days", type=int, default=365)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    db, event_count = build_database(args.habits, backend='memory', seed=args.seed, history_days=args.history_days)
+    print(f"{args.habits} habits, {event_count} check-offs, chunks of {args.chunk_size}")
+    baseline = None
+    for workers in args.workers:
+        # Timing the same code path for every worker count, including one, so the speed-up measures parallelism
+        # rather than the difference to the serial Habit path display_all_habits_tracked takes for one worker
+        start = time.perf_counter()
+        dataframe.calc_stats_in_parallel(db, workers=workers, chunk_size=args.chunk_size)
+        elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print(f"workers={workers:<3} {elapsed:8.3f}s  speed-up x{baseline / elapsed:.2f}")
+
+
+if __name__ == "__main__":
+    main()
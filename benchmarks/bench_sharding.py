@@ -0,0 +1,68 @@
+# Scaling benchmark for sharded databases: concurrent write throughput and all-habits report latency
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import dataframe  # noqa: E402
+from dataschema import get_db, add_habit_to_db, increment_guilt, batch  # noqa: E402
+
+
+def write_habits(name, shards, writer_index, habit_count, events_per_habit):
+    """
+    Writes the habits of one writer with its own connections, committing once per habit.
+    :param name: the name of the database file the shard files are derived from
+    :param shards: the number of shards
+    :param writer_index: the index of the writer, used to keep the habit names apart
+    :param habit_count: the number of habits the writer adds
+    :param events_per_habit: the number of check-off dates per habit
+    """
+    db = get_db(name, shards=shards, shard_by='name')
+    gen_date = date.today() - timedelta(days=events_per_habit * 2)
+    for index in range(habit_count):
+        habit_name = f"Habit {writer_index}-{index}"
+        with batch(db):
+            add_habit_to_db(db, habit_name, "", gen_date, "Daily")
+            for offset in range(0, events_per_habit * 2, 2):
+                increment_guilt(db, habit_name, str(gen_date + timedelta(days=offset)))
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times concurrent writes and the all-habits report per shard count.")
+    parser.add_argument("--habits", type=int, default=2000)
+    parser.add_argument("--events", type=int, default=50)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    print(f"{args.habits} habits, {args.events} check-offs each, {args.writers} writers")
+    for shards in args.shards:
+        with tempfile.TemporaryDirectory() as directory:
+            name = os.path.join(directory, "bench.db")
+            get_db(name, shards=shards, shard_by='name').close()
+            writers = [threading.Thread(target=write_habits,
+                                        args=(name, shards, index, args.habits // args.writers, args.events))
+                       for index in range(args.writers)]
+            start = time.perf_counter()
+            for writer in writers:
+                writer.start()
+            for writer in writers:
+                writer.join()
+            write_elapsed = time.perf_counter() - start
+
+            db = get_db(name, shards=shards, shard_by='name')
+            start = time.perf_counter()
+            dataframe.display_all_habits_tracked(db)
+            report_elapsed = time.perf_counter() - start
+            db.close()
+        print(f"shards={shards:<3} writes {args.habits / write_elapsed:9.1f} habits/s  report {report_elapsed:8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# Compares two result files of run_suite.py, e.g. from two commits, and flags the benchmarks that got slower
+import argparse
+import json
+import sys
+
+
+def load_results(path):
+    """
+    :param path: the name of a result file written by run_suite.py
+    :return: tuple of the commit and a dictionary of durations in seconds keyed by (benchmark, habits)
+    """
+    with open(path) as results_file:
+        data = json.load(results_file)
+    return data.get('commit'), {(result['benchmark'], result['habits']): result['seconds']
+                                for result in data['results']}
+
+
+def compare(baseline, candidate, threshold):
+    """
+    :param baseline: durations keyed by (benchmark, habits), see load_results
+    :param candidate: durations keyed the same way
+    :param threshold: the relative slow-down, e.g. 0.1 for 10%, above which a benchmark counts as a regression
+    :return: list of (benchmark, habits, baseline seconds, candidate seconds, ratio, regressed) tuples
+             for the benchmarks in both files
+    """
+    rows = []
+    for key in sorted(baseline.keys() & candidate.keys(), key=lambda key: (key[1], key[0])):
+        before, after = baseline[key], candidate[key]
+        ratio = after / before if before else float('inf')
+        rows.append((*key, before, after, ratio, ratio > 1 + threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares two benchmark result files.")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative slow-down counted as a regression (default 0.1, i.e. 10%%)")
+    args = parser.parse_args()
+
+    baseline_commit, baseline = load_results(args.baseline)
+    candidate_commit, candidate = load_results(args.candidate)
+    print(f"baseline {baseline_commit or args.baseline}  candidate {candidate_commit or args.candidate}")
+    rows = compare(baseline, candidate, args.threshold)
+    for benchmark, habits, before, after, ratio, regressed in rows:
+        print(f"{habits:>7} {benchmark:<46} {before:10.4f}s {after:10.4f}s  x{ratio:5.2f}"
+              f"{'  REGRESSION' if regressed else ''}")
+    regressions = sum(1 for row in rows if row[-1])
+    print(f"{regressions} regression(s) above {args.threshold:.0%}.")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# Differential fuzzing of the stats implementations against the reference oracle, timing them side by side
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from freezegun import freeze_time  # noqa: E402
+from oracle import ENGINES, diff_stats, prepare_oracle, random_cases  # noqa: E402
+
+
+def run_engine(prepare, habits, today, directory):
+    """
+    :return: tuple of the rows sorted by habit name and the seconds it took to calculate them
+    """
+    calculate = prepare(habits, directory)
+    # Letting the frozen clock tick, so the timer runs while today stays the same day
+    with freeze_time(today, tick=True):
+        start = time.perf_counter()
+        rows = calculate(today)
+        seconds = time.perf_counter() - start
+    return sorted(rows, key=lambda row: row['Name']), seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares every stats implementation with the reference oracle "
+                                                 "on random habit histories and times them side by side.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--habits", type=int, default=50, help="the largest number of habits in a round")
+    parser.add_argument("--engines", nargs="+", choices=sorted(ENGINES), default=sorted(ENGINES))
+    args = parser.parse_args()
+
+    seconds = dict.fromkeys(['oracle'] + args.engines, 0.0)
+    mismatches = {engine: [] for engine in args.engines}
+    habit_count = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for round_index, (today, habits) in enumerate(random_cases(args.seed, args.rounds, args.habits)):
+            habit_count += len(habits)
+            expected, elapsed = run_engine(prepare_oracle, habits, today, directory)
+            seconds['oracle'] += elapsed
+            for engine in args.engines:
+                actual, elapsed = run_engine(ENGINES[engine], habits, today, directory)
+                seconds[engine] += elapsed
+                mismatches[engine].extend((round_index, today) + difference
+                                          for difference in diff_stats(expected, actual))
+    print(f"{args.rounds} rounds, {habit_count} habits, seed {args.seed}")
+    for engine, engine_seconds in seconds.items():
+        count = len(mismatches.get(engine, []))
+        print(f"{engine:<10} {engine_seconds * 1000:10.1f} ms  {habit_count / engine_seconds:12,.0f} habits/s"
+              f"{'' if engine == 'oracle' else f'  {count} mismatch(es)'}")
+    for engine, engine_mismatches in mismatches.items():
+        for round_index, today, name, column, expected_value, actual_value in engine_mismatches[:20]:
+            print(f"{engine}: round {round_index} (today {today}), {name}, {column}: "
+                  f"expected {expected_value!r}, got {actual_value!r}")
+    if any(mismatches.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
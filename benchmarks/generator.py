@@ -0,0 +1,110 @@
+# Seeded generator of synthetic habit histories for the benchmarks
+import os
+import random
+import sys
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from dataschema import get_db, add_habit_to_db, batch  # noqa: E402
+from periods import period_start  # noqa: E402
+from storage import DEFAULT_USER, get_store  # noqa: E402
+
+PERIODICITIES = ["Daily", "Weekly", "Monthly"]
+# The number of days a period of each periodicity steps forward by, roughly for months
+PERIOD_DAYS = {"Daily": 1, "Weekly": 7, "Monthly": 30}
+
+
+def _next_period(day, periodicity, count):
+    """
+    :return: the start of the period count periods after the one starting on day
+    """
+    if periodicity == "Monthly":
+        month_index = day.year * 12 + day.month - 1 + count
+        return date(month_index // 12, month_index % 12 + 1, 1)
+    return day + timedelta(days=PERIOD_DAYS[periodicity] * count)
+
+
+def generate_habits(habit_count, history_days=365, mean_streak=4.0, mean_gap=3.0, weights=(0.5, 0.3, 0.2),
+                    seed=42, today=None):
+    """
+    Generates synthetic habit records that are the same for the same arguments on every run.
+    Each history alternates streaks of consecutive periods with gaps, their lengths drawn from geometric
+    distributions with the given means, and the check-off dates are anchored to the start of their period,
+    the way Habit.mark_complete stores them.
+    :param habit_count: the number of habits
+    :param history_days: the number of days between the creation date of a habit and today
+    :param mean_streak: the mean number of consecutive periods a habit is checked off in
+    :param mean_gap: the mean number of periods between two streaks
+    :param weights: the shares of daily, weekly and monthly habits
+    :param seed: the seed of the random generator
+    :param today: the last day of the histories (default is today)
+    :return: generator of (name, descr, gen_date, periodicity, check-off dates as ISO 8601 strings) tuples
+    """
+    rng = random.Random(seed)
+    today = today or date.today()
+    gen_date = today - timedelta(days=history_days)
+
+    def geometric(mean):
+        # The number of trials until the first success, with a mean of mean trials
+        return int(rng.expovariate(1 / mean)) + 1 if mean > 1 else 1
+
+    for index in range(habit_count):
+        periodicity = rng.choices(PERIODICITIES, weights)[0]
+        day = _next_period(period_start(gen_date, periodicity), periodicity, geometric(mean_gap) - 1)
+        check_off_dates = []
+        while day <= today:
+            for _ in range(geometric(mean_streak)):
+                if day > today:
+                    break
+                check_off_dates.append(day.isoformat())
+                day = _next_period(day, periodicity, 1)
+            day = _next_period(day, periodicity, geometric(mean_gap))
+        yield f"Habit {index}", f"Synthetic {periodicity.lower()} habit", gen_date, periodicity, check_off_dates
+
+
+def fill_store(db, habits, batch_size=1000, user_id=DEFAULT_USER):
+    """
+    Stores generated habits, adding them and their check-off dates in batches instead of event by event.
+    :param db: An SQLite database connection object or a habit store
+    :param habits: habit records as yielded by generate_habits
+    :param batch_size: the number of habits written in one transaction
+    :param user_id: the tenant the habits belong to
+    :return: tuple of the number of habits and the number of check-off dates stored
+    """
+    store = get_store(db)
+    habit_count = event_count = 0
+    pending = []
+    for name, descr, gen_date, periodicity, check_off_dates in habits:
+        pending.append((name, descr, gen_date, periodicity, check_off_dates))
+        habit_count += 1
+        event_count += len(check_off_dates)
+        if len(pending) == batch_size:
+            _store_batch(db, store, pending, user_id)
+            pending = []
+    if pending:
+        _store_batch(db, store, pending, user_id)
+    return habit_count, event_count
+
+
+def _store_batch(db, store, habits, user_id):
+    with batch(db):
+        for name, descr, gen_date, periodicity, _ in habits:
+            add_habit_to_db(db, name, descr, gen_date, periodicity, user_id)
+        store.replace_check_off_dates([(user_id, name, check_off_dates)
+                                       for name, _, _, _, check_off_dates in habits])
+
+
+def build_database(habit_count, name=None, backend='sqlite', seed=42, **generator_options):
+    """
+    Creates a database filled with generated habits.
+    :param habit_count: the number of habits
+    :param name: the name of the database file, ignored by the memory backend
+    :param backend: 'sqlite' or 'memory', see dataschema.get_db
+    :param seed: the seed of the random generator
+    :param generator_options: further arguments of generate_habits
+    :return: tuple of the database object and the number of check-off dates stored
+    """
+    db = get_db(name or 'bench.db', backend=backend)
+    _, event_count = fill_store(db, generate_habits(habit_count, seed=seed, **generator_options))
+    return db, event_count
@@ -0,0 +1,60 @@
+# Load test measuring the requests/sec of the HTTP service started with 'python main.py serve'
+import argparse
+import http.client
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def run_client(url, paths, duration, conditional, counts, index):
+    """
+    Sends GET requests over one keep-alive connection until the duration is over.
+    :param url: the base URL of the service
+    :param paths: the paths requested in turn
+    :param duration: the duration of the test in seconds
+    :param conditional: if True, the last ETag of each path is sent back in If-None-Match, like a polling dashboard
+    :param counts: list collecting the number of requests per client
+    :param index: the index of this client in counts
+    """
+    base = urlsplit(url)
+    connection = http.client.HTTPConnection(base.hostname, base.port)
+    etags = {}
+    requests = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        path = paths[requests % len(paths)]
+        headers = {'If-None-Match': etags[path]} if conditional and path in etags else {}
+        connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        etags[path] = response.getheader('ETag')
+        requests += 1
+    connection.close()
+    counts[index] = requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the requests/sec of a running Kick the Habit service.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--conditional", action="store_true", help="send If-None-Match like a polling dashboard")
+    parser.add_argument("--paths", nargs="+", default=["/habits", "/reports/all-habits",
+                                                        "/reports/longest-current-streak",
+                                                        "/reports/resistance-ratio"])
+    args = parser.parse_args()
+
+    counts = [0] * args.clients
+    threads = [threading.Thread(target=run_client,
+                                args=(args.url, args.paths, args.duration, args.conditional, counts, index))
+               for index in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total = sum(counts)
+    print(f"{total} requests from {args.clients} clients in {args.duration:.1f}s: {total / args.duration:.1f} req/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# Benchmark suite timing the data access, the stats and the reports on generated habit histories of several sizes
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import dataframe  # noqa: E402
+from dataschema import get_habit_data, increment_guilt, batch  # noqa: E402
+from generator import build_database  # noqa: E402
+from habit import Habit  # noqa: E402
+from periods import period_start  # noqa: E402
+from registry import clear_registry  # noqa: E402
+
+# The reports of dataframe.py, each called with the database object only
+REPORTS = {
+    'display_all_habits_tracked': dataframe.display_all_habits_tracked,
+    'display_all_same_periodicity_habits_tracked':
+        lambda db: dataframe.display_all_same_periodicity_habits_tracked(db, "Daily"),
+    'calculate_longestrun_current_streak': dataframe.calculate_longestrun_current_streak,
+    'calculate_longest_historical_streak': dataframe.calculate_longest_historical_streak,
+    'calculate_lowest_and_largest_average_streak': dataframe.calculate_lowest_and_largest_average_streak,
+    'calculate_lowest_and_highest_resistance_ratio': dataframe.calculate_lowest_and_highest_resistance_ratio,
+    'page_all_habits_tracked': lambda db: dataframe.page_all_habits_tracked(db).render_page(0),
+}
+
+
+def timed(func, repeat):
+    """
+    Runs a function several times and keeps the fastest run, the one least disturbed by the rest of the machine.
+    :param func: the function to time, called without arguments
+    :param repeat: the number of runs
+    :return: the duration of the fastest run in seconds
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_size(habit_count, args):
+    """
+    Builds a database of the given size and times every benchmark on it.
+    :param habit_count: the number of generated habits
+    :param args: the parsed command-line arguments
+    :return: list of result dictionaries
+    """
+    results = []
+
+    def record(benchmark, seconds, operations=1):
+        results.append({'habits': habit_count, 'benchmark': benchmark, 'seconds': round(seconds, 6),
+                        'operations': operations, 'ops_per_sec': round(operations / seconds, 1) if seconds else None})
+        print(f"{habit_count:>7} {benchmark:<46} {seconds:10.4f}s  {operations:>7} op(s)")
+
+    with tempfile.TemporaryDirectory() as directory:
+        name = os.path.join(directory, 'bench.db')
+        start = time.perf_counter()
+        db, event_count = build_database(habit_count, name=name, backend=args.backend, seed=args.seed,
+                                         history_days=args.history_days, mean_streak=args.mean_streak,
+                                         mean_gap=args.mean_gap)
+        record('build_database', time.perf_counter() - start, event_count)
+        rng = random.Random(args.seed)
+        sample = [f"Habit {rng.randrange(habit_count)}" for _ in range(min(args.sample, habit_count))]
+
+        record('get_habit_data_all', timed(lambda: get_habit_data(db, None), args.repeat), habit_count)
+        record('get_habit_data_by_name',
+               timed(lambda: [get_habit_data(db, habit_name) for habit_name in sample], args.repeat), len(sample))
+
+        def load_habits():
+            # Starting from an empty registry, so every habit is read and parsed again
+            clear_registry(db)
+            return [Habit.get_habit_by_name(db, habit_name) for habit_name in sample]
+
+        record('get_habit_by_name', timed(load_habits, args.repeat), len(sample))
+        habits = load_habits()
+        record('calc_individual_stats',
+               timed(lambda: [habit.calc_individual_stats() for habit in habits], args.repeat), len(sample))
+
+        for report, func in REPORTS.items():
+            if habit_count > args.max_report_habits:
+                continue
+
+            def run_report(func=func):
+                # Clearing the registry before every run, so each run reads and parses the habits again
+                clear_registry(db)
+                return func(db)
+
+            record(report, timed(run_report, args.repeat), habit_count)
+
+        # Anchoring today to the period of each habit, as the app does when checking off
+        check_off_dates = [str(period_start(date.today(), habit.periodicity)) for habit in habits]
+
+        def ingest():
+            with batch(db):
+                for habit_name, check_off_date in zip(sample, check_off_dates):
+                    increment_guilt(db, habit_name, check_off_date)
+
+        # Timing one round only, as the later rounds would find the dates already present
+        record('increment_guilt', timed(ingest, 1), len(sample))
+        if hasattr(db, 'close'):
+            db.close()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times data access, stats and reports at several database sizes "
+                                                 "and writes the results to a JSON file.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--backend", choices=["sqlite", "memory"], default="sqlite")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--history-days", type=int, default=365)
+    parser.add_argument("--mean-streak", type=float, default=4.0)
+    parser.add_argument("--mean-gap", type=float, default=3.0)
+    parser.add_argument("--sample", type=int, default=1000, help="habits looked up one by one per benchmark")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-report-habits", type=int, default=100000,
+                        help="skip the reports above this many habits")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+
+    results = []
+    for habit_count in args.sizes:
+        results.extend(run_size(habit_count, args))
+    with open(args.output, 'w') as output_file:
+        json.dump({
+            'commit': git_commit(),
+            'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'options': vars(args),
+            'results': results,
+        }, output_file, indent=2)
+    print(f"Wrote {len(results)} result(s) to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
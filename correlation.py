@@ -0,0 +1,128 @@
+# Co-occurrence and correlation of the guilt of all pairs of habits, calculated with matrix products
+from datetime import date
+import numpy as np
+import pandas as pd
+from instrumentation import instrumented
+from periods import period_ordinal
+from snapshot import PERIODICITIES
+from storage import DEFAULT_USER
+from trends import load_check_offs, period_ordinals, period_starts
+
+
+def _period_ends(starts, periodicity_codes):
+    """
+    :return: NumPy array of the last days of the periods starting on the given days
+    """
+    next_months = (starts.astype('datetime64[M]') + 1).astype('datetime64[D]')
+    return np.select([periodicity_codes == 1, periodicity_codes == 2],
+                     [starts + np.timedelta64(6, 'D'), next_months - np.timedelta64(1, 'D')], starts)
+
+
+def indicator_matrix(habits, check_offs, grid="Weekly", today=None):
+    """
+    Aligns all habits onto one grid of periods and marks the periods each habit was guilty in. A check-off marks
+    every grid period its own period overlaps: a daily check-off the week it falls in, a monthly one every week
+    touching its month. The grid runs from the period of the earliest creation date up to the current period;
+    periods before a habit was created count as innocent.
+    :param habits: DataFrame of the habits, see trends.load_check_offs
+    :param check_offs: DataFrame of the check-offs, see trends.load_check_offs
+    :param grid: the periodicity of the grid: Daily, Weekly or Monthly
+    :param today: the date of the last period of the grid (default is today)
+    :return: tuple of a boolean NumPy array with one row per habit and one column per grid period,
+             and the starts of the grid periods as datetime64 days
+    """
+    today = today or date.today()
+    grid_code = PERIODICITIES.index(grid)
+    first_period = period_ordinals(period_starts(habits['Gen period'].to_numpy(),
+                                                 habits['Periodicity code'].to_numpy()),
+                                   np.full(len(habits), grid_code)).min(initial=period_ordinal(today, grid))
+    last_period = period_ordinal(today, grid)
+    habit_indexes = check_offs['Habit'].to_numpy()
+    codes = habits['Periodicity code'].to_numpy()[habit_indexes]
+    starts = period_starts(check_offs['Period'].to_numpy(), codes)
+    grid_codes = np.full(len(starts), grid_code)
+    lows = np.maximum(period_ordinals(starts, grid_codes), first_period)
+    highs = np.minimum(period_ordinals(_period_ends(starts, codes), grid_codes), last_period)
+    # Expanding each check-off into the grid periods it overlaps, most of the time just one
+    spans = np.maximum(highs - lows + 1, 0)
+    offsets = np.arange(spans.sum()) - np.repeat(np.cumsum(spans) - spans, spans)
+    matrix = np.zeros((len(habits), last_period - first_period + 1), dtype=bool)
+    matrix[np.repeat(habit_indexes, spans), np.repeat(lows - first_period, spans) + offsets] = True
+    grid_starts = period_starts(np.arange(first_period, last_period + 1), np.full(matrix.shape[1], grid_code))
+    return matrix, grid_starts
+
+
+def cooccurrence_and_correlation(matrix):
+    """
+    Calculates for all pairs of habits at once the number of periods both were guilty in, as the product of the
+    indicator matrix with its transpose, and the Pearson correlation of their guilt (the phi coefficient).
+    :param matrix: boolean NumPy array with one row per habit and one column per period, see indicator_matrix
+    :return: tuple of the co-occurrence counts as an int64 array and the correlations as a float64 array, both
+             with one row and one column per habit; the diagonal of the counts holds the guilty periods of each
+             habit, and correlations with a habit guilty in every or no period are NaN
+    """
+    # Multiplying in float32, which goes through BLAS and counts exactly far beyond any number of periods
+    indicators = matrix.astype(np.float32)
+    cooccurrence = np.rint(indicators @ indicators.T).astype(np.int64)
+    period_count = matrix.shape[1]
+    if period_count == 0:
+        return cooccurrence, np.full(cooccurrence.shape, np.nan)
+    rates = np.diag(cooccurrence) / period_count
+    covariance = cooccurrence / period_count - np.outer(rates, rates)
+    deviations = np.sqrt(rates * (1 - rates))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation = covariance / np.outer(deviations, deviations)
+    correlation[~np.isfinite(correlation)] = np.nan
+    return cooccurrence, np.clip(correlation, -1, 1)
+
+
+@instrumented
+def calculate_habit_correlations(db, grid="Weekly", user_id=DEFAULT_USER):
+    """
+    Calculates how often each pair of habits was guilty in the same period and how strongly their guilt correlates.
+    :param db: An SQLite database connection object or a habit store
+    :param grid: the periodicity of the common grid of periods, see indicator_matrix
+    :param user_id: the tenant whose habits are reported
+    :return: tuple of two DataFrames with the habit names as index and columns: the co-occurrence counts and the
+             correlations rounded to 2 decimals, or None if there are no habits
+    """
+    habits, check_offs = load_check_offs(db, user_id)
+    if habits.empty:
+        print("No habits found in the database.")
+        return None
+    cooccurrence, correlation = cooccurrence_and_correlation(indicator_matrix(habits, check_offs, grid)[0])
+    names = pd.Index(habits['Name'], name=None)
+    return (pd.DataFrame(cooccurrence, index=names, columns=names),
+            pd.DataFrame(correlation, index=names, columns=names).round(2))
+
+
+@instrumented
+def calculate_most_correlated_habits(db, top=10, grid="Weekly", user_id=DEFAULT_USER):
+    """
+    Lists the pairs of habits whose guilt correlates most strongly, see calculate_habit_correlations.
+    :param db: An SQLite database connection object or a habit store
+    :param top: the number of pairs listed
+    :param grid: the periodicity of the common grid of periods, see indicator_matrix
+    :param user_id: the tenant whose habits are reported
+    :return: DataFrame with columns for both names, the periods both were guilty in and the correlation,
+             the strongest correlation first, or None if there are fewer than two habits
+    """
+    habits, check_offs = load_check_offs(db, user_id)
+    if len(habits) < 2:
+        print("At least two habits are needed to compare them.")
+        return None
+    cooccurrence, correlation = cooccurrence_and_correlation(indicator_matrix(habits, check_offs, grid)[0])
+    firsts, seconds = np.triu_indices(len(habits), k=1)
+    pair_correlations = correlation[firsts, seconds]
+    # Leaving out pairs without a correlation, and taking the strongest ones without sorting all pairs
+    candidates = np.flatnonzero(~np.isnan(pair_correlations))
+    if len(candidates) > top:
+        candidates = candidates[np.argpartition(-pair_correlations[candidates], top - 1)[:top]]
+    candidates = candidates[np.argsort(-pair_correlations[candidates], kind='stable')]
+    names = habits['Name'].to_numpy()
+    return pd.DataFrame({
+        'Habit': names[firsts[candidates]],
+        'Other habit': names[seconds[candidates]],
+        'Periods together': cooccurrence[firsts[candidates], seconds[candidates]],
+        'Correlation': pair_correlations[candidates].round(2),
+    })
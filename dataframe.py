@@ -1,45 +1,359 @@
 import dataschema
+import numpy as np
 import pandas as pd
-from habit import Habit
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from habit import Habit, STATS_COLUMNS
+from instrumentation import instrumented
+from pager import PagedTable
+from periods import format_resistance_ratio, period_ordinal
+from sharding import ShardedStore
+from snapshot import PERIODICITIES, open_snapshot
+from storage import DEFAULT_USER
+from trends import load_check_offs
 
 
-def display_all_habits_tracked(db):
+@instrumented
+def display_all_habits_tracked(db, workers=1, chunk_size=256, user_id=DEFAULT_USER, snapshot_path=None):
     """
     Retrieves all habits tracked from the database, converts the data to a dataframe, and returns it.
     :param db: an initialized sqlite3 database connection
+    :param workers: the number of processes calculating the stats; with more than 1, see calc_stats_in_parallel
+    :param chunk_size: the number of habits sent to a worker process at a time
+    :param user_id: the tenant whose habits are reported
+    :param snapshot_path: the name of a snapshot file (see snapshot.py) to calculate the stats from, as long as
+                          the database has not changed since it was written
     :return: returns the habit data with columns for name, description, date of creation, periodicity and stats.
     """
     if db is None:
         print("No database connection.")
         return None
+    snapshot = open_snapshot(db, snapshot_path, user_id)
+    if snapshot is not None:
+        with snapshot:
+            all_habits_df = calc_stats_from_snapshot(snapshot)
+        if all_habits_df is None:
+            print("No habits found in the database.")
+        return all_habits_df
+    elif _fans_out(db, user_id):
+        all_habits_df = calc_stats_on_shards(db, user_id)
+        if all_habits_df is None:
+            print("No habits found in the database.")
+        return all_habits_df
+    elif workers > 1:
+        all_habits_df = calc_stats_in_parallel(db, workers, chunk_size, user_id)
+        if all_habits_df is None:
+            print("No habits found in the database.")
+        return all_habits_df
     else:
-        # Retrieving all habit data from the database
-        habit_data = dataschema.get_habit_data(db, None)
-        if habit_data:
-            # Initializing an empty list to store individual statistics DataFrame for each habit
-            habit_stats = []
-            # Iterating over each habit and calculate statistics
-            for habit_info in habit_data:
-                # Extracting the habit name
-                name = habit_info['name']
-                # Retrieving the Habit object using the name
-                habit = Habit.get_habit_by_name(db, name)
-                habit_stat = habit.calc_individual_stats()
-                if habit_stat is not None:
-                    habit_stats.append(habit_stat)
-            # Concatenating individual statistics DataFrames into one DataFrame
-            all_habits_df = pd.concat(habit_stats, ignore_index=True)
+        # Retrieving all Habit objects, reusing the ones already loaded for this connection
+        habits = Habit.get_all_habits(db, user_id)
+        if habits:
+            # Calculating the statistics of each habit as one row of the DataFrame
+            habit_stats = [habit.calc_individual_stats_row() for habit in habits]
+            all_habits_df = pd.DataFrame(habit_stats)
             return all_habits_df
         else:
             print("No habits found in the database.")
             return None
 
 
-def display_all_same_periodicity_habits_tracked(db, periodicity):
+@instrumented
+def page_all_habits_tracked(db, page_size=20, user_id=DEFAULT_USER):
+    """
+    Prepares the same table as display_all_habits_tracked for viewing one page at a time.
+    Only the habit names are retrieved up front; the stats of a page are calculated when the page is rendered.
+    :param db: an initialized sqlite3 database connection
+    :param page_size: the number of habits on a page
+    :param user_id: the tenant whose habits are reported
+    :return: PagedTable object, or None if there are no habits
+    """
+    if db is None:
+        print("No database connection.")
+        return None
+    habit_names = dataschema.get_habit_names(db, user_id)
+    if not habit_names:
+        return None
+
+    def fetch_rows(offset, limit):
+        habits = [Habit.get_habit_by_name(db, name, user_id) for name in habit_names[offset:offset + limit]]
+        return [habit.calc_individual_stats_row() for habit in habits if habit is not None]
+
+    return PagedTable(STATS_COLUMNS, len(habit_names), fetch_rows, page_size)
+
+
+@instrumented
+def calc_stats_in_parallel(db, workers=4, chunk_size=256, user_id=DEFAULT_USER):
+    """
+    Calculates the individual statistics of all habits in a pool of worker processes.
+    The habits are split into chunks and shipped to the workers as compact payloads of date ordinals
+    instead of Habit objects, and the partial results are merged in their original order.
+    :param db: an initialized sqlite3 database connection
+    :param workers: the number of worker processes
+    :param chunk_size: the number of habits in one chunk
+    :param user_id: the tenant whose habits are reported
+    :return: DataFrame with the same columns as display_all_habits_tracked, or None if there are no habits
+    """
+    habit_data = dataschema.get_habit_data(db, None, user_id)
+    if not habit_data:
+        return None
+    payloads = [
+        (habit_info['name'], habit_info['periodicity'], habit_info['gen_date'].toordinal(),
+         [date.fromisoformat(date_str).toordinal() for date_str in habit_info['check_off_dates']])
+        for habit_info in habit_data
+    ]
+    chunks = [payloads[start:start + chunk_size] for start in range(0, len(payloads), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        partial_results = executor.map(_calc_stats_chunk, chunks)
+        habit_stats = [row for partial_result in partial_results for row in partial_result]
+    return pd.DataFrame(habit_stats)
+
+
+@instrumented
+def calc_stats_on_shards(db, user_id=DEFAULT_USER):
+    """
+    Calculates the individual statistics of the habits of a tenant on all shards of a sharded database at once,
+    with one worker process reading each shard file, and merges the partial results shard by shard.
+    :param db: a ShardedStore object
+    :param user_id: the tenant whose habits are reported
+    :return: DataFrame with the same columns as display_all_habits_tracked, or None if there are no habits
+    """
+    paths = [db.paths[index] for index in db.tenant_shard_indexes(user_id)]
+    # Making sure the workers see everything written so far
+    db.commit()
+    with ProcessPoolExecutor(max_workers=len(paths)) as executor:
+        partial_results = executor.map(_calc_stats_on_shard, paths, [user_id] * len(paths))
+        habit_stats = [row for partial_result in partial_results for row in partial_result]
+    return pd.DataFrame(habit_stats) if habit_stats else None
+
+
+@instrumented
+def calc_stats_from_snapshot(snapshot):
+    """
+    Calculates the individual statistics of all habits in a snapshot at once, with array operations over the
+    period ordinals of all habits instead of a loop over Habit objects.
+    Streaks are runs of consecutive period ordinals, so the results match the Habit stats for check-off dates
+    anchored to the start of their period, as the compact command leaves them.
+    :param snapshot: Snapshot object
+    :return: DataFrame with the same columns as display_all_habits_tracked, or None if there are no habits
+    """
+    if len(snapshot) == 0:
+        return None
+    periods, starts, counts = snapshot.periods, snapshot.starts, snapshot.counts
+    today = date.today()
+    today_periods = np.array([period_ordinal(today, periodicity) for periodicity in PERIODICITIES])[
+        snapshot.periodicity_codes]
+    run_habits, run_lengths, run_ids = _streak_runs(periods, starts, counts)
+    run_counts = np.bincount(run_habits, minlength=len(snapshot))
+    longest_streaks = np.zeros(len(snapshot), dtype=np.int64)
+    np.maximum.at(longest_streaks, run_habits, run_lengths)
+    # The current streak is the last run of a habit, if it reaches into the current period
+    current_streaks = np.zeros(len(snapshot), dtype=np.int64)
+    has_periods = counts > 0
+    last_positions = (starts + counts - 1)[has_periods]
+    current_streaks[has_periods] = np.where(periods[last_positions] == today_periods[has_periods],
+                                            run_lengths[run_ids[last_positions]], 0)
+    periods_with_data = np.maximum(today_periods - snapshot.gen_periods + 1, 0)
+    habit_stats = []
+    for index, name in enumerate(snapshot.names):
+        total_completed, run_count = int(counts[index]), int(run_counts[index])
+        total_resisted = int(periods_with_data[index]) - total_completed
+        habit_stats.append(dict(zip(STATS_COLUMNS, (
+            name,
+            date.fromordinal(int(snapshot.gen_date_ordinals[index])).strftime("%Y/%m/%d"),
+            snapshot.periodicity(index),
+            int(current_streaks[index]),
+            total_completed,
+            total_resisted,
+            format_resistance_ratio(total_resisted, int(periods_with_data[index])),
+            int(longest_streaks[index]),
+            # Rounding Python floats like Habit.calculate_average_streak_length, as NumPy rounds halves differently
+            round(total_completed / run_count, 2) if run_count else 0
+        ))))
+    return pd.DataFrame(habit_stats)
+
+
+def _streak_runs(periods, starts, counts):
+    """
+    Finds the streaks of all habits at once in their concatenated period ordinals.
+    :param periods: NumPy array of the sorted, distinct period ordinals of all habits, one habit after the other
+    :param starts: NumPy array of the position of the first period of each habit
+    :param counts: NumPy array of the number of periods of each habit
+    :return: tuple of NumPy arrays: the habit of each streak, the length of each streak, and the streak of each
+             period, the streaks of each habit oldest first
+    """
+    # Starting a new run wherever a period does not follow the one before it, and at the first period of each habit
+    new_run = np.ones(len(periods), dtype=bool)
+    new_run[1:] = np.diff(periods) != 1
+    new_run[starts[counts > 0]] = True
+    run_ids = np.cumsum(new_run) - 1
+    run_lengths = np.bincount(run_ids, minlength=int(new_run.sum()))
+    run_habits = np.repeat(np.arange(len(counts)), counts)[new_run]
+    return run_habits, run_lengths, run_ids
+
+
+def _streaks_of_all_habits(db, user_id, snapshot_path):
+    """
+    Finds the streaks of all habits of a tenant in one pass, from a snapshot that is still current or else from
+    one read of all check-offs.
+    :return: tuple of the habit names, a NumPy array of their periodicity codes (see snapshot.PERIODICITIES),
+             and NumPy arrays of the habit and the length of each streak
+    """
+    snapshot = open_snapshot(db, snapshot_path, user_id)
+    if snapshot is not None:
+        with snapshot:
+            run_habits, run_lengths, _ = _streak_runs(snapshot.periods, snapshot.starts, snapshot.counts)
+            return list(snapshot.names), snapshot.periodicity_codes.astype(np.int64), run_habits, run_lengths
+    habits, check_offs = load_check_offs(db, user_id)
+    habit_indexes, periods = check_offs['Habit'].to_numpy(), check_offs['Period'].to_numpy()
+    # Sorting the periods habit by habit and dropping check-offs in the same period
+    order = np.lexsort((periods, habit_indexes))
+    habit_indexes, periods = habit_indexes[order], periods[order]
+    distinct = np.ones(len(periods), dtype=bool)
+    distinct[1:] = (np.diff(periods) != 0) | (np.diff(habit_indexes) != 0)
+    habit_indexes, periods = habit_indexes[distinct], periods[distinct]
+    counts = np.bincount(habit_indexes, minlength=len(habits))
+    run_habits, run_lengths, _ = _streak_runs(periods, np.cumsum(counts) - counts, counts)
+    return list(habits['Name']), habits['Periodicity code'].to_numpy(), run_habits, run_lengths
+
+
+@instrumented
+def calculate_streak_histograms(db, user_id=DEFAULT_USER, snapshot_path=None):
+    """
+    Counts the streaks of every habit by their length, see Habit.calculate_streak_histogram.
+    :param db: The database connection object.
+    :param user_id: the tenant whose habits are reported
+    :param snapshot_path: the name of a snapshot file to use while it is current, see display_all_habits_tracked
+    :return: DataFrame with one row per habit and streak length, with columns for name, periodicity,
+             streak length and the number of streaks of that length
+    """
+    names, periodicity_codes, run_habits, run_lengths = _streaks_of_all_habits(db, user_id, snapshot_path)
+    # Counting the (habit, length) pairs at once by combining them into one key
+    key_base = int(run_lengths.max(initial=0)) + 1
+    keys, streak_counts = np.unique(run_habits * key_base + run_lengths, return_counts=True)
+    habit_indexes = keys // key_base
+    return pd.DataFrame({
+        'Name': np.array(names, dtype=object)[habit_indexes],
+        'Periodicity': np.array(PERIODICITIES, dtype=object)[periodicity_codes[habit_indexes]],
+        'Streak length': keys % key_base,
+        'Streaks': streak_counts,
+    })
+
+
+@instrumented
+def calculate_streak_length_distribution(db, user_id=DEFAULT_USER, snapshot_path=None):
+    """
+    Counts the streaks of all habits of each periodicity by their length.
+    :param db: The database connection object.
+    :param user_id: the tenant whose habits are reported
+    :param snapshot_path: the name of a snapshot file to use while it is current, see display_all_habits_tracked
+    :return: DataFrame with one row per periodicity and streak length, with columns for periodicity, streak length,
+             the number of streaks of that length and their share of the streaks of the periodicity in percent
+    """
+    names, periodicity_codes, run_habits, run_lengths = _streaks_of_all_habits(db, user_id, snapshot_path)
+    key_base = int(run_lengths.max(initial=0)) + 1
+    keys, streak_counts = np.unique(periodicity_codes[run_habits] * key_base + run_lengths, return_counts=True)
+    codes = keys // key_base
+    totals = np.bincount(codes, weights=streak_counts, minlength=len(PERIODICITIES))
+    return pd.DataFrame({
+        'Periodicity': np.array(PERIODICITIES, dtype=object)[codes],
+        'Streak length': keys % key_base,
+        'Streaks': streak_counts,
+        'Share': (streak_counts / totals[codes] * 100).round(2),
+    })
+
+
+@instrumented
+def calculate_streak_length_percentiles(db, user_id=DEFAULT_USER, snapshot_path=None, percentiles=(50, 90, 99)):
+    """
+    Summarizes the streak lengths of all habits of each periodicity with their percentiles.
+    :param db: The database connection object.
+    :param user_id: the tenant whose habits are reported
+    :param snapshot_path: the name of a snapshot file to use while it is current, see display_all_habits_tracked
+    :param percentiles: the percentiles reported, between 0 and 100
+    :return: DataFrame with one row per periodicity with streaks, with columns for periodicity, the number of
+             habits with streaks, the number of streaks, the mean, each percentile (linearly interpolated)
+             and the longest streak, or None if there are no streaks
+    """
+    names, periodicity_codes, run_habits, run_lengths = _streaks_of_all_habits(db, user_id, snapshot_path)
+    if len(run_lengths) == 0:
+        print("No streaks found in the database.")
+        return None
+    run_codes = periodicity_codes[run_habits]
+    rows = []
+    for code, periodicity in enumerate(PERIODICITIES):
+        lengths = run_lengths[run_codes == code]
+        if len(lengths) == 0:
+            continue
+        rows.append({
+            'Periodicity': periodicity,
+            'Habits': len(np.unique(run_habits[run_codes == code])),
+            'Streaks': len(lengths),
+            'Mean': round(float(lengths.mean()), 2),
+            **{f"p{percentile}": round(float(value), 2)
+               for percentile, value in zip(percentiles, np.percentile(lengths, percentiles))},
+            'Longest': int(lengths.max()),
+        })
+    return pd.DataFrame(rows)
+
+
+def _precomputed_stats(db, user_id, snapshot_path):
+    """
+    Calculates the stats of all habits at once when that beats recreating the habits one by one:
+    from a snapshot that is still current, or on all shards of a tenant spread over several shards.
+    :return: DataFrame as returned by display_all_habits_tracked, or None to calculate habit by habit
+    """
+    snapshot = open_snapshot(db, snapshot_path, user_id)
+    if snapshot is not None:
+        with snapshot:
+            return calc_stats_from_snapshot(snapshot)
+    if _fans_out(db, user_id):
+        return calc_stats_on_shards(db, user_id)
+    return None
+
+
+def _fans_out(db, user_id):
+    """
+    :return: True if the habits of the tenant are spread over several shards, so reports fan out to them
+    """
+    return isinstance(db, ShardedStore) and len(db.tenant_shard_indexes(user_id)) > 1
+
+
+def _calc_stats_on_shard(path, user_id):
+    """
+    Calculates the individual statistics of the habits of a tenant in one shard file in a worker process.
+    :param path: the name of the shard file
+    :param user_id: the tenant whose habits are reported
+    :return: list of dictionaries, one per habit, as returned by Habit.calc_individual_stats_row
+    """
+    db = dataschema.get_db(path)
+    try:
+        return [habit.calc_individual_stats_row() for habit in Habit.get_all_habits(db, user_id)]
+    finally:
+        db.close()
+
+
+def _calc_stats_chunk(payloads):
+    """
+    Calculates the individual statistics for one chunk of habit payloads in a worker process.
+    :param payloads: list of (name, periodicity, gen_date ordinal, check-off date ordinals) tuples
+    :return: list of dictionaries, one per habit, as returned by Habit.calc_individual_stats_row
+    """
+    rows = []
+    for name, periodicity, gen_date_ordinal, check_off_ordinals in payloads:
+        habit = Habit.from_record(name, "", date.fromordinal(gen_date_ordinal), periodicity,
+                                  [date.fromordinal(ordinal) for ordinal in check_off_ordinals])
+        rows.append(habit.calc_individual_stats_row())
+    return rows
+
+
+@instrumented
+def display_all_same_periodicity_habits_tracked(db, periodicity, user_id=DEFAULT_USER):
     """
     Retrieves all habits with the same periodicity tracked, converts the data to a dataframe, and returns it.
     :param db: an initialized sqlite3 database connection
     :param periodicity: the periodicity type (Daily, Weekly or Monthly)
+    :param user_id: the tenant whose habits are reported
     :return: returns the habit data with columns for name, description, date of creation, periodicity and stats.
     """
     if db is None:
@@ -51,7 +365,7 @@ def display_all_same_periodicity_habits_tracked(db, periodicity):
             print("Invalid periodicity.")
             return None
         # Retrieving habits with the same periodicity from the database
-        habit_data = dataschema.get_habit_data(db, None)  # Get all habits
+        habit_data = dataschema.get_habit_data(db, None, user_id)  # Get all habits of the tenant
         same_periodicity_habits = [habit for habit in habit_data if habit['periodicity'].lower() == periodicity.lower()]
 
         if same_periodicity_habits:
@@ -63,19 +377,22 @@ def display_all_same_periodicity_habits_tracked(db, periodicity):
             return None
 
 
-def calculate_longestrun_current_streak(db):
+@instrumented
+def calculate_longestrun_current_streak(db, user_id=DEFAULT_USER, snapshot_path=None):
     """
     Calculates the currently tracked habit with the largest value in the 'current streak' stats column
     and returns a table containing the name (or names in case of a tie) of the corresponding habit (habits)
     and the 'Current streak' value.
     :param db: an initialized sqlite3 database connection
+    :param user_id: the tenant whose habits are reported
+    :param snapshot_path: the name of a snapshot file to use while it is current, see display_all_habits_tracked
     :return: DataFrame with columns for name and current streak of the habit(s) with the largest value
     """
     if db is None:
         print("No database connection.")
         return None
     # Retrieving all habit data from the database
-    all_habits_df = display_all_habits_tracked(db)
+    all_habits_df = display_all_habits_tracked(db, user_id=user_id, snapshot_path=snapshot_path)
     if all_habits_df is not None and not all_habits_df.empty:
         # Finding the habit(s) with the longest current streak
         max_current_streak = all_habits_df['Current streak'].max()
@@ -86,17 +403,27 @@ def calculate_longestrun_current_streak(db):
         return None
 
 
-def calculate_longest_historical_streak(db):
+@instrumented
+def calculate_longest_historical_streak(db, user_id=DEFAULT_USER, snapshot_path=None):
     """
     Calculates the longest historical streak across all habits.
     :param db: SQLite database connection object.
+    :param user_id: the tenant whose habits are reported
+    :param snapshot_path: the name of a snapshot file to use while it is current, see display_all_habits_tracked
     :return: Pandas DataFrame containing the longest historical streak for each habit.
     """
-    cur = db.cursor()
     try:
+        # Taking the streaks of all habits calculated at once, from a snapshot or on all shards
+        stats_df = _precomputed_stats(db, user_id, snapshot_path)
+        if stats_df is not None:
+            max_streak = stats_df['Longest streak'].max()
+            max_streak_habits = stats_df.loc[stats_df['Longest streak'] == max_streak, 'Name'].tolist()
+            return pd.DataFrame({
+                'Name': max_streak_habits,
+                'Longest historical streak': [max_streak] * len(max_streak_habits)
+            })
         # Fetching all habit names from the database
-        cur.execute("SELECT name FROM habit")
-        habit_names = cur.fetchall()
+        habit_names = dataschema.get_habit_names(db, user_id)
 
         # Initializing variables to track the longest historical streak and its corresponding habit
         max_streak = -1
@@ -104,14 +431,14 @@ def calculate_longest_historical_streak(db):
 
         # Iterating over each habit and calculating its longest historical streak
         for habit_name in habit_names:
-            habit = Habit.get_habit_by_name(db, habit_name[0])
+            habit = Habit.get_habit_by_name(db, habit_name, user_id)
             if habit:
                 longest_streak = habit.calculate_longest_historical_streak()
                 if longest_streak > max_streak:
                     max_streak = longest_streak
-                    max_streak_habits = [habit_name[0]]
+                    max_streak_habits = [habit_name]
                 elif longest_streak == max_streak:
-                    max_streak_habits.append(habit_name[0])
+                    max_streak_habits.append(habit_name)
         # Creating a DataFrame to store the result
         longest_streak_df = pd.DataFrame({
             'Name': max_streak_habits,
@@ -122,28 +449,32 @@ def calculate_longest_historical_streak(db):
         print(f"Error calculating longest historical streak: {e}")
         # Returning an empty dataframe for graceful error handling
         return pd.DataFrame()
-    finally:
-        cur.close()
 
 
-def calculate_lowest_and_largest_average_streak(db):
+@instrumented
+def calculate_lowest_and_largest_average_streak(db, user_id=DEFAULT_USER, snapshot_path=None):
     """
     Calculates the lowest and largest average streaks across all habits and return them in a DataFrame.
     :param db: The database connection object.
+    :param user_id: the tenant whose habits are reported
+    :param snapshot_path: the name of a snapshot file to use while it is current, see display_all_habits_tracked
     :return: DataFrame containing habit names, their average streaks, and labels indicating lowest or largest streaks.
     """
     habit_stats = []
-    cur = db.cursor()
     try:
-        # Fetching all habit names from the database
-        cur.execute("SELECT name FROM habit")
-        habit_names = cur.fetchall()
+        # Taking the average streaks from the stats calculated at once, from a snapshot or on all shards
+        stats_df = _precomputed_stats(db, user_id, snapshot_path)
+        if stats_df is not None:
+            habit_stats = stats_df[['Name', 'Average streak']].to_dict('records')
+            habit_names = []
+        else:
+            # Fetching all habit names from the database
+            habit_names = dataschema.get_habit_names(db, user_id)
         # Iterating over all habits in the database
-        for habit_name_tuple in habit_names:
-            habit_name = habit_name_tuple[0]
+        for habit_name in habit_names:
             # Removing parentheses and comma from the habit name
             habit_name_cleaned = habit_name.replace("(", "").replace(")", "").replace(",", "")
-            habit = Habit.get_habit_by_name(db, habit_name_cleaned)
+            habit = Habit.get_habit_by_name(db, habit_name_cleaned, user_id)
             if habit:
                 # Calculating the average streak for the habit
                 average_streak = habit.calculate_average_streak_length()
@@ -166,35 +497,19 @@ def calculate_lowest_and_largest_average_streak(db):
         print(f"Error calculating minimum and maximum average streak: {e}")
         # Returning an empty dataframe for graceful error handling
         return pd.DataFrame()
-    finally:
-        cur.close()
 
 
-def calculate_lowest_and_highest_resistance_ratio(db_conn_obj):
+@instrumented
+def calculate_lowest_and_highest_resistance_ratio(db_conn_obj, user_id=DEFAULT_USER):
     """
     Calculates the lowest and highest resistance ratios across all habits and returns them in a DataFrame.
     :param db_conn_obj: The database connection object.
+    :param user_id: the tenant whose habits are reported
     :return: DataFrame containing habit names, their resistance ratios, and labels indicating lowest or highest ratios.
     """
-    resistance_stats = []
-    cur = db_conn_obj.cursor()
     try:
-        # Fetching all habit names from the database
-        cur.execute("SELECT name FROM habit")
-        habit_names = cur.fetchall()
-        # Iterating over all habits in the database
-        for habit_name_tuple in habit_names:
-            habit_name = habit_name_tuple[0]
-            # Removing parentheses and comma from the habit name
-            habit_name_cleaned = habit_name.replace("(", "").replace(")", "").replace(",", "")
-            habit = Habit.get_habit_by_name(db_conn_obj, habit_name_cleaned)
-            if habit:
-                # Calculating the resistance ratio for the habit
-                resistance_ratio = habit.calculate_resistance_ratio()
-                # Appending habit name and its resistance ratio to resistance_stats list
-                resistance_stats.append({'Name': habit_name, 'Resistance ratio': resistance_ratio})
-        # Creating DataFrame from the list of dictionaries
-        resistance_df = pd.DataFrame(resistance_stats)
+        # Counting the periods of all habits in one query instead of recreating every habit
+        resistance_df = calculate_period_counts(db_conn_obj, user_id=user_id)[['Name', 'Resistance ratio']]
         # Finding habit with the lowest resistance ratio
         lowest_resistance_ratio = resistance_df['Resistance ratio'].min()
         lowest_res_ratio_habit = resistance_df[resistance_df['Resistance ratio'] == lowest_resistance_ratio].iloc[0]
@@ -210,5 +525,26 @@ def calculate_lowest_and_highest_resistance_ratio(db_conn_obj):
         print(f"Error calculating minimum and maximum resistance ratio: {e}")
         # Returning an empty DataFrame for graceful error handling
         return pd.DataFrame()
-    finally:
-        cur.close()
+
+
+@instrumented
+def calculate_period_counts(db, window_start=None, window_end=None, user_id=DEFAULT_USER):
+    """
+    Counts the periods with data, the periods of guilt and the periods of innocence of all habits over a window,
+    see dataschema.get_period_counts.
+    :param db: The database connection object.
+    :param window_start: the first day of the window as a date object (default is the creation date of each habit)
+    :param window_end: the last day of the window as a date object (default is today)
+    :param user_id: the tenant whose habits are reported
+    :return: DataFrame with columns for name, periodicity, the three period counts and the resistance ratio
+    """
+    period_counts = dataschema.get_period_counts(db, window_start, window_end, user_id)
+    return pd.DataFrame([{
+        'Name': counts['name'],
+        'Periodicity': counts['periodicity'],
+        'Periods with data': counts['periods'],
+        'Total periods of guilt': counts['completed'],
+        'Total periods of innocence': counts['resisted'],
+        'Resistance ratio': format_resistance_ratio(counts['resisted'], counts['periods'])
+    } for counts in period_counts], columns=['Name', 'Periodicity', 'Periods with data', 'Total periods of guilt',
+                                             'Total periods of innocence', 'Resistance ratio'])
@@ -1,18 +1,174 @@
 # All database connections, loading data etc.
+import atexit
+import json
 import sqlite3
+import threading
+import weakref
 from datetime import date, datetime
-import json
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Union
+from instrumentation import instrumented
+from registry import evict_habit, clear_registry
+from journal import EventJournal, JournaledStore
+from periods import period_start
+from querylog import cursor_factory
+from sharding import ShardedStore, shard_paths
+from storage import DEFAULT_USER, HabitStore, MemoryStore, SQLiteStore, WorkingSetStore, PendingLog, get_store
+
+
+class HabitConnection(sqlite3.Connection):
+    """
+    SQLite connection returned by get_db.
+    Unlike a plain sqlite3.Connection, it can carry per-connection state such as the habit registry.
+    While the instrumentation is enabled, its cursors count the SQL statements and rows, see instrumentation.py,
+    and while the query log is enabled, they trace every statement, see querylog.py.
+    """
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or cursor_factory())
+
+
+class WorkingSetConnection(HabitConnection):
+    """
+    In-memory SQLite connection holding a working copy of a database file, returned by get_db(in_memory=True).
+    Every change is recorded in a pending log next to the file ('<name>-pending') and the whole working set
+    is written back to the file with the SQLite backup API on flush(), on close(), at exit and, if requested,
+    on a timer. Changes still in the pending log are replayed into the file the next time it is opened.
+    """
+
+    def open_working_set(self, name, flush_interval=None):
+        """
+        Loads the database file into this connection and starts recording changes.
+        :param name: The name of the database file
+        :param flush_interval: Seconds between automatic flushes, or None to flush only on demand and on exit
+        """
+        self.lock = threading.RLock()
+        self.flush_interval = flush_interval
+        self._timer = None
+        self._disk = sqlite3.connect(name, check_same_thread=False)
+        SQLiteStore(self._disk).create_schema()
+        self.pending_log = PendingLog(name + "-pending")
+        # Recovering the changes a previous session could not flush before it stopped
+        if self.pending_log.replay(SQLiteStore(self._disk)):
+            self.pending_log.truncate()
+        self._disk.backup(self)
+        self.habit_store = WorkingSetStore(self, self.pending_log, self.lock)
+        atexit.register(_flush_at_exit, weakref.ref(self))
+        self._schedule_flush()
 
+    def _schedule_flush(self):
+        if self.flush_interval:
+            self._timer = threading.Timer(self.flush_interval, self._timed_flush)
+            self._timer.daemon = True
+            self._timer.start()
 
-def get_db(name='main.db'):
+    def _timed_flush(self):
+        try:
+            self.flush()
+        except sqlite3.Error as e:
+            print(f"Error flushing the working set: {e}")
+        self._schedule_flush()
+
+    def flush(self):
+        """
+        Writes the working set back to the database file and empties the pending log.
+        """
+        with self.lock:
+            self.commit()
+            self.backup(self._disk)
+            self.pending_log.truncate()
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._disk is not None:
+            self.flush()
+            self._disk.close()
+            self._disk = None
+            self.pending_log.close()
+        super().close()
+
+
+class JournalConnection(HabitConnection):
     """
-    Gets an SQLite database connection.
-    :param name: The name of the database file (default is 'main.db')
-    :return: An SQLite database connection object
+    SQLite connection taking check-offs at a high rate, returned by get_db(journal=True).
+    Check-offs are appended to an event journal next to the file ('<name>-events', as SQLite itself uses
+    '<name>-journal') instead of rewriting the row of the habit, and the journal is compacted into the file
+    in one transaction once enough events are waiting, on compact_journal(), on close() and at exit.
+    Events left in the journal are compacted the next time it is opened.
     """
+    journal = None
+
+    def open_journal(self, name, compact_every=10_000):
+        """
+        Opens the event journal of the database file and compacts what a previous session left in it.
+        :param name: The name of the database file
+        :param compact_every: The number of journaled check-offs that triggers a compaction
+        """
+        SQLiteStore(self).create_schema()
+        try:
+            self.journal = EventJournal(name + "-events")
+        except ValueError:
+            self.close()
+            raise
+        self.habit_store = JournaledStore(self, self.journal, compact_every)
+        # Recovering the check-offs a previous session could not compact before it stopped
+        self.habit_store.compact()
+        atexit.register(_compact_at_exit, weakref.ref(self))
+
+    def close(self):
+        if self.journal is not None:
+            self.habit_store.compact()
+            self.journal.close()
+            self.journal = None
+        super().close()
+
+
+def _compact_at_exit(journal_connection_ref):
+    journal_connection = journal_connection_ref()
+    if journal_connection is not None and journal_connection.journal is not None:
+        journal_connection.close()
+
+
+def _flush_at_exit(working_set_ref):
+    working_set = working_set_ref()
+    if working_set is not None and working_set._disk is not None:
+        working_set.close()
+
+
+def get_db(name='main.db', backend='sqlite', in_memory=False, flush_interval=None, check_same_thread=True,
+           shards=None, shard_by='user_id', journal=False):
+    """
+    Gets an SQLite database connection, or an in-memory habit store.
+    :param name: The name of the database file (default is 'main.db'), ignored by the memory backend
+    :param backend: 'sqlite' for a database file, 'memory' for a store that never touches the disk
+    :param in_memory: If True, the database file is loaded into an in-memory working set (see WorkingSetConnection)
+    :param flush_interval: Seconds between automatic flushes of the in-memory working set
+    :param check_same_thread: If False, the connection may be used from other threads, one at a time
+    :param shards: If given, the habits are spread over this many database files derived from name
+                   (see sharding.ShardedStore); cannot be combined with in_memory
+    :param shard_by: 'user_id' or 'name', the key hashed to pick the shard of a habit
+    :param journal: If True, check-offs go to an append-only event journal first (see JournalConnection);
+                    cannot be combined with in_memory or shards
+    :return: An SQLite database connection object, a ShardedStore object or a MemoryStore object
+    """
+    if backend == 'memory':
+        return MemoryStore()
     try:
-        db = sqlite3.connect(name)
+        if journal and (shards or in_memory):
+            raise ValueError("The event journal cannot be combined with shards or an in-memory working set")
+        if shards:
+            if in_memory:
+                raise ValueError("A sharded database cannot be loaded into an in-memory working set")
+            db = ShardedStore(shard_paths(name, shards), shard_by, connection_factory=HabitConnection)
+        elif in_memory:
+            db = sqlite3.connect(':memory:', factory=WorkingSetConnection, check_same_thread=False)
+            db.open_working_set(name, flush_interval)
+        elif journal:
+            db = sqlite3.connect(name, factory=JournalConnection, check_same_thread=check_same_thread)
+            db.open_journal(name)
+        else:
+            db = sqlite3.connect(name, factory=HabitConnection, check_same_thread=check_same_thread)
         # print("Database connection successful!")
         create_table(db)
         return db
@@ -21,115 +177,130 @@ def get_db(name='main.db'):
         return None
 
 
+def flush_db(db):
+    """
+    Writes an in-memory working set back to its database file; does nothing for other connections.
+    :param db: An SQLite database connection object or a habit store
+    """
+    if isinstance(db, WorkingSetConnection):
+        db.flush()
+
+
+def compact_journal(db):
+    """
+    Compacts the check-offs waiting in the event journal into the database file; does nothing for other connections.
+    :param db: An SQLite database connection object or a habit store
+    :return: the number of check-off dates added to the database
+    """
+    if isinstance(db, JournalConnection):
+        return db.habit_store.compact()
+    return 0
+
+
+def batch(db):
+    """
+    Groups the changes made inside a with-block into one transaction, to commit many writes at once:
+    with batch(db):
+        increment_guilt(db, name, event_date)
+        ...
+    Inside the block, increment_guilt and update_gen_date pass the errors of the store on instead of printing them,
+    so a failed write rolls back the whole batch.
+    :param db: An SQLite database connection object or a habit store
+    :return: a context manager
+    """
+    return get_store(db).batch()
+
+
 def create_table(db):
     """
     Creates a table in the database if it does not already exist, and commits the changes.
-    :param db: An SQLite database connection object
+    :param db: An SQLite database connection object or a habit store
     """
-    cur = db.cursor()
-    # Storing 'gen_date' as TEXT in ISO 8601 format
-    # Storing 'check_off_dates' as a serialized list
-    cur.execute("""CREATE TABLE IF NOT EXISTS habit(
-        name TEXT PRIMARY KEY,
-        descr TEXT,
-        gen_date TEXT,
-        periodicity TEXT,
-        check_off_dates TEXT DEFAULT '[]');""")
+    get_store(db).create_schema()
 
-    db.commit()
-    cur.close()
 
-
-def add_habit_to_db(db: sqlite3.Connection, name: str, descr: str, gen_date: date, periodicity: str):
+@instrumented
+def add_habit_to_db(db: sqlite3.Connection, name: str, descr: str, gen_date: date, periodicity: str,
+                    user_id: str = DEFAULT_USER):
     """
-    Adds a habit to the 'habit' table in the database in case it doesn't already exist.
-    :param db: An SQLite database connection object
+    Adds a habit to the 'habit' table in the database in case the tenant doesn't already have it.
+    :param db: An SQLite database connection object or a habit store
     :param name: Name of the habit as a string
     :param descr: The description of the habit as a string
     :param gen_date: The creation date of the habit as a date object
     :param periodicity: The periodicity of the habit as a string
+    :param user_id: The tenant the habit belongs to
     """
-    cur = db.cursor()
     gen_date_str = gen_date.strftime('%Y-%m-%d') if gen_date else None
-    # First check if a habit with the given name already exists
-    cur.execute("SELECT COUNT(*) FROM habit WHERE name=?;", (name,))
-    count = cur.fetchone()[0]
-
-    if count == 0:
-        # The habit does not exist, so we can insert it.
-        # Initializing an empty list for check-off dates
-        check_off_dates = []
-        cur.execute("INSERT INTO habit VALUES (?, ?, ?, ?, ?);",
-                    (name, descr, gen_date_str, periodicity, json.dumps(check_off_dates)))
-        db.commit()
-    else:
+    if not get_store(db).add_habit(user_id, name, descr, gen_date_str, periodicity):
         # Habit with the same name already exists, so we will handle this case accordingly.
         print(f"Habit with name '{name}' already exists. Skipping insertion.")
 
-    cur.close()
-
 
-def increment_guilt(db: sqlite3.Connection, name: str, event_date=None):
+@instrumented
+def increment_guilt(db: sqlite3.Connection, name: str, event_date=None, user_id: str = DEFAULT_USER):
     """
     Adds a guilty event to the 'check_off_dates' column.
-    :param db: An SQLite database connection object
+    :param db: An SQLite database connection object or a habit store
     :param name: Name of the habit
     :param event_date: Date of the event (default is today)
+    :param user_id: The tenant the habit belongs to
     """
-    cur = db.cursor()
     if not event_date:
         event_date = str(date.today())
+    store = get_store(db)
     try:
-        # Retrieving the current check_off_dates for the habit
-        cur.execute("SELECT check_off_dates FROM habit WHERE name=?;", (name,))
-        check_off_dates_str = cur.fetchone()[0]
-        # Deserializing the current check_off_dates
-        check_off_dates = json.loads(check_off_dates_str) if check_off_dates_str else []
-        if event_date not in check_off_dates:
-            # Adding the new event_date to the list only if it's not already present
-            check_off_dates.append(event_date)
-            # Updating the check_off_dates column in the habit table
-            cur.execute("UPDATE habit SET check_off_dates=? WHERE name=?;", (json.dumps(check_off_dates), name))
-            db.commit()
-        else:
-            # print(f"The date {event_date} has been already marked for habit {name}. Skipping insertion.")
-            pass
+        # The date is only added if it's not already present
+        store.append_check_off(user_id, name, event_date)
+        evict_habit(db, name, user_id)
     except Exception as e:
+        # Inside a batch, the error has to reach the batch, so it rolls back the other writes as well
+        if store.in_batch():
+            raise
         # Logging the exception
         print(f"Error updating check_off_dates: {e}")
-    finally:
-        cur.close()
 
 
-def get_habit_data(db_conn_obj_schema_ghb: sqlite3.Connection, name: Optional[str]):
+@instrumented
+def update_gen_date(db: sqlite3.Connection, name: str, gen_date: date, user_id: str = DEFAULT_USER):
     """
-    Retrieves habit data from the table in the database.
-    :param db_conn_obj_schema_ghb: An SQLite database connection object
+    Updates the creation date of a habit in the database.
+    :param db: An SQLite database connection object or a habit store
     :param name: Name of the habit
+    :param gen_date: The new creation date of the habit as a date object
+    :param user_id: The tenant the habit belongs to
+    """
+    store = get_store(db)
+    try:
+        store.set_gen_date(user_id, name, gen_date.strftime('%Y-%m-%d'))
+    except Exception as e:
+        if store.in_batch():
+            raise
+        print(f"Error updating gen_date for habit {name}: {e}")
+
+
+@instrumented
+def get_habit_data(db_conn_obj_schema_ghb: sqlite3.Connection, name: Optional[str], user_id: str = DEFAULT_USER):
+    """
+    Retrieves habit data of one tenant from the table in the database.
+    :param db_conn_obj_schema_ghb: An SQLite database connection object or a habit store
+    :param name: Name of the habit, or None for all habits of the tenant
+    :param user_id: The tenant the habits belong to
     :return: List of dictionaries containing habit data (name, descr, gen_date, periodicity, check_off_dates)
     """
     # Check if db is a valid database connection.
-    if not isinstance(db_conn_obj_schema_ghb, sqlite3.Connection):
+    if not isinstance(db_conn_obj_schema_ghb, (sqlite3.Connection, HabitStore)):
         raise ValueError("Invalid database connection")
-    cur = db_conn_obj_schema_ghb.cursor()
+    # Retrieve the habit by name
+    if name is not None and not isinstance(name, str):
+        raise ValueError("Invalid name input")
     try:
-        if name is None:
-            # If name is None, retrieve all habits
-            query = "SELECT name, descr, gen_date, periodicity, check_off_dates FROM habit;"
-            cur.execute(query)
-        else:
-            # Retrieve the habit by name
-            if not isinstance(name, str):
-                raise ValueError("Invalid name input")
-            query = "SELECT name, descr, gen_date, periodicity, check_off_dates FROM habit WHERE name=?;"
-            cur.execute(query, (name,))
-        columns = [col[0] for col in cur.description]
+        columns = ('name', 'descr', 'gen_date', 'periodicity', 'check_off_dates')
         habit_data = []
-        for row in cur.fetchall():
-            data_dict: Dict[str, Any] = dict(zip(columns, row))
+        for record in get_store(db_conn_obj_schema_ghb).get_habits(user_id, name):
+            data_dict: Dict[str, Any] = dict(zip(columns, record))
             # Converting gen_date to date object
             data_dict['gen_date'] = datetime.strptime(data_dict['gen_date'], '%Y-%m-%d').date()
-            data_dict['check_off_dates'] = json.loads(data_dict['check_off_dates'])
             habit_data.append(data_dict)
         return habit_data
 
@@ -138,43 +309,186 @@ def get_habit_data(db_conn_obj_schema_ghb: sqlite3.Connection, name: Optional[st
         print(f"Error executing SQL query: {e}")
         return None
 
-    finally:
-        cur.close()
+
+def anchor_check_off_date(date_str: str, periodicity: str) -> str:
+    """
+    Anchors a check-off date to the start of its period, the way the Habit subclasses mark them complete.
+    :param date_str: The check-off date as an ISO 8601 string
+    :param periodicity: The periodicity of the habit as a string
+    :return: The anchored check-off date as an ISO 8601 string
+    """
+    if periodicity in ("Weekly", "Monthly"):
+        return str(period_start(datetime.strptime(date_str, '%Y-%m-%d').date(), periodicity))
+    return date_str
+
+
+@instrumented
+def compact_check_off_dates(db: sqlite3.Connection, batch_size: int = 500):
+    """
+    Deduplicates, sorts and re-anchors the check-off dates of all habits of all tenants in the database.
+    The habits are processed in batches of batch_size rows, with one transaction per batch.
+    :param db: An SQLite database connection object or a habit store
+    :param batch_size: The number of habits processed per transaction
+    :return: The number of habits whose check-off dates were rewritten
+    """
+    store = get_store(db)
+    rewritten = 0
+    try:
+        for batch in store.iter_check_off_batches(batch_size):
+            updates = []
+            for user_id, name, periodicity, check_off_dates in batch:
+                compacted = sorted({anchor_check_off_date(date_str, periodicity) for date_str in check_off_dates})
+                if compacted != check_off_dates:
+                    updates.append((user_id, name, compacted))
+                    evict_habit(db, name, user_id)
+            if updates:
+                store.replace_check_off_dates(updates)
+                rewritten += len(updates)
+    except sqlite3.Error as e:
+        # Logging the exception
+        print(f"Error compacting check-off dates: {e}")
+    return rewritten
+
+
+@instrumented
+def delete_habit(db: sqlite3.Connection, name: str, user_id: str = DEFAULT_USER):
+    """
+    Deletes a habit from the 'habit' table in the database.
+    :param db: An SQLite database connection object or a habit store
+    :param name: Name of the habit
+    :param user_id: The tenant the habit belongs to
+    """
+    try:
+        get_store(db).delete_habit(user_id, name)
+        evict_habit(db, name, user_id)
+    except sqlite3.Error as e:
+        # Logging the exception
+        print(f"Error deleting habit {name}: {e}")
+
+
+def get_change_counter(db: sqlite3.Connection):
+    """
+    Retrieves the change counter of the database, which grows with every change to the habits,
+    including changes made by other connections and processes.
+    :param db: An SQLite database connection object or a habit store
+    :return: the change counter as an integer
+    """
+    return get_store(db).change_counter()
+
+
+def changes_since(db: sqlite3.Connection, seq: Union[int, tuple] = 0, limit: Optional[int] = None,
+                  page_size: int = 1000):
+    """
+    Streams the changes to the habits of all tenants made after the change with the given sequence number,
+    for consumers that keep a copy of the habits in sync: every write from add_habit_to_db, increment_guilt,
+    update_gen_date, compact_check_off_dates and delete_habit is recorded with a sequence number that only grows,
+    and a consumer remembers the number of the last change it has seen. The changes are read page by page,
+    so a sync costs in proportion to the number of new changes, not to the size of the database.
+    A sharded database numbers the changes of every shard on its own: there, the seq of a change is a tuple of
+    the sequence numbers of all shards up to that change, and the shards are interleaved by sequence number.
+    :param db: An SQLite database connection object or a habit store
+    :param seq: the seq of the last change already seen, 0 for all changes
+    :param limit: the maximum number of changes streamed, or None for all of them
+    :param page_size: the number of changes read at once
+    :return: generator of dictionaries with the seq, user_id, name, operation and value of each change, the
+             oldest change first; the value of an add_habit change is a dictionary with descr, gen_date and
+             periodicity, see HabitStore.changes_since for the other operations
+    """
+    store = get_store(db)
+    remaining = limit
+    while remaining is None or remaining > 0:
+        requested = page_size if remaining is None else min(page_size, remaining)
+        page = store.changes_since(seq, requested)
+        for change_seq, user_id, name, operation, value in page:
+            yield {'seq': change_seq, 'user_id': user_id, 'name': name, 'operation': operation,
+                   'value': json.loads(value) if operation == 'add_habit' else value}
+        # A short page means the feed is read up to its end
+        if len(page) < requested:
+            return
+        seq = page[-1][0]
+        if remaining is not None:
+            remaining -= len(page)
+
+
+@instrumented
+def get_habit_names(db: sqlite3.Connection, user_id: str = DEFAULT_USER):
+    """
+    Retrieves the names of all habits of a tenant in the database.
+    :param db: An SQLite database connection object or a habit store
+    :param user_id: The tenant the habits belong to
+    :return: List of habit names in insertion order
+    """
+    return get_store(db).get_habit_names(user_id)
+
+
+@instrumented
+def get_period_counts(db: sqlite3.Connection, window_start: Optional[date] = None,
+                      window_end: Optional[date] = None, user_id: str = DEFAULT_USER):
+    """
+    Counts the periods with data, the completed and the resisted periods of every habit of a tenant over a window,
+    in one grouped query against the calendar table for the SQLite backend.
+    Days, ISO weeks and calendar months are counted the way the Habit subclasses count them.
+    :param db: An SQLite database connection object or a habit store
+    :param window_start: The first day of the window (default is the creation date of each habit)
+    :param window_end: The last day of the window (default is today)
+    :param user_id: The tenant the habits belong to
+    :return: List of dictionaries with name, periodicity, periods, completed and resisted, in insertion order
+    """
+    window_end = window_end or date.today()
+    try:
+        counts = get_store(db).period_counts(user_id, str(window_start) if window_start else None, str(window_end))
+    except sqlite3.Error as e:
+        # Logging the exception
+        print(f"Error counting periods: {e}")
+        return []
+    return [{'name': name, 'periodicity': periodicity, 'periods': periods, 'completed': completed,
+             'resisted': periods - completed}
+            for name, periodicity, periods, completed in counts]
+
+
+@instrumented
+def search_habits(db: sqlite3.Connection, query: str, limit: int = 20, user_id: str = DEFAULT_USER):
+    """
+    Searches the names and descriptions of the habits of a tenant, matching every word of the query as a prefix.
+    :param db: An SQLite database connection object or a habit store
+    :param query: The search text as typed by the user; an empty query lists the habits by name
+    :param limit: The maximum number of habits returned
+    :param user_id: The tenant the habits belong to
+    :return: List of (name, descr) tuples, best matches first
+    """
+    try:
+        return get_store(db).search_habits(user_id, query, limit)
+    except sqlite3.Error as e:
+        # Logging the exception
+        print(f"Error searching habits: {e}")
+        return []
 
 
 def clear_check_off_dates(db: sqlite3.Connection):
     """
     Clears all check-off dates for habits in the database.
-    :param db: An SQLite database connection object
+    :param db: An SQLite database connection object or a habit store
     """
-    cur = db.cursor()
     try:
         # Updating all check_off_dates to an empty list
-        # noinspection SqlWithoutWhere
-        cur.execute("UPDATE habit SET check_off_dates=?;", (json.dumps([]),))
-        db.commit()
+        get_store(db).clear_check_off_dates()
+        clear_registry(db)
         print("Check-off dates cleared successfully.")
     except sqlite3.Error as e:
         # Logging the exception
         print(f"Error clearing check-off dates: {e}")
-    finally:
-        cur.close()
 
 
 def clear_database(db: sqlite3.Connection):
     """
     Clears all data for habits in the database.
-    :param db: An SQLite database connection object
+    :param db: An SQLite database connection object or a habit store
     """
-    cur = db.cursor()
     try:
-        # Updating all habit data to an empty list
-        # noinspection SqlWithoutWhere
-        cur.execute("DELETE from habit")
-        db.commit()
+        # Deleting all habit data
+        get_store(db).clear()
+        clear_registry(db)
         print("Data cleared successfully.")
     except sqlite3.Error as e:
         # Logging the exception
         print(f"Error clearing data: {e}")
-    finally:
-        cur.close()
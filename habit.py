@@ -1,15 +1,22 @@
-import shutil
+import bisect
+from collections import Counter
 
 import pandas as pd
 from datetime import timedelta, date, datetime
-from dataschema import add_habit_to_db, increment_guilt
-from tabulate import tabulate
-import math
+from dataschema import add_habit_to_db, increment_guilt, get_habit_data, update_gen_date
+from instrumentation import instrumented
+from storage import DEFAULT_USER
+from registry import get_registry
+from pager import PagedTable
+from periods import count_periods, format_resistance_ratio
 from dateutil.relativedelta import relativedelta
 from abc import abstractmethod
-import json
 from typing import Union
 
+# The columns of the individual statistics of a habit, see Habit.calc_individual_stats_row
+STATS_COLUMNS = ['Name', 'Recording from', 'Periodicity', 'Current streak', 'Total periods of guilt',
+                 'Total periods of innocence', 'Resistance ratio', 'Longest streak', 'Average streak']
+
 
 class Habit:
     def __init__(
@@ -18,7 +25,8 @@ class Habit:
             descr="",
             gen_date: Union[str, date] = date.today(),
             periodicity="Daily",
-            check_off_dates=None
+            check_off_dates=None,
+            user_id=DEFAULT_USER
     ):
         """
         Habit class constructor designed to create habit objects.
@@ -26,7 +34,9 @@ class Habit:
         :param descr: the description of the habit
         :param gen_date: the date when the habit was created
         :param periodicity: one of three values: daily, weekly, monthly
+        :param user_id: the tenant the habit belongs to
         """
+        self.user_id = user_id
         self.name = name
         self.descr = descr
         # Checking if gen_date is already a datetime.date object
@@ -38,8 +48,19 @@ class Habit:
         self.periodicity = periodicity
         self.marked_complete = check_off_dates if check_off_dates else []
 
+    @property
+    def marked_complete(self):
+        return self._marked_complete
+
+    @marked_complete.setter
+    def marked_complete(self, check_off_dates):
+        self._marked_complete = check_off_dates
+        # The cached streak lengths belong to the previous check-off dates
+        self._streak_lengths = None
+
     @classmethod
-    def create_habit(cls, name="", descr="", gen_date=date.today(), periodicity="Daily", db=None):
+    def create_habit(cls, name="", descr="", gen_date=date.today(), periodicity="Daily", db=None,
+                     user_id=DEFAULT_USER):
         """
         Class method to create instances of Habit and its subclasses based on periodicity.
         :param name: the name of the habit
@@ -47,46 +68,72 @@ class Habit:
         :param gen_date: the date when the habit was created or the start date of data tracking
         :param periodicity: one of three string values: daily, weekly, monthly
         :param db: the database connection object
+        :param user_id: the tenant the habit belongs to
         :return: an instance of Habit or one of its subclasses
         """
         if periodicity == "Daily":
-            habit = DailyHabit(name, descr, gen_date)
+            habit = DailyHabit(name, descr, gen_date, user_id)
         elif periodicity == "Weekly":
-            habit = WeeklyHabit(name, descr, gen_date)
+            habit = WeeklyHabit(name, descr, gen_date, user_id)
         elif periodicity == "Monthly":
-            habit = MonthlyHabit(name, descr, gen_date)
+            habit = MonthlyHabit(name, descr, gen_date, user_id)
         else:
             # To default to creating a generic Habit instance for unknown periodicities
-            habit = cls(name, descr, gen_date, periodicity)
+            habit = cls(name, descr, gen_date, periodicity, user_id=user_id)
         # If database connection is provided, retrieve check-off dates from the database.
         if db:
-            habit.marked_complete = cls.get_check_off_dates_from_db(db, name)
+            habit.marked_complete = cls.get_check_off_dates_from_db(db, name, user_id)
+        return habit
+
+    @classmethod
+    @instrumented
+    def from_record(cls, name, descr, gen_date, periodicity, check_off_dates, user_id=DEFAULT_USER):
+        """
+        Class method to create instances of Habit and its subclasses from a stored habit record.
+        :param name: the name of the habit
+        :param descr: the description of the habit
+        :param gen_date: the date when the habit was created, as a string or a date object
+        :param periodicity: one of three string values: daily, weekly, monthly
+        :param check_off_dates: the check-off dates as strings or date objects
+        :param user_id: the tenant the habit belongs to
+        :return: an instance of Habit or one of its subclasses with sorted check-off dates
+        """
+        if periodicity == "Daily":
+            habit = DailyHabit(name, descr, gen_date, user_id)
+        elif periodicity == "Weekly":
+            habit = WeeklyHabit(name, descr, gen_date, user_id)
+        elif periodicity == "Monthly":
+            habit = MonthlyHabit(name, descr, gen_date, user_id)
+        else:
+            # Default to generic Habit if periodicity is unknown
+            habit = cls(name, descr, gen_date, periodicity, user_id=user_id)
+        # Converting check-off dates from strings to date objects
+        habit.marked_complete = sorted(
+            check_off_date if isinstance(check_off_date, date)
+            else datetime.strptime(check_off_date, "%Y-%m-%d").date()
+            for check_off_date in check_off_dates
+        )
         return habit
 
     @staticmethod
-    def get_check_off_dates_from_db(db, name):
+    def get_check_off_dates_from_db(db, name, user_id=DEFAULT_USER):
         """
         Retrieves and sorts check-off dates from the database for a specific habit.
         :param db: the database connection object
         :param name: the name of the habit
+        :param user_id: the tenant the habit belongs to
         :return: a sorted list of check-off dates
         """
-        cur = db.cursor()
         try:
-            cur.execute("SELECT check_off_dates FROM habit WHERE name=?", (name,))
-            result = cur.fetchone()
+            result = get_habit_data(db, name, user_id)
             if result:
-                check_off_dates_str = result[0]
-                check_off_dates = json.loads(check_off_dates_str) if check_off_dates_str else []
-                sorted_check_off_dates = sorted(check_off_dates)
+                sorted_check_off_dates = sorted(result[0]['check_off_dates'])
                 return [datetime.strptime(date_str, "%Y-%m-%d").date() for date_str in sorted_check_off_dates]
             else:
                 return []
         except Exception as e:
             print(f"Error retrieving check-off dates for habit {name} from the database: {e}")
             return []
-        finally:
-            cur.close()
 
     def mark_complete(self, db, mark_date=None):
         """
@@ -98,8 +145,18 @@ class Habit:
             mark_date = date.today()
         # Calling the subclass-specific part of the logic and returning the updated mark_date
         mark_date = self._mark_complete_specific(db, mark_date)
+        self._register(db)
         return mark_date
 
+    def _register(self, db):
+        """
+        Makes this object the live Habit object of the database connection for its tenant and name.
+        :param db: The database connection the habit belongs to
+        """
+        registry = get_registry(db)
+        if registry is not None:
+            registry.put(self)
+
     def _mark_complete_specific(self, db, mark_date):
         """
         Default for the subclass-specific part of marking the habit as complete.
@@ -109,6 +166,7 @@ class Habit:
         """
         raise NotImplementedError("Subclasses must override _mark_complete_specific method.")
 
+    @instrumented
     def calc_individual_stats(self):
         """
         Calculates individual statistics for each habit it is run on.
@@ -117,6 +175,15 @@ class Habit:
         """
         pd.set_option('display.max_columns', None)
         pd.set_option('display.width', None)
+        # Returning the DataFrame directly
+        return pd.DataFrame([self.calc_individual_stats_row()])
+
+    @instrumented
+    def calc_individual_stats_row(self):
+        """
+        Calculates the same statistics as calc_individual_stats, without wrapping them in a DataFrame.
+        :return: a dictionary with the column names of calc_individual_stats as keys
+        """
         # Calling the methods from the subclasses to calculate statistics
         current_streak = self.calculate_current_streak()
         total_completed = self.calculate_total_completed()
@@ -124,19 +191,17 @@ class Habit:
         resistance_ratio = self.calculate_resistance_ratio()
         longest_streak = self.calculate_longest_historical_streak()
         average_streak = self.calculate_average_streak_length()
-
-        # Returning the DataFrame directly
-        return pd.DataFrame({
-            'Name': [self.name],
-            'Recording from': [self.gen_date.strftime("%Y/%m/%d")],
-            'Periodicity': [self.periodicity],
-            'Current streak': [current_streak],
-            'Total periods of guilt': [total_completed],
-            'Total periods of innocence': [total_resisted],
-            'Resistance ratio': [resistance_ratio],
-            'Longest streak': [longest_streak],
-            'Average streak': [average_streak]
-        })
+        return dict(zip(STATS_COLUMNS, (
+            self.name,
+            self.gen_date.strftime("%Y/%m/%d"),
+            self.periodicity,
+            current_streak,
+            total_completed,
+            total_resisted,
+            resistance_ratio,
+            longest_streak,
+            average_streak
+        )))
 
     @abstractmethod
     def calculate_current_streak(self):
@@ -146,6 +211,7 @@ class Habit:
         """
         return 0
 
+    @instrumented
     def calculate_total_completed(self):
         """
         Calculates the total number of periods the habit was completed on.
@@ -157,21 +223,69 @@ class Habit:
         total_completed = int(total_completed)
         return total_completed
 
-    @abstractmethod
+    def _periods_with_data(self):
+        """
+        Counts the periods from the one containing gen_date up to the current one, see periods.count_periods.
+        Weeks are ISO weeks starting on Monday and months are calendar months, the same periods the check-off dates
+        are anchored to and the ones dataschema.get_period_counts counts in SQL.
+        :return: the number of periods as an integer
+        """
+        return count_periods(self.gen_date, date.today(), self.periodicity)
+
+    @instrumented
     def calculate_total_resisted(self):
         """
-        Default implementation for total resisted calculation.
-        :return: 0 as a default value
+        Calculates the total number of periods the user resisted performing the habit.
+        :return: the value of the total number of innocent periods as an integer
         """
-        return 0
+        total_resisted = self._periods_with_data() - self.calculate_total_completed()
+        return int(total_resisted)
 
-    @abstractmethod
+    @instrumented
     def calculate_resistance_ratio(self):
         """
-        Default implementation for resistance ratio calculation.
-        :return: "0%" as a default value
+        Calculates the ratio of innocent periods to all periods with data.
+        :return: a string with the ratio expressed as a string in percentages
+        """
+        return format_resistance_ratio(self.calculate_total_resisted(), self._periods_with_data())
+
+    def _period_before(self, period_start):
+        """
+        Returns the start of the period before the given one.
+        This method should be overridden by subclasses to implement specific behavior; that's why the underscore.
+        :param period_start: the start of a period as a date object
         """
-        return "0%"
+        raise NotImplementedError("Subclasses must override _period_before method.")
+
+    @instrumented
+    def calculate_streak_lengths(self):
+        """
+        Calculates the lengths of all streaks of the habit in one pass over the check-off dates, a streak being
+        check-off dates in consecutive periods. The lengths are cached until the check-off dates change, so the
+        longest streak, the average streak and the streak histogram share a single pass.
+        :return: list of the streak lengths as integers, the oldest streak first
+        """
+        if self._streak_lengths is None:
+            streak_lengths = []
+            last_date = None
+            for completion_date in reversed(self.marked_complete):
+                # Extending the streak if the check-off is in the period right before the previous one
+                if last_date is not None and self._period_before(last_date) == completion_date:
+                    streak_lengths[-1] += 1
+                else:
+                    streak_lengths.append(1)
+                last_date = completion_date
+            streak_lengths.reverse()
+            self._streak_lengths = streak_lengths
+        return self._streak_lengths
+
+    @instrumented
+    def calculate_streak_histogram(self):
+        """
+        Counts the streaks of the habit by their length.
+        :return: dictionary mapping each streak length to the number of streaks of that length, shortest first
+        """
+        return dict(sorted(Counter(self.calculate_streak_lengths()).items()))
 
     @abstractmethod
     def calculate_longest_historical_streak(self):
@@ -189,29 +303,16 @@ class Habit:
         """
         return 0.0
 
+    @instrumented
     def get_individual_stats(self):
         """
-        Takes the dataframe from the calc_individual_stats function and displays it as a table
+        Takes the row from the calc_individual_stats_row function and displays it as a table
         with barriers between the rows and columns, dynamic column widths and handling for screen size.
-        :return: reformatted pandas dataframe
-        """
-        stats = self.calc_individual_stats()
-        # Getting the terminal width to adjust column widths dynamically
-        terminal_width = shutil.get_terminal_size().columns
-        # Modifying column headers to include line breaks after each word
-        modified_headers = [header.replace(" ", "\n") for header in stats.columns]
-
-        # Tabulating the DataFrame for pretty printing
-        formatted_table = tabulate(
-            stats,
-            headers=modified_headers,
-            tablefmt='pretty',
-            showindex=False,
-            colalign=("center",) * len(stats.columns),
-            numalign='center',
-            maxcolwidths=[int(terminal_width / len(stats.columns))] * len(stats.columns)
-        )
-        return formatted_table
+        :return: the table as a string
+        """
+        stats_row = self.calc_individual_stats_row()
+        # Rendering the single row with the same paged renderer as the all-habits view
+        return PagedTable(STATS_COLUMNS, 1, lambda offset, limit: [stats_row]).render_page(0)
 
     def store(self, db_conn_obj_habit_store):
         """
@@ -219,7 +320,8 @@ class Habit:
         :param db_conn_obj_habit_store: the database connection
         """
         # Calling the add_habit_to_db function to add the habit to the database
-        add_habit_to_db(db_conn_obj_habit_store, self.name, self.descr, self.gen_date, self.periodicity)
+        add_habit_to_db(db_conn_obj_habit_store, self.name, self.descr, self.gen_date, self.periodicity,
+                        self.user_id)
 
     def add_event(self, db_conn_obj_habit_ae, event_date: date = None):
         """
@@ -229,9 +331,16 @@ class Habit:
         """
         # Converting event_date to string if it's not None to conform with database standards
         event_date_str = event_date.strftime('%Y-%m-%d') if event_date else None
-        increment_guilt(db_conn_obj_habit_ae, self.name, event_date_str)
+        increment_guilt(db_conn_obj_habit_ae, self.name, event_date_str, self.user_id)
+        # Keeping the object in sync with the database, so it can stay the live object for the habit
+        if event_date is None:
+            event_date = date.today()
+        if event_date not in self.marked_complete:
+            bisect.insort(self.marked_complete, event_date)
+            self._streak_lengths = None
         # Updating gen_date in the database in case it is necessary after new check-off
         self.update_gen_date(db_conn_obj_habit_ae, self.gen_date)
+        self._register(db_conn_obj_habit_ae)
 
     def update_gen_date(self, db_conn_obj_habit_ugd, new_gen_date):
         """
@@ -239,58 +348,31 @@ class Habit:
         :param db_conn_obj_habit_ugd: the database connection
         :param new_gen_date: the updated gen_date for the habit
         """
-        cur = db_conn_obj_habit_ugd.cursor()
-        try:
-            # Converting new_gen_date to the appropriate string format for the database
-            new_gen_date_str = new_gen_date.strftime('%Y-%m-%d')
-            # Executing an SQL update query to update the gen_date for the habit in the database
-            cur.execute("UPDATE habit SET gen_date=? WHERE name=?", (new_gen_date_str, self.name))
-            db_conn_obj_habit_ugd.commit()
-            # print(f"Successfully updated gen_date for habit {self.name} in the database.")
-        except Exception as e:
-            print(f"Error updating gen_date for habit {self.name}: {e}")
-        finally:
-            cur.close()
+        # Calling the update_gen_date function to update the gen_date for the habit in the database
+        update_gen_date(db_conn_obj_habit_ugd, self.name, new_gen_date, self.user_id)
 
     @staticmethod
-    def get_habit_by_name(db_conn_obj_habit_ghbn, name):
+    @instrumented
+    def get_habit_by_name(db_conn_obj_habit_ghbn, name, user_id=DEFAULT_USER):
         """
         Recreates a Habit object from the database based on the stored data.
+        The object is kept in the registry of the connection, so repeated calls return the same live object.
         :param db_conn_obj_habit_ghbn: An SQLite database connection object
         :param name: Name of the habit in question
+        :param user_id: The tenant the habit belongs to
         :return: Habit object or None if not found
         """
-        cur = db_conn_obj_habit_ghbn.cursor()
+        registry = get_registry(db_conn_obj_habit_ghbn)
+        if registry is not None:
+            registered_habit = registry.get(name, user_id)
+            if registered_habit is not None:
+                return registered_habit
         try:
-            cur.execute("SELECT name, descr, gen_date, periodicity, check_off_dates FROM habit WHERE name=?", (name,))
-            result = cur.fetchone()
+            result = get_habit_data(db_conn_obj_habit_ghbn, name, user_id)
             if result:
-                # Excluding the last element, the JSON-serialized check-off dates
-                core_habit_data = result[:-1]
-                # Extracting the check-off dates
-                check_off_dates_str = result[-1]
-                check_off_dates = json.loads(check_off_dates_str) if check_off_dates_str else []
-                # Converting check-off dates from strings to date objects
-                check_off_dates = [datetime.strptime(date_str, "%Y-%m-%d").date() for date_str in check_off_dates]
-                # Sorting the check-off dates
-                sorted_check_off_dates = sorted(check_off_dates)
-                # Extracting periodicity from database result
-                periodicity = result[3]
-                # Instantiate the appropriate subclass based on periodicity
-                if periodicity == "Daily":
-                    habit_data_without_periodicity = core_habit_data[:-1]
-                    recreated_habit = DailyHabit(*habit_data_without_periodicity)
-                elif periodicity == "Weekly":
-                    habit_data_without_periodicity = core_habit_data[:-1]
-                    recreated_habit = WeeklyHabit(*habit_data_without_periodicity)
-                elif periodicity == "Monthly":
-                    habit_data_without_periodicity = core_habit_data[:-1]
-                    recreated_habit = MonthlyHabit(*habit_data_without_periodicity)
-                else:
-                    # Default to generic Habit if periodicity is unknown
-                    recreated_habit = Habit(*core_habit_data)
-                # Assigning check-off dates to marked_complete list
-                recreated_habit.marked_complete = sorted_check_off_dates
+                recreated_habit = Habit.from_record(**result[0], user_id=user_id)
+                if registry is not None:
+                    registry.put(recreated_habit)
                 return recreated_habit
             else:
                 return None
@@ -298,13 +380,34 @@ class Habit:
             # Logging the exception
             print(f"Error retrieving Habit by name: {e}")
             return None
-        finally:
-            cur.close()
+
+    @staticmethod
+    @instrumented
+    def get_all_habits(db_conn_obj_habit_gah, user_id=DEFAULT_USER):
+        """
+        Recreates all Habit objects of a tenant from the database in a single query.
+        Habits already in the registry of the connection are returned as they are instead of being parsed again.
+        :param db_conn_obj_habit_gah: An SQLite database connection object
+        :param user_id: The tenant the habits belong to
+        :return: list of Habit objects
+        """
+        registry = get_registry(db_conn_obj_habit_gah)
+        # Reading every habit with one query however many are registered, and parsing only the ones that are not
+        habit_data = get_habit_data(db_conn_obj_habit_gah, None, user_id) or []
+        habits = []
+        for habit_info in habit_data:
+            habit = registry.get(habit_info['name'], user_id) if registry is not None else None
+            if habit is None:
+                habit = Habit.from_record(**habit_info, user_id=user_id)
+                if registry is not None:
+                    registry.put(habit)
+            habits.append(habit)
+        return habits
 
 
 class DailyHabit(Habit):
-    def __init__(self, name="", descr="", gen_date=date.today()):
-        super().__init__(name, descr, gen_date, periodicity="Daily")
+    def __init__(self, name="", descr="", gen_date=date.today(), user_id=DEFAULT_USER):
+        super().__init__(name, descr, gen_date, periodicity="Daily", user_id=user_id)
 
     def _mark_complete_specific(self, db, mark_date):
         """
@@ -312,13 +415,23 @@ class DailyHabit(Habit):
         :param db: The database connection where the marking of the habit will be stored
         :param mark_date: The date on which to mark the habit as complete
         """
-        self.marked_complete.append(mark_date)
+        if mark_date not in self.marked_complete:
+            self.marked_complete.append(mark_date)
         if mark_date != date.today() and mark_date < self.gen_date:
             self.gen_date = mark_date
         self.update_gen_date(db, self.gen_date)
         self.marked_complete.sort()
+        self._streak_lengths = None
         return mark_date
 
+    def _period_before(self, period_start):
+        """
+        :param period_start: the start of a period as a date object
+        :return: the day before
+        """
+        return period_start - timedelta(days=1)
+
+    @instrumented
     def calculate_current_streak(self):
         """
         Calculates the current streak of the given habit.
@@ -340,82 +453,29 @@ class DailyHabit(Habit):
                 current_streak = int(current_streak)
         return current_streak
 
-    def calculate_total_resisted(self):
-        """
-        Calculates the total number of days the user resisted performing the habit.
-        :return: the value of the total number of innocent days as an integer
-        """
-        time_difference = datetime.now().date() - self.gen_date
-        days_with_data = time_difference.days + 1
-        total_completed = self.calculate_total_completed()
-        total_not_completed = days_with_data - total_completed
-        total_not_completed = int(total_not_completed)
-        return total_not_completed
-
-    def calculate_resistance_ratio(self):
-        """
-        Calculates the ratio of innocent and guilty days.
-        :return: a string with the ratio expressed as a string in percentages
-        """
-        total_resisted = self.calculate_total_resisted()
-        time_difference = datetime.now().date() - self.gen_date
-        days_with_data = time_difference.days + 1
-        resistance_ratio = "{:.2f}%".format((total_resisted / days_with_data) * 100)
-        return resistance_ratio
-
+    @instrumented
     def calculate_longest_historical_streak(self):
         """
         Calculates the longest streak the user had for the particular habit.
         :return: the value of the longest streak as an integer
         """
-        longest_streak = 0
-        current_streak = 0
-        last_date = None
-        for completion_date in reversed(self.marked_complete):
-            # Now let's check if the current date is consecutive to the previous one.
-            if last_date is not None and last_date - timedelta(days=1) == completion_date:
-                current_streak += 1
-            else:
-                # Reset the streak if it is not consecutive.
-                current_streak = 1
-            # Update the longest streak if needed.
-            longest_streak = max(longest_streak, current_streak)
-            last_date = completion_date
-        longest_streak = int(longest_streak)
-        return longest_streak
+        return max(self.calculate_streak_lengths(), default=0)
 
+    @instrumented
     def calculate_average_streak_length(self):
         """
         Calculates the average length of completed streaks for the habit.
         Returns: the average length of completed streaks, considering consecutive days of completion, as a float
         """
-        completed_streak_lengths = []
-        current_streak = 0
-        last_date = None
-        for completion_date in reversed(self.marked_complete):
-            # Now let's check if the current date is consecutive to the previous one.
-            if last_date is not None and last_date - timedelta(days=1) == completion_date:
-                current_streak += 1
-            else:
-                # If there is a gap, consider the current streak completed.
-                if current_streak > 0:
-                    completed_streak_lengths.append(current_streak)
-                # Start a new streak.
-                current_streak = 1
-            last_date = completion_date
-        # If there is a streak ongoing at the end of the loop, consider it completed.
-        if current_streak > 0:
-            completed_streak_lengths.append(current_streak)
-        average_streak = (
-                sum(completed_streak_lengths) / len(completed_streak_lengths)
-        ) if completed_streak_lengths else 0
+        streak_lengths = self.calculate_streak_lengths()
+        average_streak = (sum(streak_lengths) / len(streak_lengths)) if streak_lengths else 0
         average_streak = round(average_streak, 2)
         return average_streak
 
 
 class WeeklyHabit(Habit):
-    def __init__(self, name="", descr="", gen_date=date.today()):
-        super().__init__(name, descr, gen_date, periodicity="Weekly")
+    def __init__(self, name="", descr="", gen_date=date.today(), user_id=DEFAULT_USER):
+        super().__init__(name, descr, gen_date, periodicity="Weekly", user_id=user_id)
 
     def _mark_complete_specific(self, db, mark_date):
         """
@@ -431,8 +491,17 @@ class WeeklyHabit(Habit):
             self.gen_date = mark_date
         self.update_gen_date(db, self.gen_date)
         self.marked_complete.sort()
+        self._streak_lengths = None
         return mark_date
 
+    def _period_before(self, period_start):
+        """
+        :param period_start: the start of a period as a date object
+        :return: the start of the week before
+        """
+        return period_start - timedelta(weeks=1)
+
+    @instrumented
     def calculate_current_streak(self):
         """
         Calculates the current streak of the given weekly habit.
@@ -457,89 +526,29 @@ class WeeklyHabit(Habit):
         current_streak = int(current_streak)
         return current_streak
 
-    def calculate_total_resisted(self):
-        """
-        Calculates the total number of weeks the user resisted performing the habit.
-        :return: the value of the total number of innocent weeks as an integer
-        """
-        time_difference = datetime.now().date() - self.gen_date
-        # Setting the weeks_with_data variable to 1 in case the creation date is today
-        if time_difference.days == 0:
-            weeks_with_data = 1
-        else:
-            weeks_with_data = math.ceil(time_difference.days / 7)
-        total_completed = self.calculate_total_completed()
-        total_resisted = weeks_with_data - total_completed
-        return total_resisted
-
-    def calculate_resistance_ratio(self):
-        """
-        Calculates the ratio of innocent and guilty weeks.
-        :return: a string with the ratio expressed as a string in percentages
-        """
-        total_resisted = self.calculate_total_resisted()
-        time_difference = datetime.now().date() - self.gen_date
-        # Setting the weeks_with_data variable to 1 in case the creation date is today
-        if time_difference.days == 0:
-            weeks_with_data = 1
-        else:
-            weeks_with_data = math.ceil(time_difference.days / 7)
-        resistance_ratio = "{:.2f}%".format((total_resisted / weeks_with_data) * 100)
-        return resistance_ratio
-
+    @instrumented
     def calculate_longest_historical_streak(self):
         """
         Calculates the longest streak the user had for the particular weekly habit.
         :return: the value of the longest streak as an integer
         """
-        longest_streak = 0
-        current_streak = 0
-        last_week_start = None
-        for week_start in reversed(self.marked_complete):
-            # Let's check if the current week is consecutive to the previous one.
-            if last_week_start is not None and last_week_start - timedelta(weeks=1) == week_start:
-                current_streak += 1
-            else:
-                # Resetting the streak if it is not consecutive
-                current_streak = 1
-            # Updating the longest streak if needed
-            longest_streak = max(longest_streak, current_streak)
-            last_week_start = week_start
-        longest_streak = int(longest_streak)
-        return longest_streak
+        return max(self.calculate_streak_lengths(), default=0)
 
+    @instrumented
     def calculate_average_streak_length(self):
         """
         Calculates the average length of completed streaks for the weekly habit.
         Returns: the average length of completed streaks, considering consecutive weeks of completion, as a float
         """
-        completed_streak_lengths = []
-        current_streak = 0
-        last_week_start = None
-        for week_start in reversed(self.marked_complete):
-            # Now let's check if the current week is consecutive to the previous one.
-            if last_week_start is not None and last_week_start - timedelta(days=7) == week_start:
-                current_streak += 1
-            else:
-                # If there is a gap, consider the current streak completed.
-                if current_streak > 0:
-                    completed_streak_lengths.append(current_streak)
-                # Start a new streak.
-                current_streak = 1
-            last_week_start = week_start
-        # If there is a streak ongoing at the end of the loop, consider it completed.
-        if current_streak > 0:
-            completed_streak_lengths.append(current_streak)
-        average_streak = (
-                sum(completed_streak_lengths) / len(completed_streak_lengths)
-        ) if completed_streak_lengths else 0
+        streak_lengths = self.calculate_streak_lengths()
+        average_streak = (sum(streak_lengths) / len(streak_lengths)) if streak_lengths else 0
         average_streak = round(average_streak, 2)
         return average_streak
 
 
 class MonthlyHabit(Habit):
-    def __init__(self, name="", descr="", gen_date=date.today()):
-        super().__init__(name, descr, gen_date, periodicity="Monthly")
+    def __init__(self, name="", descr="", gen_date=date.today(), user_id=DEFAULT_USER):
+        super().__init__(name, descr, gen_date, periodicity="Monthly", user_id=user_id)
 
     def _mark_complete_specific(self, db, mark_date):
         """
@@ -552,11 +561,20 @@ class MonthlyHabit(Habit):
         if mark_date not in self.marked_complete:
             self.marked_complete.append(mark_date)
         self.marked_complete.sort()
+        self._streak_lengths = None
         if mark_date != date.today() and mark_date < self.gen_date:
             self.gen_date = mark_date
         self.update_gen_date(db, self.gen_date)
         return mark_date
 
+    def _period_before(self, period_start):
+        """
+        :param period_start: the start of a period as a date object
+        :return: the start of the month before
+        """
+        return period_start - relativedelta(months=1)
+
+    @instrumented
     def calculate_current_streak(self):
         """
         Calculates the current streak of the given monthly habit.
@@ -583,79 +601,21 @@ class MonthlyHabit(Habit):
         current_streak = int(current_streak)
         return current_streak
 
-    def calculate_total_resisted(self):
-        """
-        Calculates the total number of months when the user resisted performing the habit.
-        :return: the value of the total number of innocent months as an integer
-        """
-        months_with_data = (
-                (datetime.now().year - self.gen_date.year) * 12 +
-                datetime.now().month - self.gen_date.month + 1
-        )
-        total_completed = self.calculate_total_completed()
-        total_resisted = months_with_data - total_completed
-        return total_resisted
-
-    def calculate_resistance_ratio(self):
-        """
-        Calculates the ratio of innocent and guilty weeks.
-        :return: a string with the ratio expressed as a string in percentages
-        """
-        total_resisted = self.calculate_total_resisted()
-        months_with_data = (
-                (datetime.now().year - self.gen_date.year) * 12 +
-                datetime.now().month - self.gen_date.month + 1
-        )
-        resistance_ratio = "{:.2f}%".format((total_resisted / months_with_data) * 100)
-        return resistance_ratio
-
+    @instrumented
     def calculate_longest_historical_streak(self):
         """
         Calculates the longest streak the user had for the particular monthly habit.
         :return: the value of the longest streak as an integer
         """
-        longest_streak = 0
-        current_streak = 0
-        last_month_start = None
-        for month_start in reversed(self.marked_complete):
-            # Let's check if the current month is consecutive to the previous one.
-            if last_month_start is not None and (
-                    last_month_start - relativedelta(months=1) == month_start):
-                current_streak += 1
-            else:
-                # Resetting the streak if it is not consecutive
-                current_streak = 1
-            # Updating the longest streak if needed
-            longest_streak = max(longest_streak, current_streak)
-            last_month_start = month_start
-        longest_streak = int(longest_streak)
-        return longest_streak
+        return max(self.calculate_streak_lengths(), default=0)
 
+    @instrumented
     def calculate_average_streak_length(self):
         """
         Calculates the average length of completed streaks for the monthly habit.
         Returns: the average length of completed streaks, considering consecutive months of completion, as a float
         """
-        completed_streak_lengths = []
-        current_streak = 0
-        last_month_start = None
-        for month_start in reversed(self.marked_complete):
-            # Let's check if the current month is consecutive to the previous one.
-            if last_month_start is not None and (
-                    last_month_start - relativedelta(months=1) == month_start):
-                current_streak += 1
-            else:
-                # If there is a gap, consider the current streak completed.
-                if current_streak > 0:
-                    completed_streak_lengths.append(current_streak)
-                # Start a new streak.
-                current_streak = 1
-            last_month_start = month_start
-        # If there is a streak ongoing at the end of the loop, consider it completed.
-        if current_streak > 0:
-            completed_streak_lengths.append(current_streak)
-        average_streak = (
-                sum(completed_streak_lengths) / len(completed_streak_lengths)
-        ) if completed_streak_lengths else 0
+        streak_lengths = self.calculate_streak_lengths()
+        average_streak = (sum(streak_lengths) / len(streak_lengths)) if streak_lengths else 0
         average_streak = round(average_streak, 2)
         return average_streak
@@ -0,0 +1,233 @@
+# Lightweight instrumentation of the hot paths: timers, SQL statement and row counters per operation
+import atexit
+import functools
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Setting KTH_METRICS to 'table' or 'json' turns the instrumentation on and prints a summary at exit,
+# to the file named in KTH_METRICS_FILE or to stderr
+METRICS_ENV = 'KTH_METRICS'
+METRICS_FILE_ENV = 'KTH_METRICS_FILE'
+# The operation SQL statements are counted under when no instrumented operation is running
+UNATTRIBUTED = '(no operation)'
+SUMMARY_COLUMNS = ['Operation', 'Calls', 'Total ms', 'Mean ms', 'Max ms', 'SQL statements', 'SQL rows']
+_DISABLED = nullcontext()
+
+
+class OperationMetrics:
+    __slots__ = ('calls', 'seconds', 'max_seconds', 'statements', 'rows')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.statements = 0
+        self.rows = 0
+
+
+class Metrics:
+    def __init__(self):
+        """
+        Metrics class constructor designed to collect the time spent in each instrumented operation and the SQL
+        statements and rows it caused. Times and counts are inclusive: an operation running inside another one
+        counts towards both. While disabled, the instrumented functions only check the enabled flag.
+        """
+        self.enabled = False
+        self.output_format = 'table'
+        self._operations = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self, output_format='table'):
+        self.enabled = True
+        self.output_format = output_format
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._operations.clear()
+
+    def _active(self):
+        # The operations running in this thread, innermost last
+        active = getattr(self._local, 'active', None)
+        if active is None:
+            active = self._local.active = []
+        return active
+
+    def _operation(self, name):
+        operation = self._operations.get(name)
+        if operation is None:
+            operation = self._operations[name] = OperationMetrics()
+        return operation
+
+    def measure(self, name):
+        """
+        Times a block of code as an operation:
+        with metrics.measure('storage.json_decode'):
+            ...
+        :param name: the name of the operation
+        :return: a context manager, one that does nothing while the instrumentation is disabled
+        """
+        if not self.enabled:
+            return _DISABLED
+        return self._measure(name)
+
+    @contextmanager
+    def _measure(self, name):
+        active = self._active()
+        active.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            active.pop()
+            with self._lock:
+                operation = self._operation(name)
+                operation.calls += 1
+                operation.seconds += elapsed
+                operation.max_seconds = max(operation.max_seconds, elapsed)
+
+    def count_sql(self, statements=0, rows=0):
+        """
+        Adds SQL statements and rows to every operation running in this thread.
+        """
+        if not self.enabled:
+            return
+        active = self._active() or [UNATTRIBUTED]
+        with self._lock:
+            for name in set(active):
+                operation = self._operation(name)
+                operation.statements += statements
+                operation.rows += rows
+
+    def summary(self):
+        """
+        :return: list of dictionaries keyed by SUMMARY_COLUMNS, one per operation, the slowest first
+        """
+        with self._lock:
+            operations = list(self._operations.items())
+        return [dict(zip(SUMMARY_COLUMNS, (
+            name,
+            operation.calls,
+            round(operation.seconds * 1000, 3),
+            round(operation.seconds * 1000 / operation.calls, 3) if operation.calls else 0.0,
+            round(operation.max_seconds * 1000, 3),
+            operation.statements,
+            operation.rows
+        ))) for name, operation in sorted(operations, key=lambda item: item[1].seconds, reverse=True)]
+
+    def format_summary(self, output_format=None):
+        """
+        :param output_format: 'table' or 'json' (default is the format the instrumentation was enabled with)
+        :return: the summary as a string
+        """
+        rows = self.summary()
+        if (output_format or self.output_format) == 'json':
+            return json.dumps(rows, indent=2)
+        # Giving the operation names all the room they need, as they are long and the numbers are short
+        name_width = max([len(SUMMARY_COLUMNS[0])] + [len(row['Operation']) for row in rows])
+        lines = [SUMMARY_COLUMNS[0].ljust(name_width) + "".join(f"{column:>16}" for column in SUMMARY_COLUMNS[1:])]
+        for row in rows:
+            lines.append(row['Operation'].ljust(name_width) +
+                         "".join(f"{row[column]:>16}" for column in SUMMARY_COLUMNS[1:]))
+        return "\n".join(lines)
+
+    def report(self):
+        """
+        Writes the summary to the file named in KTH_METRICS_FILE, or to stderr.
+        """
+        if not self._operations:
+            return
+        summary = self.format_summary()
+        path = os.environ.get(METRICS_FILE_ENV)
+        if path:
+            with open(path, 'w') as metrics_file:
+                metrics_file.write(summary + "\n")
+        else:
+            print(summary, file=sys.stderr)
+
+
+metrics = Metrics()
+
+
+def instrumented(func=None, *, name=None):
+    """
+    Decorator timing every call of a function as an operation named after its module and qualified name:
+    @instrumented
+    def get_habit_data(...):
+    :param func: the function to time
+    :param name: the name of the operation, if it should not be derived from the function
+    :return: the wrapped function
+    """
+    def decorate(func):
+        operation = name or f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return func(*args, **kwargs)
+            with metrics._measure(operation):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorate(func) if func is not None else decorate
+
+
+def measure(name):
+    """
+    Times a block of code as an operation, see Metrics.measure.
+    """
+    return metrics.measure(name)
+
+
+class CountingCursor(sqlite3.Cursor):
+    """
+    SQLite cursor counting the statements it executes and the rows they return or change,
+    for the operations running while they execute, see Metrics.count_sql.
+    """
+
+    def execute(self, sql, parameters=()):
+        super().execute(sql, parameters)
+        metrics.count_sql(statements=1, rows=max(self.rowcount, 0))
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        super().executemany(sql, seq_of_parameters)
+        metrics.count_sql(statements=1, rows=max(self.rowcount, 0))
+        return self
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            metrics.count_sql(rows=1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        metrics.count_sql(rows=len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        metrics.count_sql(rows=len(rows))
+        return rows
+
+
+def cursor_factory():
+    """
+    :return: the cursor class the connections of get_db create their cursors with
+    """
+    return CountingCursor if metrics.enabled else sqlite3.Cursor
+
+
+if os.environ.get(METRICS_ENV):
+    metrics.enable(os.environ[METRICS_ENV])
+    atexit.register(metrics.report)
@@ -0,0 +1,249 @@
+# Append-only journal of check-off events, compacted into SQLite in large transactions
+import os
+import struct
+from contextlib import contextmanager
+from datetime import date
+from storage import SQLiteStore
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# The file starts with a magic number and the format version; every record after it is a 4-byte length prefix
+# followed by the date ordinal of the check-off, the length of the tenant name, the tenant name and the habit name
+MAGIC = b'KTHJ'
+VERSION = 1
+FILE_HEADER = struct.Struct('<4sH')
+LENGTH_PREFIX = struct.Struct('<I')
+EVENT = struct.Struct('<IH')
+
+
+def _lock(journal_file):
+    # Locking the file for as long as it is open, so no other process appends to it or truncates it meanwhile
+    try:
+        if fcntl is not None:
+            fcntl.flock(journal_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            journal_file.seek(0)
+            msvcrt.locking(journal_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        journal_file.close()
+        raise ValueError(f"{journal_file.name} is in use by another process")
+
+
+class EventJournal:
+    def __init__(self, path, fsync_every=256):
+        """
+        EventJournal class constructor designed to record check-off events in an append-only binary file.
+        Records are flushed to the operating system right away but only synced to disk every fsync_every records,
+        on sync() and before compaction, so a crash can lose at most the events since the last sync.
+        The events recorded by an earlier session that were not compacted are read back on open.
+        The file stays locked while it is open, and opening a journal another process holds raises ValueError.
+        :param path: the name of the journal file
+        :param fsync_every: the number of records written between two syncs
+        """
+        self.path = path
+        self.fsync_every = fsync_every
+        # Pending check-off date ordinals by (user_id, name) of the habit, in the order they were recorded
+        self.pending = {}
+        self.pending_count = 0
+        self._unsynced = 0
+        self._file = open(path, 'a+b')
+        _lock(self._file)
+        self._read_existing()
+
+    def _read_existing(self):
+        self._file.seek(0)
+        data = self._file.read()
+        if not data:
+            self._write_header()
+            return
+        if len(data) < FILE_HEADER.size or FILE_HEADER.unpack_from(data) != (MAGIC, VERSION):
+            self._file.close()
+            raise ValueError(f"{self.path} is not an event journal of version {VERSION}")
+        offset = FILE_HEADER.size
+        while offset + LENGTH_PREFIX.size <= len(data):
+            (length,) = LENGTH_PREFIX.unpack_from(data, offset)
+            record = data[offset + LENGTH_PREFIX.size:offset + LENGTH_PREFIX.size + length]
+            if len(record) < length:
+                break
+            ordinal, user_id_length = EVENT.unpack_from(record)
+            names = record[EVENT.size:]
+            self._index((names[:user_id_length].decode(), names[user_id_length:].decode()), ordinal)
+            offset += LENGTH_PREFIX.size + length
+        if offset < len(data):
+            # Cutting off a record a crash left half-written, so the next records are not appended behind it
+            self._file.truncate(offset)
+
+    def _write_header(self):
+        self._file.write(FILE_HEADER.pack(MAGIC, VERSION))
+        self._file.flush()
+        self._unsynced += 1
+
+    def _index(self, habit_key, ordinal):
+        ordinals = self.pending.setdefault(habit_key, [])
+        if ordinal in ordinals:
+            return False
+        ordinals.append(ordinal)
+        self.pending_count += 1
+        return True
+
+    def append(self, user_id, name, ordinal):
+        """
+        Records a check-off event, unless the same event is already waiting for compaction.
+        The habit is identified by its tenant and name, which unlike its rowid are never reused for another habit.
+        :param user_id: the tenant the habit belongs to
+        :param name: the name of the habit
+        :param ordinal: the date ordinal of the check-off date
+        :return: True if the event was recorded
+        """
+        if not self._index((user_id, name), ordinal):
+            return False
+        user_id_bytes = user_id.encode()
+        names = user_id_bytes + name.encode()
+        self._file.write(LENGTH_PREFIX.pack(EVENT.size + len(names)) + EVENT.pack(ordinal, len(user_id_bytes))
+                         + names)
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self.sync()
+        return True
+
+    def sync(self):
+        """
+        Makes sure every recorded event is on disk.
+        """
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def pending_dates(self, user_id, name):
+        """
+        :return: list of the check-off dates of a habit that wait for compaction, as ISO 8601 strings
+        """
+        return [date.fromordinal(ordinal).isoformat() for ordinal in self.pending.get((user_id, name), ())]
+
+    def drain(self):
+        """
+        Hands over all pending events for compaction, without forgetting them yet, see truncate.
+        :return: list of (user_id, name, event_date) tuples with the dates as ISO 8601 strings
+        """
+        self.sync()
+        return [(user_id, name, date.fromordinal(ordinal).isoformat())
+                for (user_id, name), ordinals in self.pending.items() for ordinal in ordinals]
+
+    def truncate(self):
+        """
+        Forgets all pending events once they are safely in the database.
+        """
+        self._file.truncate(0)
+        self._write_header()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self.pending.clear()
+        self.pending_count = 0
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+class JournaledStore(SQLiteStore):
+    def __init__(self, conn, journal, compact_every=10_000):
+        """
+        JournaledStore class constructor designed to take check-offs at a high rate.
+        append_check_off only writes to the event journal, and the journal is merged into the habit table
+        in one transaction once compact_every events are waiting, or when compact() is called.
+        Reads overlay the events that are not compacted yet, and operations working on the table itself
+        compact the journal first.
+        :param conn: An SQLite database connection object
+        :param journal: the EventJournal object
+        :param compact_every: the number of pending events that triggers a compaction
+        """
+        super().__init__(conn)
+        self.journal = journal
+        self.compact_every = compact_every
+        # The (user_id, name) of the habits known to exist, so appending does not look them up every time
+        self._known_habits = set()
+        self._journaled_events = 0
+
+    def compact(self):
+        """
+        Merges the pending events of the journal into the habit table in one transaction and empties the journal.
+        :return: the number of check-off dates added to the table
+        """
+        events = self.journal.drain()
+        if not events:
+            return 0
+        added = self.append_check_offs(events)
+        # Replaying the journal after a crash right here would only add dates that are already present
+        self.journal.truncate()
+        return added
+
+    def _habit_exists(self, user_id, name):
+        if (user_id, name) not in self._known_habits:
+            if self.get_habit_id(user_id, name) is None:
+                return False
+            self._known_habits.add((user_id, name))
+        return True
+
+    def append_check_off(self, user_id, name, event_date):
+        if not self._habit_exists(user_id, name):
+            return False
+        appended = self.journal.append(user_id, name, date.fromisoformat(event_date).toordinal())
+        if appended:
+            self._journaled_events += 1
+        # Waiting for the end of a batch, so a rolled back batch cannot take journaled events with it
+        if self.journal.pending_count >= self.compact_every and self._batch_depth == 0:
+            self.compact()
+        return appended
+
+    def change_counter(self):
+        # Counting the journaled events as changes, so caches keyed on the counter notice them before compaction
+        return super().change_counter() + self._journaled_events
+
+    def get_habits_with_ids(self, user_id, name=None):
+        records = super().get_habits_with_ids(user_id, name)
+        if not self.journal.pending_count:
+            return records
+        overlaid = []
+        for habit_id, (habit_name, *fields, check_off_dates) in records:
+            pending_dates = [date_str for date_str in self.journal.pending_dates(user_id, habit_name)
+                             if date_str not in check_off_dates]
+            overlaid.append((habit_id, (habit_name, *fields, check_off_dates + pending_dates)))
+        return overlaid
+
+    @contextmanager
+    def _compacted(self):
+        # Operations that read or rewrite the table as a whole see the journaled events merged in first
+        self.compact()
+        yield
+
+    def changes_since(self, seq, limit):
+        # The journaled check-offs get their sequence numbers when they are merged into the table
+        with self._compacted():
+            return super().changes_since(seq, limit)
+
+    def period_counts(self, user_id, first_day, last_day):
+        with self._compacted():
+            return super().period_counts(user_id, first_day, last_day)
+
+    def iter_check_off_batches(self, batch_size):
+        with self._compacted():
+            yield from super().iter_check_off_batches(batch_size)
+
+    def delete_habit(self, user_id, name):
+        with self._compacted():
+            self._known_habits.discard((user_id, name))
+            super().delete_habit(user_id, name)
+
+    def clear_check_off_dates(self):
+        with self._compacted():
+            super().clear_check_off_dates()
+
+    def clear(self):
+        with self._compacted():
+            self._known_habits.clear()
+            super().clear()
@@ -1,22 +1,32 @@
-import json
+import argparse
+import os
 import sys
 # noinspection PyUnresolvedReferences
 from datetime import datetime, timedelta, date
-import pandas as pd
 import questionary
-from dataschema import get_db
+from dataschema import get_db, compact_check_off_dates, compact_journal, delete_habit, search_habits
 # noinspection PyUnresolvedReferences
 from habit import Habit, DailyHabit, WeeklyHabit, MonthlyHabit
 import logging
 # noinspection PyUnresolvedReferences
+import correlation
 import dataframe
 # noinspection PyUnresolvedReferences
 import asyncio
+from pager import frame_table
+from picker import pick_habit
+from profiling import profiled
+from service import make_server
+from snapshot import write_snapshot
+import trends
 
 # Setting logging level
 logging.basicConfig(level=logging.DEBUG)
 logging.getLogger('asyncio').setLevel(logging.WARNING)
 
+# The snapshot file written by the snapshot command and read by the streak reports while it is current
+SNAPSHOT_PATH = 'main.db-snapshot'
+
 
 # Creating a function for getting a user-input date
 def get_date_from_user():
@@ -51,33 +61,74 @@ def get_date_from_user():
     return user_date
 
 
-def ensure_unique_checkoff_dates(db, habit):
+def show_pages(table):
+    """
+    Prints a paged table one page at a time, letting the user move between the pages.
+    :param table: the PagedTable object to show
+    """
+    page = 0
+    while True:
+        print(table.render_page(page))
+        if table.page_count == 1:
+            return
+        choices = (["Next page"] if page < table.page_count - 1 else []) + (["Previous page"] if page > 0 else [])
+        move = questionary.select(f"Page {page + 1} of {table.page_count}",
+                                  choices=choices + ["Go back to main menu"]).ask()
+        if move == "Next page":
+            page += 1
+        elif move == "Previous page":
+            page -= 1
+        else:
+            return
+
+
+def compact(name='main.db'):
+    """
+    A maintenance command that deduplicates, sorts and re-anchors the check-off dates of all habits,
+    after merging the check-offs still waiting in the event journal into the database, if there is one.
+    It is meant to be run on its own, so starting the command-line interface does not have to do this work.
+    :param name: the name of the database file
+    """
+    # Opening the journal only where one was written, so the command does not create it for everybody else
+    db = None
+    if os.path.exists(name + "-events"):
+        try:
+            db = get_db(name, journal=True)
+        except ValueError as e:
+            print(f"{e}; its check-offs are merged when that session ends.")
+    if db is None:
+        db = get_db(name)
+    with db:
+        print(f"Merged {compact_journal(db)} journaled check-off(s) into the database.")
+        rewritten = compact_check_off_dates(db)
+        print(f"Compacted the check-off dates of {rewritten} habit(s).")
+
+
+def snapshot(path=SNAPSHOT_PATH):
     """
-    Ensures the uniqueness of check-off dates for a given habit.
-    :param db: An SQLite database connection object
-    :param habit: Habit object
+    A maintenance command that writes the habit histories to a binary snapshot file, see snapshot.py.
+    The streak reports read the snapshot instead of the database until the next change to the habits.
+    :param path: the name of the snapshot file
     """
-    cur = db.cursor()
-    try:
-        # Retrieving the current check_off_dates for the habit
-        cur.execute("SELECT check_off_dates FROM habit WHERE name=?;", (habit.name,))
-        result = cur.fetchone()
-        if result:
-            check_off_dates_str = result[0]
-            # Deserializing the current check_off_dates
-            check_off_dates = json.loads(check_off_dates_str) if check_off_dates_str else []
-            # Ensuring uniqueness of check-off dates
-            unique_dates = list(set(check_off_dates))
-            if len(unique_dates) != len(check_off_dates):
-                # Updating the check_off_dates column in the habit table if duplicates found
-                cur.execute("UPDATE habit SET check_off_dates=? WHERE name=?;", (json.dumps(unique_dates), habit.name))
-                db.commit()
-                print(f"Removed duplicate check-off dates for habit '{habit.name}'.")
-    except Exception as e:
-        # Logging the exception
-        print(f"Error ensuring uniqueness of check-off dates: {e}")
-    finally:
-        cur.close()
+    with get_db() as db:
+        written = write_snapshot(db, path)
+        print(f"Wrote the histories of {written} habit(s) to {path}.")
+
+
+def serve(port=8000):
+    """
+    Serves the habits over a local HTTP/JSON API until interrupted, see service.py.
+    :param port: the port to listen on
+    """
+    with get_db(check_same_thread=False) as db:
+        server = make_server(db, port=port)
+        print(f"Serving Kick the Habit on http://127.0.0.1:{port}, press Ctrl+C to stop.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("Farewell, my darling.")
+        finally:
+            server.server_close()
 
 
 def cli():
@@ -87,14 +138,8 @@ def cli():
     and delete habits they do not want to track anymore.
     """
     with get_db() as db:
-        # Retrieving all habit data from the database
-        habits_data = pd.read_sql_query("SELECT * FROM habit", db)
-        habits = []
-        for index, row in habits_data.iterrows():
-            habit = Habit.create_habit(row['name'], row['descr'], row['gen_date'], row['periodicity'], db=db)
-            habits.append(habit)
-            # Ensuring uniqueness of check-off dates
-            ensure_unique_checkoff_dates(db, habit)
+        # Loading all habits into the registry of the connection, so the menus below can reuse them
+        Habit.get_all_habits(db)
 
         start = questionary.select("Privacy disclaimer:"
                                    " Like everything, your data is safest when it doesn't exist."
@@ -139,20 +184,14 @@ def cli():
                 habit.store(db)
 
             elif choice == "4. Delete habit":
-                # Retrieving the list of existing habits
-                habits = pd.read_sql_query("SELECT name FROM habit ORDER BY name", db)
-
-                if habits.empty:
+                # Checking whether there is any habit, without retrieving the list of existing habits
+                if not search_habits(db, "", limit=1):
                     print("No habits found that you can delete.")
                 else:
-                    # Providing an extra option with to go back to the main menu
-                    habits_list = habits['name'].tolist()
-                    habits_list.append("Go back to main menu")
-
-                    habit_to_delete = questionary.select(
-                        "Select the habit to delete:", choices=habits_list).ask()
+                    # Searching the habits as the user types, an empty answer going back to the main menu
+                    habit_to_delete = pick_habit(db, "Select the habit to delete:")
                     # Checking if the user chose to go back to the main menu
-                    if habit_to_delete == "Go back to main menu":
+                    if habit_to_delete is None:
                         # Skipping the rest of the loop and going back to the main menu
                         continue
 
@@ -161,26 +200,20 @@ def cli():
                         f"Are you sure you want to delete the habit '{habit_to_delete}'?", choices=[
                             "Yes", "No"]).ask()
                     if confirm_deletion == "Yes":
-                        db.execute("DELETE FROM habit WHERE name=?", (habit_to_delete,))
-                        db.commit()
+                        delete_habit(db, habit_to_delete)
                         print(f"Habit '{habit_to_delete}' has been successfully deleted.")
                     else:
                         print("The deletion process has been terminated.")
 
             elif choice == "1. My habits":
-                # Retrieving the list of currently existing habits
-                habits = pd.read_sql_query("SELECT name FROM habit ORDER BY name", db)
-
-                if habits.empty:
+                # Checking whether there is any habit, without retrieving the list of currently existing habits
+                if not search_habits(db, "", limit=1):
                     print("No habits found in the database.")
                 else:
-                    # Listing the name of habits with providing an extra option to go back to the main menu
-                    habits_list = habits['name'].tolist()
-                    habits_list.append("Go back to main menu")
-                    habit_name_to_view = questionary.select(
-                        "Select habit:", choices=habits_list).ask()
+                    # Searching the habits as the user types, an empty answer going back to the main menu
+                    habit_name_to_view = pick_habit(db, "Select habit:")
                     # Checking if the user chose to go back to the main menu
-                    if habit_name_to_view == "Go back to main menu":
+                    if habit_name_to_view is None:
                         # Skipping the rest of the loop and going back to the main menu
                         continue
                     habit_to_view = Habit.get_habit_by_name(db, habit_name_to_view)
@@ -216,13 +249,13 @@ def cli():
                         "1. Data for individual habits", "2. Aggregate stats across all habits"
                     ]).ask()
                 if ind_or_agg == "1. Data for individual habits":
-                    # Retrieving the list of currently existing habits
-                    habits = pd.read_sql_query("SELECT name FROM habit", db)
-                    if habits.empty:
+                    # Checking whether there is any habit, without retrieving the list of currently existing habits
+                    if not search_habits(db, "", limit=1):
                         print("No habits found that you can see data for.")
                     else:
-                        habit_name_to_analyze = questionary.select(
-                            "Select the habit to view stats for:", choices=habits['name'].tolist()).ask()
+                        habit_name_to_analyze = pick_habit(db, "Select the habit to view stats for:")
+                        if habit_name_to_analyze is None:
+                            continue
                         # Retrieving the corresponding Habit object from the database
                         habit_to_analyze = Habit.get_habit_by_name(db, habit_name_to_analyze)
                         stats_table = habit_to_analyze.get_individual_stats()
@@ -236,13 +269,17 @@ def cli():
                             "Longest-run current streak",
                             "Longest-run historical streak",
                             "Shortest and longest average streak",
-                            "Lowest and highest resistance ratio"
+                            "Lowest and highest resistance ratio",
+                            "Guilt trends",
+                            "Habits that go together",
+                            "Streak length percentiles"
                         ]
                     ).ask()
                     if aggregate_choice == "All habits tracked":
-                        all_habits_df = dataframe.display_all_habits_tracked(db)
-                        if all_habits_df is not None:
-                            print(all_habits_df)
+                        # Calculating the stats of the habits page by page, as they are shown
+                        all_habits_table = dataframe.page_all_habits_tracked(db)
+                        if all_habits_table is not None:
+                            show_pages(all_habits_table)
                         else:
                             print("No habits found in the database.")
                     elif aggregate_choice == "All same-periodicity habits tracked":
@@ -252,23 +289,26 @@ def cli():
                         ).ask()
                         all_same_period_df = dataframe.display_all_same_periodicity_habits_tracked(db, periodicity)
                         if all_same_period_df is not None:
-                            print(all_same_period_df)
+                            show_pages(frame_table(all_same_period_df))
                         else:
                             print(f"No {periodicity.lower()} habits found in the database.")
                     elif aggregate_choice == "Longest-run current streak":
-                        longest_streak_table = dataframe.calculate_longestrun_current_streak(db)
+                        longest_streak_table = dataframe.calculate_longestrun_current_streak(
+                            db, snapshot_path=SNAPSHOT_PATH)
                         if longest_streak_table is not None:
                             print("The longest-run current streak across all habits is…:")
                             print(longest_streak_table)
                         else:
                             print("No habits found in the database.")
                     elif aggregate_choice == "Longest-run historical streak":
-                        longest_historical_streak_table = dataframe.calculate_longest_historical_streak(db)
+                        longest_historical_streak_table = dataframe.calculate_longest_historical_streak(
+                            db, snapshot_path=SNAPSHOT_PATH)
                         if longest_historical_streak_table is not None:
                             print("The longest-run historical streak across all habits is…")
                             print(longest_historical_streak_table)
                     elif aggregate_choice == "Shortest and longest average streak":
-                        lowest_largest_stats_aver_table = dataframe.calculate_lowest_and_largest_average_streak(db)
+                        lowest_largest_stats_aver_table = dataframe.calculate_lowest_and_largest_average_streak(
+                            db, snapshot_path=SNAPSHOT_PATH)
                         if lowest_largest_stats_aver_table is not None:
                             print("The minimum and maximum values for the average streak are as follows.")
                             print(lowest_largest_stats_aver_table)
@@ -277,10 +317,71 @@ def cli():
                         if lowest_largest_resistance_ratio is not None:
                             print("The minimum and maximum values for the average streak are as follows.")
                             print(lowest_largest_resistance_ratio)
+                    elif aggregate_choice == "Guilt trends":
+                        guilt_trends = trends.calculate_guilt_trends(db)
+                        if guilt_trends is not None:
+                            print("The guilt rates over the last 7, 30 and 90 periods, and their change since a week "
+                                  "ago in percentage points:")
+                            show_pages(frame_table(guilt_trends))
+                    elif aggregate_choice == "Habits that go together":
+                        correlated_habits = correlation.calculate_most_correlated_habits(db)
+                        if correlated_habits is not None:
+                            print("The pairs of habits whose guilty weeks coincide the most:")
+                            print(correlated_habits)
+                    elif aggregate_choice == "Streak length percentiles":
+                        streak_percentiles = dataframe.calculate_streak_length_percentiles(
+                            db, snapshot_path=SNAPSHOT_PATH)
+                        if streak_percentiles is not None:
+                            print("The distribution of the streak lengths of the habits of each periodicity:")
+                            print(streak_percentiles)
             else:
                 print("Farewell, my darling.")
                 stop = True
 
 
+def parse_args(argv=None):
+    """
+    Parses the command line: no command starts the interactive interface, the other commands are described below.
+    :param argv: the arguments without the program name (default is sys.argv[1:])
+    :return: argparse.Namespace object
+    """
+    parser = argparse.ArgumentParser(description="Kick the Habit: track the habits you want to get rid of.")
+    parser.add_argument("--profile", action="store_true",
+                        help="profile the session and write cProfile stats and flame graph stacks on exit")
+    parser.add_argument("--profile-dir", help="the directory the profile is written to (default is profile-<time>)")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="also trace allocations with tracemalloc and report the top ones")
+    parser.add_argument("--profile-top", type=int, default=25,
+                        help="the number of functions and allocations listed in the reports")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("compact", help="deduplicate, sort and re-anchor the stored check-off dates")
+    snapshot_parser = commands.add_parser("snapshot", help="write the habit histories to a binary snapshot")
+    snapshot_parser.add_argument("path", nargs="?", default=SNAPSHOT_PATH)
+    serve_parser = commands.add_parser("serve", help="serve the habits over a local HTTP/JSON API")
+    serve_parser.add_argument("port", nargs="?", type=int, default=8000)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "compact":
+        def run():
+            compact()
+    elif args.command == "snapshot":
+        def run():
+            snapshot(args.path)
+    elif args.command == "serve":
+        def run():
+            serve(port=args.port)
+    else:
+        run = cli
+    if args.profile:
+        # Profiling the whole session, so a slow run can be attached to a bug report as it happened
+        with profiled(args.profile_dir, args.profile_memory, args.profile_top):
+            run()
+    else:
+        run()
+
+
 if __name__ == '__main__':
-    cli()
+    main()
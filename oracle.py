@@ -0,0 +1,205 @@
+# Reference oracle for the habit statistics and a seeded generator of random habit histories to check
+# faster implementations against it
+import os
+import random
+from datetime import date, timedelta
+from dataframe import calc_stats_from_snapshot
+from dataschema import add_habit_to_db, batch, get_db
+from habit import Habit, STATS_COLUMNS
+from snapshot import Snapshot, write_snapshot
+from storage import DEFAULT_USER, get_store
+
+PERIODICITIES = ["Daily", "Weekly", "Monthly"]
+
+
+def period_of(day, periodicity):
+    """
+    Names the period a day falls in, from the calendar itself rather than the period arithmetic of periods.py.
+    :param day: the date as a date object
+    :param periodicity: one of three string values: daily, weekly, monthly
+    :return: the day itself, the ISO (year, week) or the (year, month), only meant to be compared for equality
+    """
+    if periodicity == "Weekly":
+        return day.isocalendar()[:2]
+    if periodicity == "Monthly":
+        return day.year, day.month
+    return day
+
+
+def calendar_periods(first_day, last_day, periodicity):
+    """
+    Walks the calendar day by day and lists the periods touched by a window of days, in order.
+    :param first_day: the first day of the window
+    :param last_day: the last day of the window
+    :param periodicity: one of three string values: daily, weekly, monthly
+    :return: list of (period, first day of the period) tuples, see period_of, empty if the window is empty
+    """
+    if last_day < first_day:
+        return []
+    day = first_day
+    # Stepping back to the first day of the period the window starts in
+    while period_of(day - timedelta(days=1), periodicity) == period_of(first_day, periodicity):
+        day -= timedelta(days=1)
+    periods = []
+    while day <= last_day:
+        if not periods or periods[-1][0] != period_of(day, periodicity):
+            periods.append((period_of(day, periodicity), day))
+        day += timedelta(days=1)
+    return periods
+
+
+def reference_stats(name, gen_date, periodicity, check_off_dates, today):
+    """
+    Calculates the individual statistics of a habit straight from their definitions, written to be obviously
+    right rather than fast, and without periods.py, which the implementations share: the calendar is walked
+    day by day, every period on the way is guilty if a check-off date falls in it, runs of guilty periods are
+    the streaks, and every statistic is read off those streaks and the periods from gen_date to today.
+    :param name: the name of the habit
+    :param gen_date: the date when the habit was created as a date object
+    :param periodicity: one of three string values: daily, weekly, monthly
+    :param check_off_dates: the check-off dates as date objects, anchored to the start of their period
+    :param today: the date the statistics are calculated on
+    :return: a dictionary with the keys of STATS_COLUMNS, as returned by Habit.calc_individual_stats_row
+    """
+    guilty = {period_of(day, periodicity) for day in check_off_dates}
+    streak_lengths = []
+    current_streak = 0
+    previous_guilty = False
+    for period, _ in calendar_periods(min([gen_date, *check_off_dates]), max([today, *check_off_dates]),
+                                      periodicity):
+        if period in guilty:
+            if previous_guilty:
+                streak_lengths[-1] += 1
+            else:
+                streak_lengths.append(1)
+        previous_guilty = period in guilty
+        # The current streak is the run of guilty periods reaching the current period
+        if period == period_of(today, periodicity):
+            current_streak = streak_lengths[-1] if previous_guilty else 0
+    periods_with_data = len(calendar_periods(gen_date, today, periodicity))
+    total_completed = len(guilty)
+    total_resisted = periods_with_data - total_completed
+    resistance_ratio = f"{total_resisted * 100 / periods_with_data:.2f}%" if periods_with_data else "0%"
+    return dict(zip(STATS_COLUMNS, (
+        name,
+        gen_date.strftime("%Y/%m/%d"),
+        periodicity,
+        current_streak,
+        total_completed,
+        total_resisted,
+        resistance_ratio,
+        max(streak_lengths, default=0),
+        round(sum(streak_lengths) / len(streak_lengths), 2) if streak_lengths else 0
+    )))
+
+
+def random_today(rng):
+    """
+    :param rng: random.Random object
+    :return: a random date between 2000 and 2039, so leap days and year boundaries come up
+    """
+    return date(2000, 1, 1) + timedelta(days=rng.randrange(40 * 365))
+
+
+def random_habits(rng, habit_count, today, max_history_days=3 * 365):
+    """
+    Generates random habit records ending on a given day, from empty histories over single check-offs and
+    streaks reaching into the current period to dense histories without gaps. Each history is a two-state
+    chain over the periods since the creation date: every period repeats the decision of the period before it
+    with a random stickiness and otherwise decides anew with a random density.
+    :param rng: random.Random object
+    :param habit_count: the number of habits
+    :param today: the last day of the histories
+    :param max_history_days: the largest number of days between the creation date of a habit and today
+    :return: list of dictionaries with the keyword arguments of Habit.from_record
+    """
+    habits = []
+    for index in range(habit_count):
+        periodicity = rng.choice(PERIODICITIES)
+        gen_date = today - timedelta(days=rng.choice([0, rng.randrange(max_history_days + 1)]))
+        density, stickiness = rng.random(), rng.random()
+        check_off_dates = []
+        checked = False
+        for _, first_day in calendar_periods(gen_date, today, periodicity):
+            if rng.random() >= stickiness:
+                checked = rng.random() < density
+            if checked:
+                check_off_dates.append(first_day)
+        habits.append({'name': f"Habit {index}", 'descr': "", 'gen_date': gen_date, 'periodicity': periodicity,
+                       'check_off_dates': check_off_dates})
+    return habits
+
+
+def random_cases(seed, rounds, habit_count):
+    """
+    Generates the same rounds of random test cases for the same seed.
+    :param seed: the seed of the random generator
+    :param rounds: the number of rounds
+    :param habit_count: the largest number of habits in a round
+    :return: generator of (today, habit records) tuples, see random_habits
+    """
+    rng = random.Random(seed)
+    for _ in range(rounds):
+        today = random_today(rng)
+        yield today, random_habits(rng, rng.randint(1, habit_count), today)
+
+
+def diff_stats(expected_rows, actual_rows):
+    """
+    Compares the statistics of an implementation with those of the oracle, metric by metric.
+    :param expected_rows: the rows of the oracle, see reference_stats
+    :param actual_rows: the rows of the implementation in the same order
+    :return: list of (habit name, column, expected value, actual value) tuples, empty if everything matches
+    """
+    if len(expected_rows) != len(actual_rows):
+        return [(None, 'rows', len(expected_rows), len(actual_rows))]
+    return [(expected['Name'], column, expected[column], actual[column])
+            for expected, actual in zip(expected_rows, actual_rows)
+            for column in STATS_COLUMNS if expected[column] != actual[column]]
+
+
+def prepare_oracle(habits, directory):
+    """
+    Prepares the oracle itself, to time the implementations against it.
+    :param habits: habit records, see random_habits
+    :param directory: a directory for files the implementation needs
+    :return: function taking today and returning the rows of all habits
+    """
+    return lambda today: [reference_stats(habit['name'], habit['gen_date'], habit['periodicity'],
+                                          habit['check_off_dates'], today) for habit in habits]
+
+
+def prepare_habit(habits, directory):
+    """
+    Prepares the Habit objects, see prepare_oracle.
+    """
+    habit_objects = [Habit.from_record(**habit) for habit in habits]
+    return lambda today: [habit.calc_individual_stats_row() for habit in habit_objects]
+
+
+def prepare_snapshot(habits, directory):
+    """
+    Prepares a snapshot of the habits written from an in-memory store, see prepare_oracle.
+    """
+    db = get_db(backend='memory')
+    with batch(db):
+        for habit in habits:
+            add_habit_to_db(db, habit['name'], habit['descr'], habit['gen_date'], habit['periodicity'])
+        get_store(db).replace_check_off_dates([(DEFAULT_USER, habit['name'],
+                                                [day.isoformat() for day in habit['check_off_dates']])
+                                               for habit in habits])
+    path = os.path.join(directory, "fuzz.db-snapshot")
+    write_snapshot(db, path)
+
+    def run(today):
+        with Snapshot(path) as snapshot:
+            return calc_stats_from_snapshot(snapshot).to_dict('records')
+    return run
+
+
+# The implementations checked against the oracle; each prepares its input outside the timed part and returns
+# a function calculating the rows of all habits for a given today, in any order
+ENGINES = {
+    'Habit': prepare_habit,
+    'snapshot': prepare_snapshot,
+}
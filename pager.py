@@ -0,0 +1,109 @@
+# Paged rendering of stats tables for the command-line interface
+import math
+import shutil
+import textwrap
+from instrumentation import instrumented
+
+
+class PagedTable:
+    def __init__(self, columns, row_count, fetch_rows, page_size=20, sample_size=None, max_width=None):
+        """
+        PagedTable class constructor designed to render big tables one page at a time.
+        Rows are fetched page by page only when a page is rendered, and the column widths are computed once
+        from the headers and a sample of the first rows, so every page lines up without looking at all rows.
+        :param columns: the column names of the table
+        :param row_count: the total number of rows
+        :param fetch_rows: function taking an offset and a limit and returning that many rows as dictionaries
+                           keyed by the column names
+        :param page_size: the number of rows on a page
+        :param sample_size: the number of rows the column widths are computed from (default is page_size)
+        :param max_width: the width the table has to fit in (default is the width of the terminal)
+        """
+        self.columns = list(columns)
+        self.row_count = row_count
+        self.fetch_rows = fetch_rows
+        self.page_size = page_size
+        self.sample_size = sample_size or page_size
+        self.max_width = max_width or shutil.get_terminal_size().columns
+        self._pages = {}
+        self._widths = None
+
+    @property
+    def page_count(self):
+        return max(1, math.ceil(self.row_count / self.page_size))
+
+    def page_rows(self, page):
+        """
+        Fetches the rows of a page, once.
+        :param page: the index of the page, starting with 0
+        :return: list of row dictionaries
+        """
+        if page not in self._pages:
+            self._pages[page] = self.fetch_rows(page * self.page_size, self.page_size)
+        return self._pages[page]
+
+    def widths(self):
+        """
+        :return: list of the column widths, computed from the headers and the sample rows
+        """
+        if self._widths is None:
+            # Taking the sample from the first pages, which are the ones rendered first anyway
+            sample = [row for page in range(math.ceil(self.sample_size / self.page_size))
+                      for row in self.page_rows(page)][:self.sample_size]
+            # Limiting the column widths by the terminal width, like tabulate's maxcolwidths did
+            max_column_width = max(1, self.max_width // len(self.columns))
+            self._widths = [
+                min(max_column_width, max([len(word) for word in column.split()] +
+                                          [len(str(row[column])) for row in sample]))
+                for column in self.columns
+            ]
+        return self._widths
+
+    @instrumented
+    def render_page(self, page):
+        """
+        Renders one page of the table with barriers between the rows and columns, like tabulate's 'pretty' format.
+        :param page: the index of the page, starting with 0
+        :return: the page as a string
+        """
+        widths = self.widths()
+        separator = "+" + "+".join("-" * (width + 2) for width in widths) + "+"
+        # Breaking the headers after each word
+        lines = [separator, self._render_row([column.replace(" ", "\n") for column in self.columns], widths),
+                 separator]
+        for row in self.page_rows(page):
+            lines.append(self._render_row([str(row[column]) for column in self.columns], widths))
+        lines.append(separator)
+        return "\n".join(lines)
+
+    @staticmethod
+    def _render_row(cells, widths):
+        # Wrapping cells wider than their column over several lines
+        cell_lines = [[wrapped for part in cell.split("\n") for wrapped in textwrap.wrap(part, width) or [""]]
+                      for cell, width in zip(cells, widths)]
+        height = max(len(lines) for lines in cell_lines)
+        return "\n".join(
+            "| " + " | ".join((lines[index] if index < len(lines) else "").center(width)
+                              for lines, width in zip(cell_lines, widths)) + " |"
+            for index in range(height)
+        )
+
+    def iter_pages(self):
+        """
+        Renders the pages one after the other, fetching the rows of each only when it is reached.
+        :return: generator of rendered pages
+        """
+        for page in range(self.page_count):
+            yield self.render_page(page)
+
+
+def frame_table(df, page_size=20):
+    """
+    Wraps an already calculated DataFrame in a PagedTable, so it is printed one page at a time.
+    :param df: the DataFrame
+    :param page_size: the number of rows on a page
+    :return: PagedTable object
+    """
+    return PagedTable([str(column) for column in df.columns], len(df),
+                      lambda offset, limit: df.iloc[offset:offset + limit].rename(columns=str).to_dict('records'),
+                      page_size)
@@ -0,0 +1,91 @@
+# Period arithmetic shared by the habit statistics and the storage backends
+from datetime import date, timedelta
+
+
+def period_start(day: date, periodicity: str) -> date:
+    """
+    Anchors a date to the start of its period: the day itself, the Monday of its ISO week or the first of its month.
+    :param day: the date as a date object
+    :param periodicity: the periodicity of the habit as a string
+    :return: the start of the period as a date object
+    """
+    if periodicity == "Weekly":
+        return day - timedelta(days=day.weekday())
+    if periodicity == "Monthly":
+        return day.replace(day=1)
+    return day
+
+
+def period_ordinal(day: date, periodicity: str) -> int:
+    """
+    Numbers the periods consecutively, so that two periods follow each other exactly when their ordinals differ by 1:
+    days by their date ordinal, ISO weeks by the number of weeks since the first Monday of year 1 and months
+    by the number of months since year 0.
+    :param day: the date as a date object
+    :param periodicity: the periodicity of the habit as a string
+    :return: the ordinal of the period containing the date as an integer
+    """
+    if periodicity == "Weekly":
+        # date(1, 1, 1) is a Monday with ordinal 1
+        return (day.toordinal() - 1) // 7
+    if periodicity == "Monthly":
+        return day.year * 12 + day.month - 1
+    return day.toordinal()
+
+
+def period_from_ordinal(ordinal: int, periodicity: str) -> date:
+    """
+    Turns a period ordinal back into the start of its period, the inverse of period_ordinal.
+    :param ordinal: the period ordinal as an integer
+    :param periodicity: the periodicity of the habit as a string
+    :return: the start of the period as a date object
+    """
+    if periodicity == "Weekly":
+        return date.fromordinal(ordinal * 7 + 1)
+    if periodicity == "Monthly":
+        return date(ordinal // 12, ordinal % 12 + 1, 1)
+    return date.fromordinal(ordinal)
+
+
+def count_periods(first_day: date, last_day: date, periodicity: str) -> int:
+    """
+    Counts the periods touched by a window of days, including partly covered periods at either end.
+    :param first_day: the first day of the window
+    :param last_day: the last day of the window
+    :param periodicity: the periodicity of the habit as a string
+    :return: the number of periods as an integer, 0 if the window is empty
+    """
+    if last_day < first_day:
+        return 0
+    first_period, last_period = period_start(first_day, periodicity), period_start(last_day, periodicity)
+    if periodicity == "Weekly":
+        return (last_period - first_period).days // 7 + 1
+    if periodicity == "Monthly":
+        return (last_period.year - first_period.year) * 12 + last_period.month - first_period.month + 1
+    return (last_period - first_period).days + 1
+
+
+def format_resistance_ratio(resisted: int, periods: int) -> str:
+    """
+    Formats the share of resisted periods the way the stats tables show it.
+    :param resisted: the number of resisted periods
+    :param periods: the number of periods with data
+    :return: the ratio as a percentage string, e.g. '96.58%'
+    """
+    if periods == 0:
+        return "0%"
+    return "{:.2f}%".format((resisted / periods) * 100)
+
+
+def count_completed_periods(check_off_dates, first_day: date, last_day: date, periodicity: str) -> int:
+    """
+    Counts the periods of a window of days in which the habit was checked off at least once.
+    :param check_off_dates: the check-off dates as date objects
+    :param first_day: the first day of the window
+    :param last_day: the last day of the window
+    :param periodicity: the periodicity of the habit as a string
+    :return: the number of completed periods as an integer
+    """
+    first_period, last_period = period_start(first_day, periodicity), period_start(last_day, periodicity)
+    return len({period for period in (period_start(day, periodicity) for day in check_off_dates)
+                if first_period <= period <= last_period})
@@ -0,0 +1,43 @@
+# Search-as-you-type habit picker for the menus of the command-line interface
+import questionary
+from prompt_toolkit.completion import Completer, Completion
+from dataschema import search_habits, get_habit_data
+from storage import DEFAULT_USER
+
+
+class HabitCompleter(Completer):
+    def __init__(self, db, user_id=DEFAULT_USER, limit=20):
+        """
+        HabitCompleter class constructor designed to suggest habits while the user types,
+        querying the search index with a result limit instead of listing every habit.
+        :param db: the database connection object
+        :param user_id: the tenant whose habits are suggested
+        :param limit: the maximum number of suggestions shown at a time
+        """
+        self.db = db
+        self.user_id = user_id
+        self.limit = limit
+
+    def get_completions(self, document, complete_event):
+        text = document.text_before_cursor
+        for name, descr in search_habits(self.db, text, self.limit, self.user_id):
+            # Replacing everything typed so far with the suggested habit name
+            yield Completion(name, start_position=-len(text), display_meta=descr or "")
+
+
+def pick_habit(db, message, user_id=DEFAULT_USER, limit=20):
+    """
+    Asks the user to pick a habit by typing a part of its name or description.
+    :param db: the database connection object
+    :param message: the question shown to the user
+    :param user_id: the tenant whose habits can be picked
+    :param limit: the maximum number of suggestions shown at a time
+    :return: the name of the picked habit, or None if the user left the answer empty to go back
+    """
+    answer = questionary.autocomplete(
+        f"{message} (type to search, leave empty to go back)",
+        choices=[],
+        completer=HabitCompleter(db, user_id, limit),
+        validate=lambda text: not text or bool(get_habit_data(db, text, user_id)) or "No habit with this name.",
+    ).ask()
+    return answer or None
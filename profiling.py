@@ -0,0 +1,118 @@
+# Profiling of whole sessions: cProfile statistics, sampled call stacks for flame graphs and top allocations
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+
+class StackSampler:
+    def __init__(self, thread_id, interval=0.005):
+        """
+        StackSampler class constructor designed to record the call stacks of a thread at a fixed interval
+        from a background thread, so the time spent in each stack can be drawn as a flame graph.
+        :param thread_id: the identifier of the sampled thread
+        :param interval: the seconds between two samples
+        """
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write_collapsed(self, path):
+        """
+        Writes the samples in the collapsed-stack format of flamegraph.pl and speedscope: one line per stack,
+        the frames from the outermost one separated by semicolons, followed by the number of samples.
+        :param path: the name of the output file
+        """
+        with open(path, 'w') as collapsed_file:
+            for stack, samples in self.stacks.most_common():
+                collapsed_file.write(f"{stack} {samples}\n")
+
+
+def write_top_allocations(snapshot, path, top=25):
+    """
+    Writes the source lines that allocated the most memory still held when the snapshot was taken.
+    :param snapshot: tracemalloc.Snapshot object
+    :param path: the name of the output file
+    :param top: the number of source lines listed
+    """
+    statistics = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ]).statistics('lineno')
+    with open(path, 'w') as allocations_file:
+        allocations_file.write(f"Top {top} allocations by source line, "
+                               f"{sum(stat.size for stat in statistics) / 1024:.1f} KiB held in total\n")
+        for rank, stat in enumerate(statistics[:top], 1):
+            frame = stat.traceback[0]
+            allocations_file.write(f"{rank:>3}. {frame.filename}:{frame.lineno}  "
+                                   f"{stat.size / 1024:.1f} KiB in {stat.count} block(s)\n")
+
+
+@contextmanager
+def profiled(output_dir=None, trace_allocations=False, top=25):
+    """
+    Profiles the code run inside the with-block and writes the reports into a directory when it ends,
+    also when it ends with an exception or sys.exit():
+    - profile.pstats: the cProfile statistics, to load with pstats or snakeviz
+    - profile.txt: the functions with the most cumulative time
+    - profile.collapsed: sampled call stacks for flame graphs, see StackSampler
+    - allocations.txt: the top allocations, if trace_allocations is True
+    :param output_dir: the directory the reports are written to (default is profile-<timestamp>)
+    :param trace_allocations: if True, allocations are traced with tracemalloc, which slows everything down
+    :param top: the number of functions and allocations listed in the text reports
+    :return: a context manager giving the name of the output directory
+    """
+    output_dir = output_dir or datetime.now().strftime("profile-%Y%m%d-%H%M%S")
+    os.makedirs(output_dir, exist_ok=True)
+    if trace_allocations:
+        # Keeping a few frames per allocation, so the top lines can be traced back to their callers
+        tracemalloc.start(10)
+    sampler = StackSampler(threading.get_ident())
+    profiler = cProfile.Profile()
+    sampler.start()
+    profiler.enable()
+    try:
+        yield output_dir
+    finally:
+        profiler.disable()
+        sampler.stop()
+        allocations = None
+        if trace_allocations:
+            # Taking the allocations before writing the reports allocates anything itself
+            allocations = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        profiler.dump_stats(os.path.join(output_dir, "profile.pstats"))
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+        with open(os.path.join(output_dir, "profile.txt"), 'w') as text_file:
+            text_file.write(text.getvalue())
+        sampler.write_collapsed(os.path.join(output_dir, "profile.collapsed"))
+        if allocations is not None:
+            write_top_allocations(allocations, os.path.join(output_dir, "allocations.txt"), top)
+        print(f"Profile written to {output_dir}.")
@@ -11,8 +11,11 @@ def test_current_date():
 
 
 # Function to create the test database and add predefined habits and their check-off dates
-def setup_test_database():
-    test_db = get_db(name='test.db')
+def setup_test_database(backend='sqlite', name='test.db', shards=None, shard_by='user_id', journal=False):
+    # With backend='memory' the test habits are kept in a MemoryStore and test.db is not touched
+    # With shards the test habits are spread over that many files next to name, see dataschema.get_db
+    # With journal the check-off dates go through an event journal next to name first
+    test_db = get_db(name=name, backend=backend, shards=shards, shard_by=shard_by, journal=journal)
     create_table(test_db)
     # Adding predefined habits
     add_habit_to_db(test_db, name='Swearstorming', descr='Unleashing a torrent of colorful language',
@@ -0,0 +1,280 @@
+# Slow-query log: per-statement latency histograms, query plans and full-scan flags for the SQL of get_db connections
+import atexit
+import bisect
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from instrumentation import CountingCursor, cursor_factory as counting_cursor_factory
+
+# Setting KTH_SLOW_QUERY_MS turns the query log on: statements slower than that many milliseconds are logged
+# with the shape of their parameters, and a per-statement summary is printed at exit, to the file named in
+# KTH_QUERY_LOG_FILE or to stderr
+SLOW_QUERY_ENV = 'KTH_SLOW_QUERY_MS'
+QUERY_LOG_FILE_ENV = 'KTH_QUERY_LOG_FILE'
+# The upper bounds of the latency histogram buckets in milliseconds; the last bucket takes everything slower
+HISTOGRAM_BOUNDS_MS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000]
+# Only these statements have a query plan worth looking at
+PLANNED_STATEMENTS = ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT')
+# A full scan of a table or an index; scans of virtual tables such as json_each are expected
+FULL_SCAN = re.compile(r'^SCAN (?!CONSTANT ROW)\S+(?:$| USING)')
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_sql(sql):
+    """
+    :return: the statement with its whitespace collapsed, so the same statement is recognized wherever it comes from
+    """
+    return " ".join(sql.split())
+
+
+def parameter_shape(parameters):
+    """
+    Describes the parameters of a statement without their values, which may be private.
+    :param parameters: a sequence or a mapping of parameters
+    :return: the types of the parameters as a string, e.g. '(str, int)' or '{user_id: str}'
+    """
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{key}: {type(value).__name__}" for key, value in parameters.items()) + "}"
+    return "(" + ", ".join(type(value).__name__ for value in parameters) + ")"
+
+
+class StatementStats:
+    def __init__(self, sql):
+        """
+        StatementStats class constructor designed to collect the executions of one statement.
+        :param sql: the normalized statement
+        """
+        self.sql = sql
+        self.executions = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.slow = 0
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+        self.plan = None
+        self.full_scans = []
+
+    def add(self, seconds):
+        self.executions += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.histogram[bisect.bisect_left(HISTOGRAM_BOUNDS_MS, seconds * 1000)] += 1
+
+    def percentile_ms(self, fraction):
+        """
+        Estimates a latency percentile from the histogram.
+        :param fraction: the percentile as a fraction, e.g. 0.95
+        :return: the upper bound of the bucket holding the percentile in milliseconds, or the maximum latency
+                 for the last bucket
+        """
+        rank = fraction * self.executions
+        seen = 0
+        for index, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= rank:
+                if index < len(HISTOGRAM_BOUNDS_MS):
+                    return HISTOGRAM_BOUNDS_MS[index]
+                break
+        return round(self.max_seconds * 1000, 3)
+
+    def to_dict(self):
+        return {
+            'sql': self.sql,
+            'executions': self.executions,
+            'total_ms': round(self.seconds * 1000, 3),
+            'max_ms': round(self.max_seconds * 1000, 3),
+            'p50_ms': self.percentile_ms(0.5),
+            'p95_ms': self.percentile_ms(0.95),
+            'slow': self.slow,
+            'histogram': dict(zip([f"<={bound}ms" for bound in HISTOGRAM_BOUNDS_MS] +
+                                  [f">{HISTOGRAM_BOUNDS_MS[-1]}ms"], self.histogram)),
+            'plan': self.plan,
+            'full_scans': self.full_scans,
+        }
+
+
+class QueryLog:
+    def __init__(self):
+        """
+        QueryLog class constructor designed to trace the statements run through the cursors of get_db connections.
+        The first time a statement is seen, its query plan is captured and full scans in it are logged as warnings;
+        every execution is added to the latency histogram of the statement, and executions slower than the
+        threshold are logged with the shape of their parameters.
+        """
+        self.enabled = False
+        self.threshold_seconds = 0.1
+        self._statements = {}
+        self._lock = threading.Lock()
+
+    def enable(self, threshold_ms=100):
+        self.enabled = True
+        self.threshold_seconds = threshold_ms / 1000
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+
+    def statement(self, connection, sql, parameters):
+        """
+        Looks up the stats of a statement, capturing its query plan when the statement is new.
+        :param connection: the connection the statement runs on
+        :param sql: the statement
+        :param parameters: the parameters of the statement, used to explain it
+        :return: StatementStats object
+        """
+        normalized = normalize_sql(sql)
+        with self._lock:
+            stats = self._statements.get(normalized)
+            if stats is None:
+                stats = self._statements[normalized] = StatementStats(normalized)
+            else:
+                return stats
+        if normalized.upper().startswith(PLANNED_STATEMENTS):
+            self._capture_plan(connection, stats, sql, parameters)
+        return stats
+
+    @staticmethod
+    def _capture_plan(connection, stats, sql, parameters):
+        cur = connection.cursor(sqlite3.Cursor)
+        try:
+            cur.execute("EXPLAIN QUERY PLAN " + sql, parameters)
+            stats.plan = [row[-1] for row in cur.fetchall()]
+        except sqlite3.Error as e:
+            # Statements that cannot be explained before they run, e.g. on a table they create themselves
+            stats.plan = [f"(no plan: {e})"]
+            return
+        finally:
+            cur.close()
+        stats.full_scans = [detail for detail in stats.plan if FULL_SCAN.match(detail)]
+        if stats.full_scans:
+            logger.warning("Full scan (%s) in: %s", "; ".join(stats.full_scans), stats.sql)
+
+    def record(self, stats, seconds, shape):
+        """
+        Adds an execution to the stats of its statement and logs it if it was slow.
+        :param stats: StatementStats object, see statement
+        :param seconds: the time the statement took, including fetching its rows
+        :param shape: the shape of its parameters, see parameter_shape
+        """
+        with self._lock:
+            stats.add(seconds)
+            slow = seconds >= self.threshold_seconds
+            if slow:
+                stats.slow += 1
+        if slow:
+            logger.warning("Slow query (%.1f ms, parameters %s): %s", seconds * 1000, shape, stats.sql)
+
+    def summary(self):
+        """
+        :return: list of dictionaries, one per statement, the one with the most time in total first
+        """
+        with self._lock:
+            statements = list(self._statements.values())
+        return [stats.to_dict() for stats in sorted(statements, key=lambda stats: stats.seconds, reverse=True)]
+
+    def report(self):
+        """
+        Writes the summary as JSON to the file named in KTH_QUERY_LOG_FILE, or as text to stderr.
+        """
+        summary = self.summary()
+        if not summary:
+            return
+        path = os.environ.get(QUERY_LOG_FILE_ENV)
+        if path:
+            with open(path, 'w') as query_log_file:
+                json.dump(summary, query_log_file, indent=2)
+            return
+        for entry in summary:
+            flag = "  FULL SCAN" if entry['full_scans'] else ""
+            print(f"{entry['executions']:>8} x  total {entry['total_ms']:10.3f} ms  p50 <={entry['p50_ms']} ms  "
+                  f"p95 <={entry['p95_ms']} ms  max {entry['max_ms']} ms  slow {entry['slow']}{flag}\n"
+                  f"    {entry['sql'][:200]}", file=sys.stderr)
+
+
+query_log = QueryLog()
+
+
+class TracingCursor(CountingCursor):
+    """
+    SQLite cursor reporting each statement to the query log, timed from its execution until its rows are fetched
+    or the next statement runs on the cursor.
+    """
+    _pending = None
+
+    def _finish(self):
+        if self._pending is not None:
+            stats, seconds, shape = self._pending
+            self._pending = None
+            query_log.record(stats, seconds, shape)
+
+    def _add_time(self, seconds):
+        if self._pending is not None:
+            stats, elapsed, shape = self._pending
+            self._pending = (stats, elapsed + seconds, shape)
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        stats = query_log.statement(self.connection, sql, parameters)
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        self._pending = (stats, time.perf_counter() - start, parameter_shape(parameters))
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        seq_of_parameters = list(seq_of_parameters)
+        stats = query_log.statement(self.connection, sql, seq_of_parameters[0] if seq_of_parameters else ())
+        start = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        shape = f"{len(seq_of_parameters)} x " + (parameter_shape(seq_of_parameters[0]) if seq_of_parameters
+                                                  else "()")
+        self._pending = (stats, time.perf_counter() - start, shape)
+        self._finish()
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._add_time(time.perf_counter() - start)
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._add_time(time.perf_counter() - start)
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._add_time(time.perf_counter() - start)
+        self._finish()
+        return rows
+
+    def close(self):
+        self._finish()
+        super().close()
+
+
+def cursor_factory():
+    """
+    :return: the cursor class the connections of get_db create their cursors with
+    """
+    return TracingCursor if query_log.enabled else counting_cursor_factory()
+
+
+if os.environ.get(SLOW_QUERY_ENV):
+    query_log.enable(float(os.environ[SLOW_QUERY_ENV]))
+    atexit.register(query_log.report)
@@ -0,0 +1,113 @@
+# Identity map keeping one live Habit object per tenant, habit name and database connection
+from collections import OrderedDict
+from storage import DEFAULT_USER
+
+
+class HabitRegistry:
+    def __init__(self, max_habits=1024, max_events=1_000_000):
+        """
+        HabitRegistry class constructor designed to hold the live Habit objects of one database connection.
+        The least recently used habits are evicted once either limit is exceeded, so big databases do not
+        end up fully parsed in memory.
+        :param max_habits: the maximum number of habits kept in the registry
+        :param max_events: the maximum number of check-off dates kept in the registry across all habits
+        """
+        self.max_habits = max_habits
+        self.max_events = max_events
+        self._habits = OrderedDict()
+        self._event_counts = {}
+        self._total_events = 0
+
+    def __len__(self):
+        return len(self._habits)
+
+    def __contains__(self, key):
+        # Accepting a bare habit name for the default tenant, or a (user_id, name) tuple
+        return (key if isinstance(key, tuple) else (DEFAULT_USER, key)) in self._habits
+
+    def get(self, name, user_id=DEFAULT_USER):
+        """
+        Returns the live Habit object registered under the given tenant and name.
+        :param name: the name of the habit
+        :param user_id: the tenant the habit belongs to
+        :return: Habit object or None if it is not registered
+        """
+        habit = self._habits.get((user_id, name))
+        if habit is not None:
+            # Marking the habit as the most recently used one
+            self._habits.move_to_end((user_id, name))
+        return habit
+
+    def put(self, habit):
+        """
+        Registers a Habit object under its tenant and name, replacing any object registered before.
+        :param habit: the Habit object to register
+        :return: the registered Habit object
+        """
+        key = (habit.user_id, habit.name)
+        self.evict(habit.name, habit.user_id)
+        self._habits[key] = habit
+        self._event_counts[key] = len(habit.marked_complete)
+        self._total_events += self._event_counts[key]
+        # Evicting the least recently used habits while over budget, but always keeping the newest one
+        while len(self._habits) > 1 and (
+                len(self._habits) > self.max_habits or self._total_events > self.max_events):
+            oldest_user_id, oldest_name = next(iter(self._habits))
+            self.evict(oldest_name, oldest_user_id)
+        return habit
+
+    def evict(self, name, user_id=DEFAULT_USER):
+        """
+        Removes the habit with the given tenant and name from the registry, if it is registered.
+        :param name: the name of the habit
+        :param user_id: the tenant the habit belongs to
+        """
+        if self._habits.pop((user_id, name), None) is not None:
+            self._total_events -= self._event_counts.pop((user_id, name))
+
+    def clear(self):
+        """
+        Removes all habits from the registry.
+        """
+        self._habits.clear()
+        self._event_counts.clear()
+        self._total_events = 0
+
+
+def get_registry(db):
+    """
+    Retrieves the habit registry belonging to a database connection, creating it on first use.
+    :param db: the database connection object
+    :return: HabitRegistry object or None if the connection cannot carry one
+    """
+    registry = getattr(db, 'habit_registry', None)
+    if registry is None:
+        try:
+            registry = HabitRegistry()
+            db.habit_registry = registry
+        except AttributeError:
+            # Plain sqlite3.Connection objects do not accept extra attributes
+            return None
+    return registry
+
+
+def evict_habit(db, name, user_id=DEFAULT_USER):
+    """
+    Removes a habit from the registry of a database connection after it was changed in the database.
+    :param db: the database connection object
+    :param name: the name of the habit
+    :param user_id: the tenant the habit belongs to
+    """
+    registry = getattr(db, 'habit_registry', None)
+    if registry is not None:
+        registry.evict(name, user_id)
+
+
+def clear_registry(db):
+    """
+    Removes all habits from the registry of a database connection.
+    :param db: the database connection object
+    """
+    registry = getattr(db, 'habit_registry', None)
+    if registry is not None:
+        registry.clear()
@@ -0,0 +1,182 @@
+# Local HTTP/JSON service exposing the habit tracker, started with 'python main.py serve'
+import json
+import threading
+from datetime import date
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+import dataframe
+from dataschema import get_habit_data, get_change_counter
+from habit import Habit
+from registry import clear_registry
+from storage import DEFAULT_USER
+
+# The request header naming the tenant a request is made for; requests without it use the default tenant
+USER_HEADER = 'X-User-Id'
+
+# The aggregate reports of dataframe.py, by the last part of their URL
+REPORTS = {
+    'all-habits': dataframe.display_all_habits_tracked,
+    'same-periodicity': dataframe.display_all_same_periodicity_habits_tracked,
+    'longest-current-streak': dataframe.calculate_longestrun_current_streak,
+    'longest-historical-streak': dataframe.calculate_longest_historical_streak,
+    'average-streak': dataframe.calculate_lowest_and_largest_average_streak,
+    'resistance-ratio': dataframe.calculate_lowest_and_highest_resistance_ratio,
+}
+
+
+class HabitService:
+    def __init__(self, db, max_cached_responses=256):
+        """
+        HabitService class constructor designed to answer the requests of the HTTP service.
+        Read responses are cached in memory together with an ETag derived from the change counter of the database
+        and today's date, so polling clients get cached bodies until something changes.
+        :param db: the database connection object
+        :param max_cached_responses: the maximum number of cached read responses
+        """
+        self.db = db
+        self.max_cached_responses = max_cached_responses
+        self._cache = {}
+        self._cache_etag = None
+        # Requests are handled on several threads, but the database connection is used by one at a time
+        self._lock = threading.Lock()
+
+    def current_etag(self):
+        """
+        :return: the ETag all read responses share until the database changes or the day ends
+        """
+        return f'"{get_change_counter(self.db)}-{date.today().isoformat()}"'
+
+    def get(self, path, query, user_id=DEFAULT_USER):
+        """
+        Answers a read request, from the cache if possible.
+        :param path: the path of the request URL
+        :param query: the parsed query string of the request URL
+        :param user_id: the tenant the request is made for
+        :return: tuple of (HTTP status, JSON-serializable body or cached bytes, ETag)
+        """
+        with self._lock:
+            return self._get(path, query, user_id)
+
+    def _get(self, path, query, user_id):
+        etag = self.current_etag()
+        if etag != self._cache_etag:
+            # Everything cached so far belongs to an older version of the database, and so may the Habit objects
+            # in the registry, as other processes write to the database without going through it
+            self._cache.clear()
+            clear_registry(self.db)
+            self._cache_etag = etag
+        cache_key = (user_id, path, tuple(sorted((key, tuple(values)) for key, values in query.items())))
+        if cache_key in self._cache:
+            return 200, self._cache[cache_key], etag
+        status, body = self._compute(path, query, user_id)
+        if status == 200:
+            body = json.dumps(body, default=str).encode('utf-8')
+            if len(self._cache) < self.max_cached_responses:
+                self._cache[cache_key] = body
+        return status, body, etag
+
+    def _compute(self, path, query, user_id):
+        parts = [unquote(part) for part in path.strip('/').split('/')]
+        if parts == ['habits']:
+            habits = get_habit_data(self.db, None, user_id) or []
+            return 200, [{key: habit[key] for key in ('name', 'descr', 'gen_date', 'periodicity')}
+                         for habit in habits]
+        if len(parts) in (2, 3) and parts[0] == 'habits':
+            habit = Habit.get_habit_by_name(self.db, parts[1], user_id)
+            if habit is None:
+                return 404, {'error': f"Habit '{parts[1]}' not found"}
+            if len(parts) == 2:
+                return 200, {'name': habit.name, 'descr': habit.descr, 'gen_date': habit.gen_date,
+                             'periodicity': habit.periodicity, 'check_off_dates': habit.marked_complete}
+            if parts[2] == 'stats':
+                return 200, habit.calc_individual_stats_row()
+        if len(parts) == 2 and parts[0] == 'reports' and parts[1] in REPORTS:
+            if parts[1] == 'same-periodicity':
+                report = REPORTS[parts[1]](self.db, query.get('periodicity', ['Daily'])[0], user_id=user_id)
+            else:
+                report = REPORTS[parts[1]](self.db, user_id=user_id)
+            # Converting to Python objects first, so numpy integers serialize as JSON numbers
+            records = [] if report is None else report.astype(object).to_dict(orient='records')
+            return 200, records
+        return 404, {'error': f"Unknown path '{path}'"}
+
+    def mark_complete(self, name, mark_date=None, user_id=DEFAULT_USER):
+        """
+        Marks a habit as complete, see Habit.mark_complete and Habit.add_event.
+        :param name: the name of the habit
+        :param mark_date: the date on which to mark the habit as complete (default is today)
+        :param user_id: the tenant the habit belongs to
+        :return: tuple of (HTTP status, JSON-serializable body)
+        """
+        with self._lock:
+            habit = Habit.get_habit_by_name(self.db, name, user_id)
+            if habit is None:
+                return 404, {'error': f"Habit '{name}' not found"}
+            mark_date = habit.mark_complete(self.db, mark_date)
+            habit.add_event(self.db, mark_date)
+        return 200, {'name': name, 'marked': mark_date.isoformat()}
+
+
+class HabitRequestHandler(BaseHTTPRequestHandler):
+    # Keeping connections open between requests, for clients polling the service
+    protocol_version = 'HTTP/1.1'
+    # Sending small responses right away instead of waiting for the client to acknowledge the headers
+    disable_nagle_algorithm = True
+    service = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        status, body, etag = self.service.get(url.path, parse_qs(url.query), self._user_id())
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            self._respond(304, b'', etag)
+        else:
+            self._respond(status, body if isinstance(body, bytes) else json.dumps(body, default=str).encode('utf-8'),
+                          etag)
+
+    def do_POST(self):
+        parts = [unquote(part) for part in urlsplit(self.path).path.strip('/').split('/')]
+        if len(parts) != 3 or parts[0] != 'habits' or parts[2] != 'complete':
+            self._respond(404, json.dumps({'error': f"Unknown path '{self.path}'"}).encode('utf-8'))
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+            mark_date = date.fromisoformat(payload['date']) if payload.get('date') else None
+        except (ValueError, TypeError, AttributeError) as e:
+            self._respond(400, json.dumps({'error': f"Invalid request body: {e}"}).encode('utf-8'))
+            return
+        status, body = self.service.mark_complete(parts[1], mark_date, self._user_id())
+        self._respond(status, json.dumps(body).encode('utf-8'))
+
+    def _user_id(self):
+        return self.headers.get(USER_HEADER) or DEFAULT_USER
+
+    def _respond(self, status, body, etag=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+            # The same URL answers differently for each tenant
+            self.send_header('Vary', USER_HEADER)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keeping the console quiet while dashboards poll the service
+        pass
+
+
+def make_server(db, host='127.0.0.1', port=8000):
+    """
+    Creates the HTTP server of the service without starting it.
+    Every client connection is handled on its own thread, so an SQLite connection passed in has to be
+    opened with check_same_thread=False.
+    :param db: the database connection object
+    :param host: the address to listen on
+    :param port: the port to listen on, 0 to pick a free one
+    :return: HTTPServer object
+    """
+    handler = type('BoundHabitRequestHandler', (HabitRequestHandler,), {'service': HabitService(db)})
+    return ThreadingHTTPServer((host, port), handler)
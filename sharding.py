@@ -0,0 +1,174 @@
+# Habit store spreading tenants or habits over several SQLite database files
+import heapq
+import os
+import sqlite3
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from itertools import islice
+from storage import HabitStore, SQLiteStore, search_words
+
+
+def shard_paths(name, shard_count):
+    """
+    Derives the names of the database files of a sharded database, e.g. 'main-shard0.db', 'main-shard1.db', ...
+    :param name: the name of the database file as given to get_db
+    :param shard_count: the number of shards
+    :return: list of database file names, one per shard
+    """
+    root, extension = os.path.splitext(name)
+    return [f"{root}-shard{index}{extension}" for index in range(shard_count)]
+
+
+class ShardedStore(HabitStore):
+    def __init__(self, paths, shard_by='user_id', connection_factory=sqlite3.Connection):
+        """
+        ShardedStore class constructor designed to keep habits in several SQLite database files,
+        so writes to different shards do not wait for each other's locks and journals.
+        Each habit lives in exactly one shard, picked by a stable hash of its tenant or of its name.
+        The shard map depends on the number of shards, so a sharded database always has to be opened
+        with the same number of shards; create_schema refuses to open it otherwise.
+        :param paths: the names of the database files, one per shard, see shard_paths
+        :param shard_by: 'user_id' to keep each tenant in one shard, 'name' to spread every tenant's habits
+        :param connection_factory: the sqlite3.Connection subclass the shard connections are created with
+        """
+        if shard_by not in ('user_id', 'name'):
+            raise ValueError(f"Invalid shard key: {shard_by}")
+        self.paths = list(paths)
+        self.shard_by = shard_by
+        # Shards may be written from other threads, one at a time each
+        self.shards = [SQLiteStore(sqlite3.connect(path, factory=connection_factory, check_same_thread=False))
+                       for path in self.paths]
+
+    def shard_index(self, user_id, name):
+        """
+        :return: the index of the shard the habit with the given tenant and name lives in
+        """
+        key = user_id if self.shard_by == 'user_id' else f"{user_id}/{name}"
+        # crc32 instead of hash(), which differs between processes
+        return zlib.crc32(key.encode('utf-8')) % len(self.shards)
+
+    def tenant_shard_indexes(self, user_id):
+        """
+        :return: list of the indexes of the shards that may hold habits of the given tenant
+        """
+        if self.shard_by == 'user_id':
+            return [self.shard_index(user_id, None)]
+        return list(range(len(self.shards)))
+
+    def shards_of(self, user_id):
+        """
+        :return: list of the shards that may hold habits of the given tenant
+        """
+        return [self.shards[index] for index in self.tenant_shard_indexes(user_id)]
+
+    def _shard(self, user_id, name):
+        return self.shards[self.shard_index(user_id, name)]
+
+    def create_schema(self):
+        for index, shard in enumerate(self.shards):
+            shard.create_schema()
+            # Remembering the shard map, so opening the files with another number of shards fails loudly
+            cur = shard.conn.cursor()
+            cur.execute("INSERT OR IGNORE INTO meta VALUES ('shard_count', ?);", (len(self.shards),))
+            cur.execute("SELECT value FROM meta WHERE key='shard_count';")
+            stored_shard_count = cur.fetchone()[0]
+            shard.conn.commit()
+            cur.close()
+            if stored_shard_count != len(self.shards):
+                raise ValueError(f"{self.paths[index]} belongs to a database with {stored_shard_count} shards, "
+                                 f"not {len(self.shards)}")
+
+    def commit(self):
+        for shard in self.shards:
+            shard.commit()
+
+    def in_batch(self):
+        return any(shard.in_batch() for shard in self.shards)
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    @contextmanager
+    def batch(self):
+        # Each shard commits its part of the batch on its own, so a batch is not atomic across shards
+        with ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.batch())
+            yield self
+
+    def add_habit(self, user_id, name, descr, gen_date, periodicity):
+        return self._shard(user_id, name).add_habit(user_id, name, descr, gen_date, periodicity)
+
+    def append_check_off(self, user_id, name, event_date):
+        return self._shard(user_id, name).append_check_off(user_id, name, event_date)
+
+    def change_counter(self):
+        # Every shard counter only grows, so their sum does too
+        return sum(shard.change_counter() for shard in self.shards)
+
+    def changes_since(self, seq, limit):
+        # Every shard numbers its own changes, so a change is identified by its shard and its sequence number there,
+        # and the position in the feed is the last sequence number seen of every shard
+        positions = list(seq) if seq else [0] * len(self.shards)
+        if len(positions) != len(self.shards):
+            raise ValueError(f"The position {seq!r} does not hold one sequence number for each of the "
+                             f"{len(self.shards)} shards")
+        pages = [[(change_seq, index, *change) for change_seq, *change in shard.changes_since(positions[index], limit)]
+                 for index, shard in enumerate(self.shards)]
+        # Interleaving the shards by sequence number, so no shard waits for the others to be read up to their end
+        changes = []
+        for change_seq, index, user_id, name, operation, value in islice(heapq.merge(*pages), limit):
+            positions[index] = change_seq
+            changes.append((tuple(positions), user_id, name, operation, value))
+        return changes
+
+    def get_habits(self, user_id, name=None):
+        if name is not None:
+            return self._shard(user_id, name).get_habits(user_id, name)
+        return [record for shard in self.shards_of(user_id) for record in shard.get_habits(user_id)]
+
+    def get_habit_names(self, user_id):
+        # Habit names come in insertion order within each shard, and shard by shard
+        return [name for shard in self.shards_of(user_id) for name in shard.get_habit_names(user_id)]
+
+    def search_habits(self, user_id, query, limit):
+        matches = [match for shard in self.shards_of(user_id) for match in shard.search_habits(user_id, query, limit)]
+        if not search_words(query):
+            matches.sort()
+        return matches[:limit]
+
+    def period_counts(self, user_id, first_day, last_day):
+        shards = self.shards_of(user_id)
+        if len(shards) == 1:
+            return shards[0].period_counts(user_id, first_day, last_day)
+        # SQLite releases the GIL while it runs a query, so the shards are queried on threads at once
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            partial_counts = executor.map(lambda shard: shard.period_counts(user_id, first_day, last_day), shards)
+            return [counts for partial_count in partial_counts for counts in partial_count]
+
+    def set_gen_date(self, user_id, name, gen_date):
+        self._shard(user_id, name).set_gen_date(user_id, name, gen_date)
+
+    def delete_habit(self, user_id, name):
+        self._shard(user_id, name).delete_habit(user_id, name)
+
+    def iter_check_off_batches(self, batch_size):
+        for shard in self.shards:
+            yield from shard.iter_check_off_batches(batch_size)
+
+    def replace_check_off_dates(self, updates):
+        updates_by_shard = {}
+        for user_id, name, check_off_dates in updates:
+            updates_by_shard.setdefault(self.shard_index(user_id, name), []).append((user_id, name, check_off_dates))
+        for index, shard_updates in updates_by_shard.items():
+            self.shards[index].replace_check_off_dates(shard_updates)
+
+    def clear_check_off_dates(self):
+        for shard in self.shards:
+            shard.clear_check_off_dates()
+
+    def clear(self):
+        for shard in self.shards:
+            shard.clear()
@@ -0,0 +1,154 @@
+# Read-only binary snapshot of the habit histories of a tenant, memory-mapped for the reports
+import mmap
+import os
+import struct
+from datetime import date
+import numpy as np
+from dataschema import get_habit_data, get_change_counter
+from periods import period_ordinal
+from storage import DEFAULT_USER
+
+# The header holds a magic number, the format version, the change counter of the database when the snapshot was
+# written, the number of habits and the length of the tenant name that follows it
+MAGIC = b'KTHS'
+VERSION = 1
+HEADER = struct.Struct('<4sHHqII')
+# Every habit in the directory holds the length of its name, the periodicity, the date ordinal of gen_date,
+# the period ordinal of gen_date, the offset of its period ordinals in the period array and their count,
+# followed by the name itself
+DIRECTORY_ENTRY = struct.Struct('<HBiiII')
+PERIODICITIES = ["Daily", "Weekly", "Monthly"]
+PERIOD_ARRAY_TYPE = np.dtype('<i4')
+
+
+def write_snapshot(db, path, user_id=DEFAULT_USER):
+    """
+    Writes the habits of a tenant to a snapshot file: a directory of the habits followed by one contiguous array
+    of int32 period ordinals (see periods.period_ordinal), sorted and deduplicated per habit.
+    The file is replaced at once, so readers never see a half-written snapshot.
+    :param db: An SQLite database connection object or a habit store
+    :param path: the name of the snapshot file
+    :param user_id: the tenant whose habits are written
+    :return: the number of habits written
+    """
+    # Reading the change counter first, so changes made while the snapshot is written make it stale
+    change_counter = get_change_counter(db)
+    habit_data = get_habit_data(db, None, user_id) or []
+    user_id_bytes = user_id.encode()
+    directory = []
+    period_arrays = []
+    offset = 0
+    for habit_info in habit_data:
+        periodicity = habit_info['periodicity']
+        periods = np.array(sorted({period_ordinal(date.fromisoformat(date_str), periodicity)
+                                   for date_str in habit_info['check_off_dates']}), dtype=PERIOD_ARRAY_TYPE)
+        name_bytes = habit_info['name'].encode()
+        gen_date = habit_info['gen_date']
+        directory.append(DIRECTORY_ENTRY.pack(len(name_bytes), PERIODICITIES.index(periodicity), gen_date.toordinal(),
+                                              period_ordinal(gen_date, periodicity), offset, len(periods))
+                         + name_bytes)
+        period_arrays.append(periods)
+        offset += len(periods)
+    head = HEADER.pack(MAGIC, VERSION, 0, change_counter, len(directory), len(user_id_bytes)) + user_id_bytes
+    head += b''.join(directory)
+    # Aligning the period array, so it can be viewed as int32 values right where it is
+    head += b'\0' * (-len(head) % PERIOD_ARRAY_TYPE.itemsize)
+    with open(path + ".tmp", 'wb') as snapshot_file:
+        snapshot_file.write(head)
+        for periods in period_arrays:
+            snapshot_file.write(periods.tobytes())
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(path + ".tmp", path)
+    return len(directory)
+
+
+class Snapshot:
+    def __init__(self, path):
+        """
+        Snapshot class constructor designed to read a snapshot file without parsing the habit histories.
+        The file is memory-mapped, and the period ordinals are NumPy views into the mapping rather than copies,
+        so only the pages that are actually used get read from disk.
+        :param path: the name of the snapshot file
+        """
+        with open(path, 'rb') as snapshot_file:
+            self._mmap = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.change_counter, habit_count, user_id_length = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a habit snapshot of version {VERSION}")
+        offset = HEADER.size
+        self.user_id = self._mmap[offset:offset + user_id_length].decode()
+        offset += user_id_length
+        self.names = []
+        periodicity_codes = []
+        gen_date_ordinals = []
+        gen_periods = []
+        starts = []
+        counts = []
+        for _ in range(habit_count):
+            (name_length, periodicity_code, gen_date_ordinal, gen_period, start,
+             count) = DIRECTORY_ENTRY.unpack_from(self._mmap, offset)
+            offset += DIRECTORY_ENTRY.size
+            self.names.append(self._mmap[offset:offset + name_length].decode())
+            offset += name_length
+            periodicity_codes.append(periodicity_code)
+            gen_date_ordinals.append(gen_date_ordinal)
+            gen_periods.append(gen_period)
+            starts.append(start)
+            counts.append(count)
+        self.periodicity_codes = np.array(periodicity_codes, dtype=np.int8)
+        self.gen_date_ordinals = np.array(gen_date_ordinals, dtype=np.int64)
+        self.gen_periods = np.array(gen_periods, dtype=np.int64)
+        self.starts = np.array(starts, dtype=np.int64)
+        self.counts = np.array(counts, dtype=np.int64)
+        offset += -offset % PERIOD_ARRAY_TYPE.itemsize
+        # The period ordinals of all habits, one after the other, without copying them out of the mapping
+        self.periods = np.frombuffer(self._mmap, dtype=PERIOD_ARRAY_TYPE, count=int(self.counts.sum()),
+                                     offset=offset)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def periodicity(self, index):
+        return PERIODICITIES[self.periodicity_codes[index]]
+
+    def habit_periods(self, index):
+        """
+        :param index: the position of the habit in the snapshot
+        :return: NumPy view of the sorted period ordinals of the habit
+        """
+        return self.periods[self.starts[index]:self.starts[index] + self.counts[index]]
+
+    def close(self):
+        # The mapping can only be closed once no view into it is left
+        self.periods = None
+        self._mmap.close()
+
+
+def open_snapshot(db, path, user_id=DEFAULT_USER):
+    """
+    Opens a snapshot file if it still shows the current state of the database.
+    :param db: An SQLite database connection object or a habit store
+    :param path: the name of the snapshot file
+    :param user_id: the tenant the snapshot has to be written for
+    :return: Snapshot object, or None if there is no snapshot, or it belongs to another tenant, or the database
+             changed since it was written
+    """
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        snapshot = Snapshot(path)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Error reading snapshot {path}: {e}")
+        return None
+    if snapshot.user_id != user_id or snapshot.change_counter != get_change_counter(db):
+        snapshot.close()
+        return None
+    return snapshot
@@ -0,0 +1,841 @@
+# Storage backends behind the functions of dataschema
+import bisect
+import json
+import os
+import re
+import sqlite3
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import date, timedelta
+from instrumentation import measure
+from periods import count_periods, count_completed_periods
+
+# The tenant habits belong to when no user_id is given, e.g. in the single-user command-line interface
+DEFAULT_USER = 'default'
+
+
+class HabitStore(ABC):
+    """
+    Repository interface the dataschema functions call into.
+    Every habit belongs to a tenant (user_id), and habit names are only unique per tenant.
+    Habit records are passed around as tuples of (name, descr, gen_date, periodicity, check_off_dates),
+    with dates as ISO 8601 strings and check_off_dates as a list of them.
+    """
+
+    def create_schema(self):
+        """
+        Creates whatever the backend needs to store habits, if it does not already exist.
+        """
+
+    def commit(self):
+        """
+        Makes the changes done so far permanent, for backends that work with transactions.
+        """
+
+    def close(self):
+        """
+        Releases the resources held by the backend.
+        """
+
+    @contextmanager
+    def batch(self):
+        """
+        Groups the changes made inside the with-block into one transaction, for backends that work with transactions.
+        """
+        yield self
+
+    def in_batch(self):
+        """
+        :return: True inside a batch that is rolled back if the with-block raises, see batch
+        """
+        return False
+
+    @abstractmethod
+    def add_habit(self, user_id, name, descr, gen_date, periodicity):
+        """
+        Adds a habit with no check-off dates in case it doesn't already exist.
+        :return: True if the habit was added, False if the tenant already has a habit with the same name
+        """
+
+    @abstractmethod
+    def append_check_off(self, user_id, name, event_date):
+        """
+        Adds a check-off date to a habit in case it is not already present.
+        :return: True if the date was added
+        """
+
+    @abstractmethod
+    def change_counter(self):
+        """
+        :return: a number that grows with every change to the stored habits, also across processes
+        """
+
+    @abstractmethod
+    def changes_since(self, seq, limit):
+        """
+        Retrieves the changes to the habits of all tenants made after the change with the given sequence number.
+        Every change gets the next number of one sequence that only grows, and is one of these operations:
+        - add_habit: the value is a JSON object with the descr, gen_date and periodicity of the new habit
+        - check_off: the value is the check-off date that was added
+        - remove_check_off: the value is the check-off date that was removed, e.g. by compaction
+        - set_gen_date: the value is the new gen_date
+        - delete_habit: the value is None, and the check-off dates of the habit are gone with it
+        A store keeping habits in several databases has one sequence per database, and its position in the feed
+        is a tuple of the last sequence number seen of each of them, see ShardedStore.
+        :param seq: the sequence number of the last change already seen, 0 for all changes
+        :param limit: the maximum number of changes returned
+        :return: list of (seq, user_id, name, operation, value) tuples, the oldest change first
+        """
+
+    @abstractmethod
+    def get_habits(self, user_id, name=None):
+        """
+        Retrieves the records of all habits of a tenant, or of the habit with the given name.
+        :return: list of habit record tuples
+        """
+
+    @abstractmethod
+    def get_habit_names(self, user_id):
+        """
+        :return: list of the habit names of a tenant in insertion order
+        """
+
+    @abstractmethod
+    def search_habits(self, user_id, query, limit):
+        """
+        Finds the habits of a tenant whose name or description contains words starting with every word of the query.
+        :return: list of (name, descr) tuples, best matches first, or the first habits by name for an empty query
+        """
+
+    @abstractmethod
+    def period_counts(self, user_id, first_day, last_day):
+        """
+        Counts the periods of every habit of a tenant within a window of days, and the ones it was checked off in.
+        Days are counted for daily habits, ISO weeks for weekly ones and calendar months for monthly ones,
+        including partly covered periods at either end, see periods.count_periods.
+        :param first_day: the first day of the window as an ISO 8601 string, or None to start at each gen_date;
+                          the window never starts before the gen_date of a habit
+        :param last_day: the last day of the window as an ISO 8601 string
+        :return: list of (name, periodicity, periods, completed periods) tuples in insertion order
+        """
+
+    @abstractmethod
+    def set_gen_date(self, user_id, name, gen_date):
+        """
+        Updates the creation date of a habit.
+        """
+
+    @abstractmethod
+    def delete_habit(self, user_id, name):
+        """
+        Deletes a habit together with its check-off dates.
+        """
+
+    @abstractmethod
+    def iter_check_off_batches(self, batch_size):
+        """
+        Walks through the habits of all tenants in batches.
+        :return: generator of lists of (user_id, name, periodicity, check_off_dates) tuples
+        """
+
+    @abstractmethod
+    def replace_check_off_dates(self, updates):
+        """
+        Overwrites the check-off dates of several habits in one go.
+        :param updates: list of (user_id, name, check_off_dates) tuples
+        """
+
+    @abstractmethod
+    def clear_check_off_dates(self):
+        """
+        Removes the check-off dates of the habits of all tenants.
+        """
+
+    @abstractmethod
+    def clear(self):
+        """
+        Removes the habits of all tenants.
+        """
+
+
+class SQLiteStore(HabitStore):
+    def __init__(self, conn):
+        """
+        SQLiteStore class constructor designed to keep habits in the 'habit' table of an SQLite database.
+        :param conn: An SQLite database connection object
+        """
+        self.conn = conn
+        self._batch_depth = 0
+
+    def create_schema(self):
+        cur = self.conn.cursor()
+        cur.execute("PRAGMA table_info(habit);")
+        columns = [row[1] for row in cur.fetchall()]
+        if columns and 'user_id' not in columns:
+            # Moving the habits of a database from before tenants existed to the default tenant
+            cur.execute("ALTER TABLE habit RENAME TO habit_single_user;")
+        # Storing 'gen_date' as TEXT in ISO 8601 format
+        # Storing 'check_off_dates' as a serialized list
+        # The composite primary key also serves as the per-tenant index every query is scoped by
+        cur.execute("""CREATE TABLE IF NOT EXISTS habit(
+            user_id TEXT NOT NULL DEFAULT 'default',
+            name TEXT NOT NULL,
+            descr TEXT,
+            gen_date TEXT,
+            periodicity TEXT,
+            check_off_dates TEXT DEFAULT '[]',
+            PRIMARY KEY (user_id, name));""")
+        if columns and 'user_id' not in columns:
+            cur.execute("""INSERT INTO habit(user_id, name, descr, gen_date, periodicity, check_off_dates)
+                SELECT ?, name, descr, gen_date, periodicity, check_off_dates FROM habit_single_user ORDER BY rowid;""",
+                        (DEFAULT_USER,))
+            cur.execute("DROP TABLE habit_single_user;")
+        # Counting every change to the habit table, so readers can tell cheaply whether anything changed
+        cur.execute("CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value INTEGER);")
+        cur.execute("INSERT OR IGNORE INTO meta VALUES ('change_counter', 0);")
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cur.execute(f"""CREATE TRIGGER IF NOT EXISTS habit_{event.lower()}_counter AFTER {event} ON habit
+                BEGIN UPDATE meta SET value=value+1 WHERE key='change_counter'; END;""")
+        # Recording every change to the habit table with a sequence number for the change feed, see changes_since;
+        # AUTOINCREMENT keeps the numbers from being reused
+        cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='habit_changes';")
+        backfill = cur.fetchone()[0] == 0
+        cur.execute("""CREATE TABLE IF NOT EXISTS habit_changes(
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            operation TEXT NOT NULL,
+            value TEXT);""")
+        if backfill:
+            # Starting the feed of an existing database with the habits and check-offs it already holds,
+            # habit by habit in insertion order
+            cur.execute("""INSERT INTO habit_changes(user_id, name, operation, value)
+                SELECT user_id, name, operation, value FROM (
+                    SELECT rowid AS habit_rowid, 0 AS kind, user_id, name, 'add_habit' AS operation,
+                           json_object('descr', descr, 'gen_date', gen_date, 'periodicity', periodicity) AS value
+                    FROM habit
+                    UNION
+                    SELECT habit.rowid, 1, habit.user_id, habit.name, 'check_off', check_off.value
+                    FROM habit, json_each(COALESCE(habit.check_off_dates, '[]')) AS check_off)
+                ORDER BY habit_rowid, kind, value;""")
+        cur.execute("""CREATE TRIGGER IF NOT EXISTS habit_insert_changes AFTER INSERT ON habit
+            BEGIN INSERT INTO habit_changes(user_id, name, operation, value)
+            VALUES (new.user_id, new.name, 'add_habit',
+                    json_object('descr', new.descr, 'gen_date', new.gen_date, 'periodicity', new.periodicity));
+            INSERT INTO habit_changes(user_id, name, operation, value)
+            SELECT DISTINCT new.user_id, new.name, 'check_off', value
+            FROM json_each(COALESCE(new.check_off_dates, '[]')) ORDER BY value; END;""")
+        # The check-off dates are recorded by the methods changing them, which know what they add and remove
+        cur.execute("DROP TRIGGER IF EXISTS habit_check_off_appended;")
+        cur.execute("DROP TRIGGER IF EXISTS habit_check_off_changes;")
+        cur.execute("""CREATE TRIGGER IF NOT EXISTS habit_gen_date_changes AFTER UPDATE OF gen_date ON habit
+            WHEN old.gen_date IS NOT new.gen_date
+            BEGIN INSERT INTO habit_changes(user_id, name, operation, value)
+            VALUES (new.user_id, new.name, 'set_gen_date', new.gen_date); END;""")
+        cur.execute("""CREATE TRIGGER IF NOT EXISTS habit_delete_changes AFTER DELETE ON habit
+            BEGIN INSERT INTO habit_changes(user_id, name, operation, value)
+            VALUES (old.user_id, old.name, 'delete_habit', NULL); END;""")
+        # Mapping days to the start of their ISO week and month, filled on demand by ensure_calendar
+        cur.execute("""CREATE TABLE IF NOT EXISTS calendar(
+            day TEXT PRIMARY KEY,
+            week_start TEXT NOT NULL,
+            month_start TEXT NOT NULL) WITHOUT ROWID;""")
+        # Indexing habit names and descriptions for full-text and prefix search, kept in step by triggers
+        cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='habit_fts';")
+        backfill = cur.fetchone()[0] == 0
+        cur.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS habit_fts USING fts5(
+            user_id UNINDEXED, name, descr, prefix='2 3');""")
+        if backfill:
+            cur.execute("""INSERT INTO habit_fts(rowid, user_id, name, descr)
+                SELECT rowid, user_id, name, descr FROM habit;""")
+        cur.execute("""CREATE TRIGGER IF NOT EXISTS habit_fts_insert AFTER INSERT ON habit
+            BEGIN INSERT INTO habit_fts(rowid, user_id, name, descr)
+            VALUES (new.rowid, new.user_id, new.name, new.descr); END;""")
+        cur.execute("""CREATE TRIGGER IF NOT EXISTS habit_fts_delete AFTER DELETE ON habit
+            BEGIN DELETE FROM habit_fts WHERE rowid=old.rowid; END;""")
+        cur.execute("""CREATE TRIGGER IF NOT EXISTS habit_fts_update AFTER UPDATE OF user_id, name, descr ON habit
+            BEGIN DELETE FROM habit_fts WHERE rowid=old.rowid;
+            INSERT INTO habit_fts(rowid, user_id, name, descr) VALUES (new.rowid, new.user_id, new.name, new.descr);
+            END;""")
+        self.conn.commit()
+        cur.close()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    @contextmanager
+    def batch(self):
+        self._batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.conn.rollback()
+            raise
+        self._batch_depth -= 1
+        if self._batch_depth == 0:
+            self.conn.commit()
+
+    def in_batch(self):
+        return self._batch_depth > 0
+
+    def _commit(self):
+        # Inside a batch, the changes are committed together when the batch ends
+        if self._batch_depth == 0:
+            self.conn.commit()
+
+    def add_habit(self, user_id, name, descr, gen_date, periodicity):
+        cur = self.conn.cursor()
+        try:
+            # First check if the tenant already has a habit with the given name
+            cur.execute("SELECT COUNT(*) FROM habit WHERE user_id=? AND name=?;", (user_id, name))
+            if cur.fetchone()[0] != 0:
+                return False
+            cur.execute("INSERT INTO habit VALUES (?, ?, ?, ?, ?, ?);",
+                        (user_id, name, descr, gen_date, periodicity, json.dumps([])))
+            self._commit()
+            return True
+        finally:
+            cur.close()
+
+    @staticmethod
+    def _record_changes(cur, changes):
+        """
+        Adds changes to the change feed, in the transaction of the write they belong to.
+        :param cur: the cursor of the write
+        :param changes: list of (user_id, name, operation, value) tuples
+        """
+        cur.executemany("INSERT INTO habit_changes(user_id, name, operation, value) VALUES (?, ?, ?, ?);", changes)
+
+    def _append_check_off(self, cur, user_id, name, event_date):
+        # Appending the event_date inside SQLite in a single statement, only if it's not already present,
+        # so concurrent writers cannot overwrite each other's check-offs
+        cur.execute("""UPDATE habit SET check_off_dates=json_insert(COALESCE(check_off_dates, '[]'), '$[#]', ?)
+            WHERE user_id=? AND name=?
+            AND NOT EXISTS (SELECT 1 FROM json_each(habit.check_off_dates) WHERE value=?);""",
+                    (event_date, user_id, name, event_date))
+        if cur.rowcount <= 0:
+            return False
+        self._record_changes(cur, [(user_id, name, 'check_off', event_date)])
+        return True
+
+    def append_check_off(self, user_id, name, event_date):
+        cur = self.conn.cursor()
+        try:
+            appended = self._append_check_off(cur, user_id, name, event_date)
+            self._commit()
+            return appended
+        finally:
+            cur.close()
+
+    def change_counter(self):
+        cur = self.conn.cursor()
+        try:
+            cur.execute("SELECT value FROM meta WHERE key='change_counter';")
+            return cur.fetchone()[0]
+        finally:
+            cur.close()
+
+    def changes_since(self, seq, limit):
+        cur = self.conn.cursor()
+        try:
+            # Reading a range of the primary key, so a page costs the same however long the feed has grown
+            cur.execute("SELECT seq, user_id, name, operation, value FROM habit_changes WHERE seq>? "
+                        "ORDER BY seq LIMIT ?;", (seq, limit))
+            return cur.fetchall()
+        finally:
+            cur.close()
+
+    def get_habits(self, user_id, name=None):
+        return [record for _, record in self.get_habits_with_ids(user_id, name)]
+
+    def get_habits_with_ids(self, user_id, name=None):
+        """
+        Retrieves the same records as get_habits, together with the rowid identifying each habit in the table.
+        :return: list of (rowid, habit record tuple) tuples in insertion order
+        """
+        cur = self.conn.cursor()
+        try:
+            if name is None:
+                cur.execute("SELECT rowid, name, descr, gen_date, periodicity, check_off_dates FROM habit "
+                            "WHERE user_id=? ORDER BY rowid;", (user_id,))
+            else:
+                cur.execute("SELECT rowid, name, descr, gen_date, periodicity, check_off_dates FROM habit "
+                            "WHERE user_id=? AND name=?;", (user_id, name))
+            rows = cur.fetchall()
+            with measure('storage.json_decode'):
+                return [(row[0], (*row[1:-1], json.loads(row[-1]) if row[-1] else [])) for row in rows]
+        finally:
+            cur.close()
+
+    def get_habit_id(self, user_id, name):
+        """
+        :return: the rowid identifying the habit in the table, or None if the tenant has no habit with the given name
+        """
+        cur = self.conn.cursor()
+        try:
+            cur.execute("SELECT rowid FROM habit WHERE user_id=? AND name=?;", (user_id, name))
+            row = cur.fetchone()
+            return row[0] if row else None
+        finally:
+            cur.close()
+
+    def append_check_offs(self, events):
+        """
+        Adds many check-off dates at once, each only if it is not already present, in one transaction.
+        Every habit row is read and written once, however many of the dates belong to it.
+        :param events: list of (user_id, name, event_date) tuples
+        :return: the number of check-off dates added
+        """
+        dates_by_habit = {}
+        for user_id, name, event_date in events:
+            dates_by_habit.setdefault((user_id, name), []).append(event_date)
+        cur = self.conn.cursor()
+        try:
+            updates, changes = [], []
+            for (user_id, name), event_dates in dates_by_habit.items():
+                cur.execute("SELECT check_off_dates FROM habit WHERE user_id=? AND name=?;", (user_id, name))
+                row = cur.fetchone()
+                if row is None:
+                    continue
+                check_off_dates = json.loads(row[0]) if row[0] else []
+                # Appending the new dates in the order they were checked off, as append_check_off would
+                present = set(check_off_dates)
+                added_dates = [event_date for event_date in dict.fromkeys(event_dates) if event_date not in present]
+                if added_dates:
+                    updates.append((json.dumps(check_off_dates + added_dates), user_id, name))
+                    changes.extend((user_id, name, 'check_off', event_date) for event_date in added_dates)
+            cur.executemany("UPDATE habit SET check_off_dates=? WHERE user_id=? AND name=?;", updates)
+            self._record_changes(cur, changes)
+            self._commit()
+            return len(changes)
+        finally:
+            cur.close()
+
+    def get_habit_names(self, user_id):
+        cur = self.conn.cursor()
+        try:
+            cur.execute("SELECT name FROM habit WHERE user_id=? ORDER BY rowid;", (user_id,))
+            return [row[0] for row in cur.fetchall()]
+        finally:
+            cur.close()
+
+    def search_habits(self, user_id, query, limit):
+        cur = self.conn.cursor()
+        try:
+            words = search_words(query)
+            if not words:
+                cur.execute("SELECT name, descr FROM habit WHERE user_id=? ORDER BY name LIMIT ?;", (user_id, limit))
+            else:
+                # Matching every word as a prefix, and ranking matches in the name above those in the description
+                match = ' '.join(f'"{word}"*' for word in words)
+                cur.execute("SELECT name, descr FROM habit_fts WHERE habit_fts MATCH ? AND user_id=? "
+                            "ORDER BY bm25(habit_fts, 0.0, 10.0, 1.0) LIMIT ?;", (match, user_id, limit))
+            return cur.fetchall()
+        finally:
+            cur.close()
+
+    def ensure_calendar(self, first_day, last_day):
+        """
+        Makes sure the calendar table has a row for every day from first_day to last_day.
+        The table always covers one contiguous range of days, which is only extended when needed.
+        :param first_day: the first day as an ISO 8601 string
+        :param last_day: the last day as an ISO 8601 string
+        """
+        cur = self.conn.cursor()
+        try:
+            cur.execute("SELECT MIN(day), MAX(day) FROM calendar;")
+            covered_first, covered_last = cur.fetchone()
+            if covered_first is not None and covered_first <= first_day and last_day <= covered_last:
+                return
+            # Generating the missing days with a recursive query, weeks starting on Monday as in ISO 8601
+            cur.execute("""WITH RECURSIVE days(day) AS (
+                    SELECT date(?) UNION ALL SELECT date(day, '+1 day') FROM days WHERE day < date(?))
+                INSERT OR IGNORE INTO calendar
+                SELECT day, date(day, '-' || ((CAST(strftime('%w', day) AS INTEGER) + 6) % 7) || ' days'),
+                    date(day, 'start of month') FROM days;""",
+                        (min(first_day, covered_first or first_day), max(last_day, covered_last or last_day)))
+            self._commit()
+        finally:
+            cur.close()
+
+    def period_counts(self, user_id, first_day, last_day):
+        cur = self.conn.cursor()
+        try:
+            cur.execute("SELECT MIN(gen_date) FROM habit WHERE user_id=?;", (user_id,))
+            earliest_gen_date = cur.fetchone()[0]
+            if earliest_gen_date is None:
+                return []
+            # Starting the calendar early enough for check-offs anchored to the period containing gen_date
+            calendar_first_day = str(date.fromisoformat(min(first_day or earliest_gen_date, earliest_gen_date))
+                                     .replace(day=1) - timedelta(days=6))
+            self.ensure_calendar(calendar_first_day, last_day)
+            # Counting the periods of the window and the checked-off ones for all habits in one query,
+            # each count a lookup of a range of calendar days by primary key rather than a join of the two sets
+            cur.execute("""WITH windows AS (
+                    SELECT rowid AS habit_rowid, name, periodicity, check_off_dates,
+                        MAX(gen_date, COALESCE(:first_day, gen_date)) AS first_day
+                    FROM habit WHERE user_id=:user_id AND periodicity IN ('Daily', 'Weekly', 'Monthly')),
+                bounds AS (
+                    SELECT w.*,
+                        CASE w.periodicity WHEN 'Weekly' THEN f.week_start
+                            WHEN 'Monthly' THEN f.month_start ELSE f.day END AS first_period,
+                        CASE w.periodicity WHEN 'Weekly' THEN l.week_start
+                            WHEN 'Monthly' THEN l.month_start ELSE l.day END AS last_period
+                    FROM windows w
+                    LEFT JOIN calendar f ON f.day=w.first_day
+                    LEFT JOIN calendar l ON l.day=:last_day AND w.first_day <= :last_day)
+                SELECT b.name, b.periodicity,
+                    (SELECT COUNT(DISTINCT CASE b.periodicity WHEN 'Weekly' THEN c.week_start
+                            WHEN 'Monthly' THEN c.month_start ELSE c.day END)
+                        FROM calendar c WHERE c.day BETWEEN b.first_day AND :last_day),
+                    (SELECT COUNT(DISTINCT CASE b.periodicity WHEN 'Weekly' THEN c.week_start
+                            WHEN 'Monthly' THEN c.month_start ELSE c.day END)
+                        FROM json_each(b.check_off_dates) j JOIN calendar c ON c.day=j.value
+                        WHERE CASE b.periodicity WHEN 'Weekly' THEN c.week_start
+                            WHEN 'Monthly' THEN c.month_start ELSE c.day END
+                            BETWEEN b.first_period AND b.last_period)
+                FROM bounds b ORDER BY b.habit_rowid;""",
+                        {'user_id': user_id, 'first_day': first_day, 'last_day': last_day})
+            return cur.fetchall()
+        finally:
+            cur.close()
+
+    def set_gen_date(self, user_id, name, gen_date):
+        cur = self.conn.cursor()
+        try:
+            # Leaving the row alone when the date does not change, as marking a habit complete mostly keeps it
+            cur.execute("UPDATE habit SET gen_date=? WHERE user_id=? AND name=? AND gen_date IS NOT ?;",
+                        (gen_date, user_id, name, gen_date))
+            self._commit()
+        finally:
+            cur.close()
+
+    def delete_habit(self, user_id, name):
+        cur = self.conn.cursor()
+        try:
+            cur.execute("DELETE FROM habit WHERE user_id=? AND name=?;", (user_id, name))
+            self._commit()
+        finally:
+            cur.close()
+
+    def iter_check_off_batches(self, batch_size):
+        cur = self.conn.cursor()
+        last_rowid = 0
+        try:
+            while True:
+                # Paging through the table by rowid, so updating a batch does not disturb the next read
+                cur.execute("SELECT rowid, user_id, name, periodicity, check_off_dates FROM habit "
+                            "WHERE rowid>? ORDER BY rowid LIMIT ?;", (last_rowid, batch_size))
+                rows = cur.fetchall()
+                if not rows:
+                    break
+                last_rowid = rows[-1][0]
+                yield [(user_id, name, periodicity, json.loads(check_off_dates_str) if check_off_dates_str else [])
+                       for _, user_id, name, periodicity, check_off_dates_str in rows]
+        finally:
+            cur.close()
+
+    def replace_check_off_dates(self, updates):
+        cur = self.conn.cursor()
+        try:
+            changes = []
+            for user_id, name, check_off_dates in updates:
+                cur.execute("SELECT check_off_dates FROM habit WHERE user_id=? AND name=?;", (user_id, name))
+                row = cur.fetchone()
+                if row is None:
+                    continue
+                # Comparing the old and new dates as sets, the removed ones first, as MemoryStore does
+                old_dates, new_dates = set(json.loads(row[0]) if row[0] else []), set(check_off_dates)
+                changes.extend((user_id, name, 'remove_check_off', check_off_date)
+                               for check_off_date in sorted(old_dates - new_dates))
+                changes.extend((user_id, name, 'check_off', check_off_date)
+                               for check_off_date in sorted(new_dates - old_dates))
+            cur.executemany("UPDATE habit SET check_off_dates=? WHERE user_id=? AND name=?;",
+                            [(json.dumps(check_off_dates), user_id, name)
+                             for user_id, name, check_off_dates in updates])
+            self._record_changes(cur, changes)
+            self._commit()
+        finally:
+            cur.close()
+
+    def clear_check_off_dates(self):
+        cur = self.conn.cursor()
+        try:
+            cur.execute("""INSERT INTO habit_changes(user_id, name, operation, value)
+                SELECT DISTINCT habit.user_id, habit.name, 'remove_check_off', check_off.value
+                FROM habit, json_each(COALESCE(habit.check_off_dates, '[]')) AS check_off
+                ORDER BY habit.rowid, check_off.value;""")
+            # noinspection SqlWithoutWhere
+            cur.execute("UPDATE habit SET check_off_dates=?;", (json.dumps([]),))
+            self._commit()
+        finally:
+            cur.close()
+
+    def clear(self):
+        cur = self.conn.cursor()
+        try:
+            # noinspection SqlWithoutWhere
+            cur.execute("DELETE from habit")
+            self._commit()
+        finally:
+            cur.close()
+
+
+class PendingLog:
+    def __init__(self, path):
+        """
+        PendingLog class constructor designed to keep a write-ahead record of the changes that were made
+        to an in-memory working set but not yet flushed to the database file. Every change is one JSON line.
+        :param path: the path of the record file
+        """
+        self.path = path
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def append(self, operation, args):
+        """
+        Durably records one change before it is applied.
+        :param operation: the name of the HabitStore method making the change
+        :param args: the arguments of the method call
+        """
+        self._file.write(json.dumps({'op': operation, 'args': args}) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def replay(self, store):
+        """
+        Applies the recorded changes to a store, e.g. to the database file after a crash.
+        :param store: the HabitStore object to apply the changes to
+        :return: the number of changes applied
+        """
+        with open(self.path, encoding='utf-8') as record_file:
+            records = [json.loads(line) for line in record_file if line.strip()]
+        for record in records:
+            try:
+                getattr(store, record['op'])(*record['args'])
+            except (sqlite3.Error, TypeError) as e:
+                # A change that failed when it was recorded fails again, so it is skipped,
+                # as is one recorded with the arguments of another version
+                print(f"Error replaying pending change {record['op']}: {e}")
+        return len(records)
+
+    def truncate(self):
+        """
+        Forgets all recorded changes once they are safely in the database file.
+        """
+        self._file.truncate(0)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class WorkingSetStore(SQLiteStore):
+    def __init__(self, conn, pending_log, lock):
+        """
+        WorkingSetStore class constructor designed to keep habits in an in-memory SQLite database
+        that mirrors a database file, recording every change in a pending log before applying it.
+        :param conn: the in-memory SQLite database connection object
+        :param pending_log: the PendingLog object of the working set
+        :param lock: the lock shared with the flushes of the working set
+        """
+        super().__init__(conn)
+        self.pending_log = pending_log
+        self.lock = lock
+
+    @contextmanager
+    def batch(self):
+        # Holding the lock for the whole batch, so a timed flush never commits it halfway
+        with self.lock, super().batch():
+            yield self
+
+    def _recorded(self, operation, apply, *args):
+        # Holding the lock, so a timed flush never copies a half-applied change
+        with self.lock:
+            self.pending_log.append(operation, list(args))
+            return apply(*args)
+
+    def add_habit(self, user_id, name, descr, gen_date, periodicity):
+        return self._recorded('add_habit', super().add_habit, user_id, name, descr, gen_date, periodicity)
+
+    def append_check_off(self, user_id, name, event_date):
+        return self._recorded('append_check_off', super().append_check_off, user_id, name, event_date)
+
+    def set_gen_date(self, user_id, name, gen_date):
+        return self._recorded('set_gen_date', super().set_gen_date, user_id, name, gen_date)
+
+    def delete_habit(self, user_id, name):
+        return self._recorded('delete_habit', super().delete_habit, user_id, name)
+
+    def replace_check_off_dates(self, updates):
+        return self._recorded('replace_check_off_dates', super().replace_check_off_dates, updates)
+
+    def clear_check_off_dates(self):
+        return self._recorded('clear_check_off_dates', super().clear_check_off_dates)
+
+    def clear(self):
+        return self._recorded('clear', super().clear)
+
+
+class MemoryStore(HabitStore):
+    def __init__(self):
+        """
+        MemoryStore class constructor designed to keep the habits of each tenant in a dict,
+        with the check-off dates of each habit in a sorted list. Nothing is ever written to disk.
+        """
+        self._tenants = {}
+        self._change_counter = 0
+        # The change feed, the change with sequence number seq at position seq - 1
+        self._changes = []
+
+    def change_counter(self):
+        return self._change_counter
+
+    def _record(self, user_id, name, operation, value=None):
+        self._changes.append((len(self._changes) + 1, user_id, name, operation, value))
+
+    def changes_since(self, seq, limit):
+        return self._changes[seq:seq + limit]
+
+    def add_habit(self, user_id, name, descr, gen_date, periodicity):
+        habits = self._tenants.setdefault(user_id, {})
+        if name in habits:
+            return False
+        habits[name] = {'descr': descr, 'gen_date': gen_date, 'periodicity': periodicity, 'check_off_dates': []}
+        self._change_counter += 1
+        self._record(user_id, name, 'add_habit', json.dumps({'descr': descr, 'gen_date': gen_date,
+                                                             'periodicity': periodicity}, separators=(',', ':')))
+        return True
+
+    def append_check_off(self, user_id, name, event_date):
+        habit = self._tenants.get(user_id, {}).get(name)
+        if habit is None:
+            return False
+        check_off_dates = habit['check_off_dates']
+        index = bisect.bisect_left(check_off_dates, event_date)
+        if index < len(check_off_dates) and check_off_dates[index] == event_date:
+            return False
+        check_off_dates.insert(index, event_date)
+        self._change_counter += 1
+        self._record(user_id, name, 'check_off', event_date)
+        return True
+
+    def get_habits(self, user_id, name=None):
+        habits = self._tenants.get(user_id, {})
+        names = habits if name is None else [name] if name in habits else []
+        return [(habit_name, habits[habit_name]['descr'], habits[habit_name]['gen_date'],
+                 habits[habit_name]['periodicity'], list(habits[habit_name]['check_off_dates']))
+                for habit_name in names]
+
+    def get_habit_names(self, user_id):
+        return list(self._tenants.get(user_id, {}))
+
+    def search_habits(self, user_id, query, limit):
+        habits = self._tenants.get(user_id, {})
+        words = search_words(query)
+        matches = []
+        for name in sorted(habits):
+            habit_words = search_words(f"{name} {habits[name]['descr'] or ''}")
+            if all(any(habit_word.startswith(word) for habit_word in habit_words) for word in words):
+                matches.append((name, habits[name]['descr']))
+                if len(matches) == limit:
+                    break
+        return matches
+
+    def period_counts(self, user_id, first_day, last_day):
+        counts = []
+        last_day = date.fromisoformat(last_day)
+        for name, habit in self._tenants.get(user_id, {}).items():
+            if habit['periodicity'] not in ('Daily', 'Weekly', 'Monthly'):
+                continue
+            gen_date = date.fromisoformat(habit['gen_date'])
+            window_first_day = max(gen_date, date.fromisoformat(first_day)) if first_day else gen_date
+            check_off_dates = [date.fromisoformat(date_str) for date_str in habit['check_off_dates']]
+            counts.append((name, habit['periodicity'],
+                           count_periods(window_first_day, last_day, habit['periodicity']),
+                           count_completed_periods(check_off_dates, window_first_day, last_day, habit['periodicity'])))
+        return counts
+
+    def set_gen_date(self, user_id, name, gen_date):
+        habit = self._tenants.get(user_id, {}).get(name)
+        if habit is not None:
+            if habit['gen_date'] != gen_date:
+                habit['gen_date'] = gen_date
+                self._change_counter += 1
+                self._record(user_id, name, 'set_gen_date', gen_date)
+
+    def delete_habit(self, user_id, name):
+        if self._tenants.get(user_id, {}).pop(name, None) is not None:
+            self._change_counter += 1
+            self._record(user_id, name, 'delete_habit')
+
+    def iter_check_off_batches(self, batch_size):
+        keys = [(user_id, name) for user_id, habits in self._tenants.items() for name in habits]
+        for start in range(0, len(keys), batch_size):
+            yield [(user_id, name, self._tenants[user_id][name]['periodicity'],
+                    list(self._tenants[user_id][name]['check_off_dates']))
+                   for user_id, name in keys[start:start + batch_size] if name in self._tenants[user_id]]
+
+    def replace_check_off_dates(self, updates):
+        for user_id, name, check_off_dates in updates:
+            habit = self._tenants.get(user_id, {}).get(name)
+            if habit is not None:
+                self._replace_check_off_dates(user_id, name, habit, sorted(set(check_off_dates)))
+                self._change_counter += 1
+
+    def _replace_check_off_dates(self, user_id, name, habit, check_off_dates):
+        # Recording the removed dates first and then the added ones, like the triggers of SQLiteStore
+        old_dates, new_dates = set(habit['check_off_dates']), set(check_off_dates)
+        for check_off_date in sorted(old_dates - new_dates):
+            self._record(user_id, name, 'remove_check_off', check_off_date)
+        for check_off_date in sorted(new_dates - old_dates):
+            self._record(user_id, name, 'check_off', check_off_date)
+        habit['check_off_dates'] = check_off_dates
+
+    def clear_check_off_dates(self):
+        for user_id, habits in self._tenants.items():
+            for name, habit in habits.items():
+                self._replace_check_off_dates(user_id, name, habit, [])
+        self._change_counter += 1
+
+    def clear(self):
+        for user_id, habits in self._tenants.items():
+            for name in habits:
+                self._record(user_id, name, 'delete_habit')
+        self._tenants.clear()
+        self._change_counter += 1
+
+
+def search_words(text):
+    """
+    Splits a search query or a searched text into lowercase words, dropping punctuation and search operators.
+    :param text: the text to split
+    :return: list of words
+    """
+    return re.findall(r'\w+', (text or '').lower())
+
+
+def get_store(db):
+    """
+    Retrieves the storage backend for a database object.
+    :param db: a HabitStore, or an SQLite database connection object which then gets wrapped in an SQLiteStore
+    :return: HabitStore object
+    """
+    if isinstance(db, HabitStore):
+        return db
+    if isinstance(db, sqlite3.Connection):
+        store = getattr(db, 'habit_store', None)
+        if store is None:
+            store = SQLiteStore(db)
+            try:
+                db.habit_store = store
+            except AttributeError:
+                # Plain sqlite3.Connection objects do not accept extra attributes
+                pass
+        return store
+    raise ValueError("Invalid database connection")
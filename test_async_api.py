@@ -0,0 +1,62 @@
+import asyncio
+from datetime import date, timedelta
+import pytest
+import sqlite3
+import dataschema
+from async_api import AsyncHabitTracker
+
+
+def test_concurrent_marks_are_group_committed(tmp_path):
+    db_path = str(tmp_path / 'async.db')
+    db = dataschema.get_db(name=db_path)
+    dataschema.add_habit_to_db(db, name='Swearstorming', descr='Unleashing a torrent of colorful language',
+                               gen_date=date.fromisoformat("2024-01-01"), periodicity='Daily')
+    db.close()
+    mark_dates = [date.fromisoformat("2024-01-01") + timedelta(days=offset) for offset in range(50)]
+
+    async def mark_all():
+        async with AsyncHabitTracker(name=db_path) as tracker:
+            marked = await asyncio.gather(*(tracker.async_mark_complete('Swearstorming', mark_date)
+                                            for mark_date in mark_dates))
+            with pytest.raises(LookupError):
+                await tracker.async_mark_complete('Not a habit')
+            habit = await tracker.async_get_habit('Swearstorming')
+            all_habits_df = await tracker.async_display_all_habits_tracked()
+            return marked, habit, all_habits_df, tracker.batches_committed
+
+    marked, habit, all_habits_df, batches_committed = asyncio.run(mark_all())
+    assert marked == mark_dates
+    assert habit.marked_complete == mark_dates
+    assert all_habits_df['Total periods of guilt'].iloc[0] == 50
+    # The 50 concurrent writes should have been coalesced into far fewer commits
+    assert batches_committed < 10
+    habit_data = dataschema.get_habit_data(dataschema.get_db(name=db_path), 'Swearstorming')
+    assert len(habit_data[0]['check_off_dates']) == 50
+
+
+def test_failed_batch_leaves_no_marks_behind(tmp_path):
+    db_path = str(tmp_path / 'async.db')
+    db = dataschema.get_db(name=db_path)
+    dataschema.add_habit_to_db(db, name='Swearstorming', descr='Unleashing a torrent of colorful language',
+                               gen_date=date.fromisoformat("2024-01-01"), periodicity='Daily')
+
+    async def mark_and_fail():
+        async with AsyncHabitTracker(name=db_path) as tracker:
+            await tracker.async_mark_complete('Swearstorming', date.fromisoformat("2024-01-01"))
+            # Making SQLite itself refuse the next check-off
+            db.execute("CREATE TRIGGER refuse_check_offs BEFORE UPDATE OF check_off_dates ON habit "
+                       "BEGIN SELECT RAISE(ABORT, 'check-offs are refused'); END;")
+            db.commit()
+            with pytest.raises(sqlite3.IntegrityError):
+                await tracker.async_mark_complete('Swearstorming', date.fromisoformat("2024-01-05"))
+            return await tracker.async_get_habit('Swearstorming')
+
+    habit = asyncio.run(mark_and_fail())
+    # The cached habit is read again after the rollback, without the mark that never reached the database
+    assert habit.marked_complete == [date.fromisoformat("2024-01-01")]
+    assert dataschema.get_habit_data(db, 'Swearstorming')[0]['check_off_dates'] == ["2024-01-01"]
+    db.close()
+
+
+if __name__ == "__main__":
+    pytest.main()
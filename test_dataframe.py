@@ -1,10 +1,20 @@
 from project_setup import setup_test_database
 from freezegun import freeze_time
 from datetime import date
+import random
 import pytest
 import dataschema
 import pandas as pd
 import dataframe
+import numpy as np
+import trends
+from habit import Habit
+from correlation import (calculate_habit_correlations, calculate_most_correlated_habits,
+                         cooccurrence_and_correlation, indicator_matrix)
+from oracle import random_habits
+from periods import period_ordinal
+from snapshot import write_snapshot, open_snapshot
+from storage import DEFAULT_USER, get_store
 
 fake_today = "2024-04-23"
 
@@ -16,7 +26,8 @@ def test_current_date():
 
 class TestDataframe:
     def setup_method(self):
-        self.test_db = setup_test_database()
+        # Running the analytics tests on the in-memory backend, so they do not touch test.db
+        self.test_db = setup_test_database(backend='memory')
 
     def teardown_method(self):
         dataschema.clear_database(self.test_db)
@@ -29,6 +40,12 @@ class TestDataframe:
         # 5 test habits are added in setup_test_database
         assert len(df) == 5
 
+    def test_display_all_habits_tracked_in_parallel(self):
+        serial_df = dataframe.display_all_habits_tracked(self.test_db)
+        # Using chunks of 2 habits, so the 5 test habits are split across the workers
+        parallel_df = dataframe.display_all_habits_tracked(self.test_db, workers=2, chunk_size=2)
+        pd.testing.assert_frame_equal(serial_df, parallel_df)
+
     # Test cases for the function display_all_same_periodicity_habits_tracked
     def test_display_all_same_periodicity_habits_tracked(self):
         df = dataframe.display_all_same_periodicity_habits_tracked(self.test_db, periodicity='Daily')
@@ -94,6 +111,185 @@ class TestDataframe:
         assert not min_resistance_row.empty
         assert min_resistance_row['Resistance ratio'].iloc[0] == min(df['Resistance ratio'])
 
+    def test_page_all_habits_tracked(self):
+        table = dataframe.page_all_habits_tracked(self.test_db, page_size=2)
+        assert table.page_count == 3
+        # Rendering the second page only calculates the stats of its habits, plus the sample for the widths
+        second_page = table.render_page(1)
+        assert 'Binge' in second_page and 'Rushing' in second_page
+        assert 'Swearstorming' not in second_page
+        assert sorted(table._pages) == [0, 1]
+        serial_df = dataframe.display_all_habits_tracked(self.test_db)
+        assert table.page_rows(2) == serial_df.iloc[4:].to_dict('records')
+
+
+class TestShardedDataframe:
+    def test_reports_fan_out_to_shards(self, tmp_path):
+        # The reports on habits spread over 3 shard files should match the ones on a single store
+        sharded_db = setup_test_database(name=str(tmp_path / 'test.db'), shards=3, shard_by='name')
+        single_db = setup_test_database(backend='memory')
+        sharded_df = dataframe.display_all_habits_tracked(sharded_db)
+        single_df = dataframe.display_all_habits_tracked(single_db)
+        pd.testing.assert_frame_equal(sharded_df.sort_values('Name').reset_index(drop=True),
+                                      single_df.sort_values('Name').reset_index(drop=True))
+        for report in (dataframe.calculate_longestrun_current_streak, dataframe.calculate_longest_historical_streak,
+                       dataframe.calculate_lowest_and_largest_average_streak,
+                       dataframe.calculate_lowest_and_highest_resistance_ratio):
+            sharded_report = report(sharded_db)
+            single_report = report(single_db)
+            assert sorted(map(tuple, sharded_report.astype(str).values)) == sorted(
+                map(tuple, single_report.astype(str).values))
+        sharded_db.close()
+
+
+class TestSnapshotDataframe:
+    def setup_method(self):
+        self.test_db = setup_test_database(backend='memory')
+
+    @freeze_time(fake_today)
+    def test_stats_from_snapshot_match_habit_stats(self, tmp_path):
+        snapshot_path = str(tmp_path / 'test.db-snapshot')
+        assert write_snapshot(self.test_db, snapshot_path) == 5
+        snapshot_df = dataframe.display_all_habits_tracked(self.test_db, snapshot_path=snapshot_path)
+        habit_df = dataframe.display_all_habits_tracked(self.test_db)
+        pd.testing.assert_frame_equal(snapshot_df, habit_df)
+        for report in (dataframe.calculate_longestrun_current_streak, dataframe.calculate_longest_historical_streak,
+                       dataframe.calculate_lowest_and_largest_average_streak):
+            pd.testing.assert_frame_equal(report(self.test_db, snapshot_path=snapshot_path), report(self.test_db))
+
+    def test_snapshot_is_invalidated_by_changes(self, tmp_path):
+        snapshot_path = str(tmp_path / 'test.db-snapshot')
+        write_snapshot(self.test_db, snapshot_path)
+        snapshot = open_snapshot(self.test_db, snapshot_path)
+        assert snapshot is not None
+        # The period ordinals are read straight out of the mapped file
+        assert not snapshot.habit_periods(0).flags.owndata
+        snapshot.close()
+        assert open_snapshot(self.test_db, snapshot_path, user_id='someone else') is None
+        dataschema.increment_guilt(self.test_db, name='Rushing', event_date="2024-04-08")
+        assert open_snapshot(self.test_db, snapshot_path) is None
+
+
+class TestTrends:
+    def setup_method(self):
+        self.test_db = setup_test_database(backend='memory')
+
+    def test_rolling_rates_match_window_by_window_counts(self):
+        today = date(2024, 3, 1)
+        habits = random_habits(random.Random(3), 30, today)
+        db = dataschema.get_db(backend='memory')
+        for habit in habits:
+            dataschema.add_habit_to_db(db, habit['name'], "", habit['gen_date'], habit['periodicity'])
+        get_store(db).replace_check_off_dates([(DEFAULT_USER, habit['name'],
+                                                [day.isoformat() for day in habit['check_off_dates']])
+                                               for habit in habits])
+        rates = trends.rolling_guilt_rates(*trends.load_check_offs(db), today=today)
+        for habit in habits:
+            periodicity = habit['periodicity']
+            first, last = period_ordinal(habit['gen_date'], periodicity), period_ordinal(today, periodicity)
+            guilty = {period_ordinal(day, periodicity) for day in habit['check_off_dates']}
+            habit_rates = rates[rates['Name'] == habit['name']]
+            assert len(habit_rates) == last - first + 1
+            for period, (_, row) in zip(range(first, last + 1), habit_rates.iterrows()):
+                assert row['Guilty'] == (period in guilty)
+                for window in trends.TREND_WINDOWS:
+                    window_periods = range(max(first, period - window + 1), period + 1)
+                    expected = len(guilty.intersection(window_periods)) / len(window_periods)
+                    assert row[f"{window}-period guilt rate"] == pytest.approx(expected)
+
+    @freeze_time(fake_today)
+    def test_calculate_guilt_trends(self):
+        report = trends.calculate_guilt_trends(self.test_db)
+        assert list(report['Name']) == [habit['name'] for habit in dataschema.get_habit_data(self.test_db, None)]
+        assert report.filter(like='guilt rate').stack().between(0, 100).all()
+        rates = trends.rolling_guilt_rates(*trends.load_check_offs(self.test_db))
+        rushing = rates[rates['Name'] == 'Rushing']
+        # Comparing the last period with the period a week ago, one period back for a weekly habit
+        assert report.set_index('Name').loc['Rushing', '7-period change'] == round(
+            (rushing['7-period guilt rate'].iloc[-1] - rushing['7-period guilt rate'].iloc[-2]) * 100, 2)
+
+    def test_unknown_periodicities_are_left_out(self):
+        # Habit.create_habit accepts any periodicity, but only the known ones have periods to count
+        dataschema.add_habit_to_db(self.test_db, name='Overthinking', descr='Thinking too much',
+                                   gen_date=date(2024, 1, 1), periodicity='Yearly')
+        dataschema.increment_guilt(self.test_db, name='Overthinking', event_date="2024-02-01")
+        habits, check_offs = trends.load_check_offs(self.test_db)
+        assert 'Overthinking' not in set(habits['Name'])
+        assert len(check_offs) == sum(len(habit_info['check_off_dates'])
+                                      for habit_info in dataschema.get_habit_data(self.test_db, None)) - 1
+        assert 'Overthinking' not in set(trends.calculate_guilt_trends(self.test_db)['Name'])
+
+
+class TestCorrelation:
+    def setup_method(self):
+        self.test_db = setup_test_database(backend='memory')
+
+    @freeze_time(fake_today)
+    def test_monthly_check_offs_mark_every_week_of_their_month(self):
+        habits, check_offs = trends.load_check_offs(self.test_db)
+        matrix, grid_starts = indicator_matrix(habits, check_offs)
+        assert grid_starts[-1] == np.datetime64("2024-04-22")
+        procrastipondering = list(habits['Name']).index('Procrastipondering')
+        # Checked off in January 2024, whose weeks start from 2024-01-01 to 2024-01-29, and not in February
+        january_weeks = (grid_starts >= np.datetime64("2024-01-01")) & (grid_starts <= np.datetime64("2024-01-29"))
+        assert january_weeks.sum() == 5 and matrix[procrastipondering, january_weeks].all()
+        assert not matrix[procrastipondering, grid_starts == np.datetime64("2024-02-05")].any()
+
+    @freeze_time(fake_today)
+    def test_correlations_match_numpy(self):
+        cooccurrence, correlation = calculate_habit_correlations(self.test_db)
+        matrix, _ = indicator_matrix(*trends.load_check_offs(self.test_db))
+        assert (np.diag(cooccurrence) == matrix.sum(axis=1)).all()
+        assert (cooccurrence.values == cooccurrence.values.T).all()
+        np.testing.assert_allclose(correlation.values, np.corrcoef(matrix).round(2))
+        pairs = calculate_most_correlated_habits(self.test_db, top=3)
+        assert len(pairs) == 3
+        assert pairs['Correlation'].is_monotonic_decreasing
+        first = pairs.iloc[0]
+        assert first['Correlation'] == correlation.loc[first['Habit'], first['Other habit']]
+
+    def test_habits_never_guilty_have_no_correlation(self):
+        matrix = np.array([[True, False, True], [False, False, False], [True, False, True]])
+        cooccurrence, correlation = cooccurrence_and_correlation(matrix)
+        assert cooccurrence.tolist() == [[2, 0, 2], [0, 0, 0], [2, 0, 2]]
+        assert correlation[0, 2] == pytest.approx(1.0)
+        assert np.isnan(correlation[0, 1]) and np.isnan(correlation[1, 1])
+
+
+class TestStreakDistribution:
+    def setup_method(self):
+        self.test_db = setup_test_database(backend='memory')
+
+    def test_histograms_match_habit_histograms(self, tmp_path):
+        snapshot_path = str(tmp_path / 'test.db-snapshot')
+        write_snapshot(self.test_db, snapshot_path)
+        expected = {habit.name: habit.calculate_streak_histogram() for habit in Habit.get_all_habits(self.test_db)}
+        for path in (None, snapshot_path):
+            histograms = dataframe.calculate_streak_histograms(self.test_db, snapshot_path=path)
+            actual = {name: dict(zip(rows['Streak length'], rows['Streaks']))
+                      for name, rows in histograms.groupby('Name')}
+            assert actual == {name: histogram for name, histogram in expected.items() if histogram}
+
+    def test_percentiles_per_periodicity(self):
+        habits = Habit.get_all_habits(self.test_db)
+        report = dataframe.calculate_streak_length_percentiles(self.test_db).set_index('Periodicity')
+        weekly_lengths = [length for habit in habits if habit.periodicity == "Weekly"
+                          for length in habit.calculate_streak_lengths()]
+        assert report.loc['Weekly', 'Streaks'] == len(weekly_lengths)
+        assert report.loc['Weekly', 'p90'] == round(float(np.percentile(weekly_lengths, 90)), 2)
+        assert report.loc['Weekly', 'Longest'] == max(weekly_lengths)
+        distribution = dataframe.calculate_streak_length_distribution(self.test_db)
+        assert distribution.groupby('Periodicity')['Share'].sum().round().eq(100).all()
+
+    def test_streak_lengths_are_cached_until_check_offs_change(self):
+        habit = Habit.get_habit_by_name(self.test_db, 'Rushing')
+        streak_lengths = habit.calculate_streak_lengths()
+        assert habit.calculate_streak_lengths() is streak_lengths
+        assert max(streak_lengths) == habit.calculate_longest_historical_streak()
+        habit.add_event(self.test_db, date.fromisoformat("2024-01-22"))
+        assert habit.calculate_streak_lengths() is not streak_lengths
+        assert sum(habit.calculate_streak_lengths()) == len(habit.marked_complete)
+
 
 if __name__ == "__main__":
     pytest.main()
@@ -1,8 +1,14 @@
 from project_setup import setup_test_database
 from freezegun import freeze_time
 from datetime import date
+import json
+import os
 import pytest
+import sqlite3
 import dataschema
+import main
+from habit import Habit
+from journal import EventJournal, FILE_HEADER, LENGTH_PREFIX, MAGIC, VERSION
 
 fake_today = "2024-04-23"
 
@@ -49,6 +55,386 @@ class TestDB:
         assert 'check_off_dates' in habit_data[0]
         assert len(habit_data[0]['check_off_dates']) == 1
 
+    def test_increment_guilt_skips_existing_date(self):
+        # Testing that marking the same date twice stores it only once
+        dataschema.increment_guilt(self.test_db, name='Swearstorming', event_date="2024-03-23")
+        dataschema.increment_guilt(self.test_db, name='Swearstorming', event_date="2024-04-24")
+        habit_data = dataschema.get_habit_data(self.test_db, 'Swearstorming')
+        check_off_dates = habit_data[0]['check_off_dates']
+        assert check_off_dates.count("2024-03-23") == 1
+        assert check_off_dates[-1] == "2024-04-24"
+        assert len(check_off_dates) == 7
+
+    def test_compact_check_off_dates(self):
+        # Testing that compaction deduplicates, sorts and re-anchors check-off dates
+        dataschema.increment_guilt(self.test_db, name='Rushing', event_date="2024-04-24")
+        dataschema.increment_guilt(self.test_db, name='Rushing', event_date="2024-03-27")
+        rewritten = dataschema.compact_check_off_dates(self.test_db, batch_size=2)
+        assert rewritten == 1
+        habit_data = dataschema.get_habit_data(self.test_db, 'Rushing')
+        assert habit_data[0]['check_off_dates'] == ["2024-01-01", "2024-01-08", "2024-01-15",
+                                                    "2024-03-25", "2024-04-15", "2024-04-22"]
+        # Running it again should find nothing left to rewrite
+        assert dataschema.compact_check_off_dates(self.test_db) == 0
+
+    def test_tenants_are_isolated(self):
+        # Testing that two tenants can track habits with the same name without seeing each other's
+        dataschema.add_habit_to_db(self.test_db, name='Swearstorming', descr='Cursing in a meeting',
+                                   gen_date=date.fromisoformat("2024-04-01"), periodicity='Weekly',
+                                   user_id='alice')
+        dataschema.increment_guilt(self.test_db, name='Swearstorming', event_date="2024-04-01", user_id='alice')
+        alice_data = dataschema.get_habit_data(self.test_db, 'Swearstorming', user_id='alice')
+        assert alice_data[0]['periodicity'] == 'Weekly'
+        assert alice_data[0]['check_off_dates'] == ["2024-04-01"]
+        assert dataschema.get_habit_names(self.test_db, user_id='alice') == ['Swearstorming']
+        assert "2024-04-01" not in dataschema.get_habit_data(self.test_db, 'Swearstorming')[0]['check_off_dates']
+        dataschema.delete_habit(self.test_db, 'Swearstorming', user_id='alice')
+        assert dataschema.get_habit_data(self.test_db, None, user_id='alice') == []
+        assert len(dataschema.get_habit_data(self.test_db, 'Swearstorming')) == 1
+
+    def test_search_habits(self):
+        # Testing prefix search over names and descriptions, scoped to the tenant and limited
+        assert [name for name, _ in dataschema.search_habits(self.test_db, "swear")] == ['Swearstorming']
+        assert [name for name, _ in dataschema.search_habits(self.test_db, "torrent col")] == ['Swearstorming']
+        assert dataschema.search_habits(self.test_db, "pondering importance")[0][0] == 'Procrastipondering'
+        assert [name for name, _ in dataschema.search_habits(self.test_db, "", limit=2)] == ['Binge watching',
+                                                                                              'Overanalyzing']
+        assert dataschema.search_habits(self.test_db, "swear", user_id='alice') == []
+        dataschema.delete_habit(self.test_db, 'Swearstorming')
+        assert dataschema.search_habits(self.test_db, "swear") == []
+
+    @freeze_time(fake_today)
+    def test_period_counts_match_habit_stats(self):
+        # Testing that the grouped period counts agree with the stats of the Habit subclasses
+        period_counts = dataschema.get_period_counts(self.test_db)
+        assert [counts['name'] for counts in period_counts] == dataschema.get_habit_names(self.test_db)
+        for counts in period_counts:
+            habit = Habit.get_habit_by_name(self.test_db, counts['name'])
+            assert counts['completed'] == habit.calculate_total_completed()
+            assert counts['resisted'] == habit.calculate_total_resisted()
+        # Weekly habits count ISO weeks: 2024-01-01 to 2024-04-23 touches 17 weeks
+        assert {counts['name']: counts['periods'] for counts in period_counts}['Rushing'] == 17
+
+    def test_period_counts_over_a_window(self):
+        period_counts = dataschema.get_period_counts(self.test_db, window_start=date.fromisoformat("2024-04-03"),
+                                                     window_end=date.fromisoformat("2024-04-23"))
+        rushing = {counts['name']: counts for counts in period_counts}['Rushing']
+        # The weeks starting on 2024-04-01, 04-08, 04-15 and 04-22, checked off in the last two
+        assert (rushing['periods'], rushing['completed'], rushing['resisted']) == (4, 2, 2)
+
+    def test_changes_since(self):
+        # Testing that every write lands in the change feed in order, read from the last change already seen
+        seq = max([change['seq'] for change in dataschema.changes_since(self.test_db)], default=0)
+        dataschema.add_habit_to_db(self.test_db, name='Overthinking', descr='Thinking too much',
+                                   gen_date=date.fromisoformat("2024-04-01"), periodicity='Daily')
+        dataschema.increment_guilt(self.test_db, name='Overthinking', event_date="2024-04-02")
+        dataschema.increment_guilt(self.test_db, name='Rushing', event_date="2024-03-27")
+        dataschema.update_gen_date(self.test_db, 'Overthinking', date.fromisoformat("2024-03-01"))
+        dataschema.compact_check_off_dates(self.test_db)
+        dataschema.delete_habit(self.test_db, 'Overthinking')
+        changes = list(dataschema.changes_since(self.test_db, seq))
+        assert [(change['name'], change['operation'], change['value']) for change in changes] == [
+            ('Overthinking', 'add_habit', {'descr': 'Thinking too much', 'gen_date': '2024-04-01',
+                                           'periodicity': 'Daily'}),
+            ('Overthinking', 'check_off', '2024-04-02'),
+            ('Rushing', 'check_off', '2024-03-27'),
+            ('Overthinking', 'set_gen_date', '2024-03-01'),
+            ('Rushing', 'remove_check_off', '2024-03-27'),
+            ('Rushing', 'check_off', '2024-03-25'),
+            ('Overthinking', 'delete_habit', None)]
+        assert [change['seq'] for change in changes] == list(range(seq + 1, seq + 8))
+        # Paging through the feed gives the same changes, and a limit stops it early
+        assert list(dataschema.changes_since(self.test_db, seq, page_size=2)) == changes
+        assert list(dataschema.changes_since(self.test_db, seq + 2, limit=3)) == changes[2:5]
+        assert list(dataschema.changes_since(self.test_db, changes[-1]['seq'])) == []
+        # Setting the creation date a habit already has changes nothing
+        change_counter = dataschema.get_change_counter(self.test_db)
+        dataschema.update_gen_date(self.test_db, 'Rushing', date.fromisoformat("2024-01-01"))
+        assert dataschema.get_change_counter(self.test_db) == change_counter
+        assert list(dataschema.changes_since(self.test_db, changes[-1]['seq'])) == []
+
+
+class TestMemoryDB(TestDB):
+    # Running the same tests against the in-memory backend
+
+    def setup_method(self):
+        self.test_db = setup_test_database(backend='memory')
+
+
+class TestShardedDB(TestDB):
+    # Running the same tests against habits spread over several database files by name
+
+    @pytest.fixture(autouse=True)
+    def sharded_db(self, tmp_path):
+        self.test_db = setup_test_database(name=str(tmp_path / 'test.db'), shards=3, shard_by='name')
+
+    def setup_method(self):
+        pass
+
+    def test_habits_are_spread_over_the_shards(self):
+        shard_names = [shard.get_habit_names('default') for shard in self.test_db.shards]
+        assert sorted(name for names in shard_names for name in names) == sorted(
+            dataschema.get_habit_names(self.test_db))
+        assert sum(1 for names in shard_names if names) > 1
+
+    def test_changes_since(self):
+        # Every shard numbers its own changes, and the seq of a change holds the sequence numbers of all shards
+        changes = list(dataschema.changes_since(self.test_db))
+        assert sorted(change['name'] for change in changes if change['operation'] == 'add_habit') == sorted(
+            dataschema.get_habit_names(self.test_db))
+        for previous, change in zip([{'seq': (0, 0, 0)}] + changes, changes):
+            steps = [current - last for last, current in zip(previous['seq'], change['seq'])]
+            assert sorted(steps) == [0, 0, 1]
+            assert steps.index(1) == self.test_db.shard_index('default', change['name'])
+        seq = changes[-1]['seq']
+        for name in ('Overthinking', 'Oversleeping', 'Overeating', 'Overspending'):
+            dataschema.add_habit_to_db(self.test_db, name=name, descr='', gen_date=date.fromisoformat("2024-04-01"),
+                                       periodicity='Daily')
+            dataschema.increment_guilt(self.test_db, name=name, event_date="2024-04-02")
+        dataschema.delete_habit(self.test_db, 'Overthinking')
+        new_changes = list(dataschema.changes_since(self.test_db, seq))
+        assert len(new_changes) == 9
+        assert sum(1 for changes_of_shard in map(set, zip(*(change['seq'] for change in new_changes)))
+                   if len(changes_of_shard) > 1) > 1
+        overthinking = [(change['operation'], change['value']) for change in new_changes
+                        if change['name'] == 'Overthinking']
+        assert overthinking == [('add_habit', {'descr': '', 'gen_date': '2024-04-01', 'periodicity': 'Daily'}),
+                                ('check_off', '2024-04-02'), ('delete_habit', None)]
+        # Paging, and resuming from the seq of any change, gives the same changes
+        assert list(dataschema.changes_since(self.test_db, seq, page_size=2)) == new_changes
+        first_changes = list(dataschema.changes_since(self.test_db, seq, limit=4))
+        assert first_changes + list(dataschema.changes_since(self.test_db, first_changes[-1]['seq'])) == new_changes
+        with pytest.raises(ValueError):
+            next(dataschema.changes_since(self.test_db, (0, 0)))
+
+    def test_shard_count_cannot_change(self, tmp_path):
+        with pytest.raises(ValueError):
+            dataschema.get_db(name=str(tmp_path / 'test.db'), shards=2, shard_by='name')
+
+
+class TestJournaledDB(TestDB):
+    # Running the same tests with the check-off dates going through an event journal first
+
+    @pytest.fixture(autouse=True)
+    def journaled_db(self, tmp_path):
+        self.test_db = setup_test_database(name=str(tmp_path / 'test.db'), journal=True)
+
+    def setup_method(self):
+        pass
+
+    def test_check_offs_wait_in_the_journal(self):
+        # The check-off dates of the test habits are only in the journal, but reads see them already
+        assert self.test_db.journal.pending_count > 0
+        plain_db = sqlite3.connect(self.test_db.journal.path[:-len('-events')])
+        assert plain_db.execute("SELECT check_off_dates FROM habit WHERE name='Rushing';").fetchone()[0] == '[]'
+        habit_data = dataschema.get_habit_data(self.test_db, 'Rushing')
+        assert habit_data[0]['check_off_dates'] == ["2024-01-01", "2024-01-08", "2024-01-15", "2024-04-15",
+                                                    "2024-04-22"]
+        # Compacting moves them into the database file in one go
+        pending_count = self.test_db.journal.pending_count
+        assert dataschema.compact_journal(self.test_db) == pending_count
+        assert self.test_db.journal.pending_count == 0
+        assert os.path.getsize(self.test_db.journal.path) == FILE_HEADER.size
+        assert json.loads(plain_db.execute("SELECT check_off_dates FROM habit WHERE name='Rushing';").fetchone()[0]
+                          ) == habit_data[0]['check_off_dates']
+        plain_db.close()
+
+    def test_changes_since(self):
+        # The journaled check-offs get their sequence numbers when the journal is merged, after the other writes
+        seq = max(change['seq'] for change in dataschema.changes_since(self.test_db))
+        dataschema.add_habit_to_db(self.test_db, name='Overthinking', descr='Thinking too much',
+                                   gen_date=date.fromisoformat("2024-04-01"), periodicity='Daily')
+        dataschema.increment_guilt(self.test_db, name='Overthinking', event_date="2024-04-02")
+        dataschema.update_gen_date(self.test_db, 'Overthinking', date.fromisoformat("2024-03-01"))
+        assert self.test_db.journal.pending_count == 1
+        changes = list(dataschema.changes_since(self.test_db, seq))
+        assert self.test_db.journal.pending_count == 0
+        assert [(change['operation'], change['value']) for change in changes[1:]] == [
+            ('set_gen_date', '2024-03-01'), ('check_off', '2024-04-02')]
+
+    def test_compaction_writes_each_habit_once(self):
+        # Merging the events of several habits, some dates already present and some recorded twice
+        seq = max(change['seq'] for change in dataschema.changes_since(self.test_db))
+        store = self.test_db.habit_store
+        added = store.append_check_offs([('default', 'Rushing', "2024-04-29"),
+                                         ('default', 'Swearstorming', "2024-05-01"),
+                                         ('default', 'Rushing', "2024-01-01"),
+                                         ('default', 'Rushing', "2024-04-29"),
+                                         ('default', 'Not a habit', "2024-05-01")])
+        assert added == 2
+        assert dataschema.get_habit_data(self.test_db, 'Rushing')[0]['check_off_dates'][-1] == "2024-04-29"
+        assert [(change['name'], change['value']) for change in dataschema.changes_since(self.test_db, seq)] == [
+            ('Rushing', "2024-04-29"), ('Swearstorming', "2024-05-01")]
+
+    def test_compact_command_opens_only_existing_journals(self, tmp_path, capsys):
+        db_path = str(tmp_path / 'plain.db')
+        db = dataschema.get_db(name=db_path)
+        dataschema.add_habit_to_db(db, name='Overthinking', descr='', gen_date=date.fromisoformat("2024-04-01"),
+                                   periodicity='Weekly')
+        dataschema.increment_guilt(db, name='Overthinking', event_date="2024-04-03")
+        db.close()
+        main.compact(db_path)
+        assert not os.path.exists(db_path + '-events')
+        # While a journaling session holds the journal, the command leaves it alone and compacts the rest
+        main.compact(self.test_db.journal.path[:-len('-events')])
+        assert "in use by another process" in capsys.readouterr().out
+        assert self.test_db.journal.pending_count > 0
+        assert dataschema.get_habit_data(dataschema.get_db(name=db_path), 'Overthinking')[0][
+            'check_off_dates'] == ["2024-04-01"]
+
+    def test_journal_is_compacted_when_full(self, tmp_path):
+        db = dataschema.get_db(name=str(tmp_path / 'full.db'), journal=True)
+        db.habit_store.compact_every = 3
+        dataschema.add_habit_to_db(db, name='Overthinking', descr='Thinking too much',
+                                   gen_date=date.fromisoformat("2024-04-01"), periodicity='Daily')
+        for day in range(2, 6):
+            dataschema.increment_guilt(db, name='Overthinking', event_date=f"2024-04-0{day}")
+        assert db.journal.pending_count == 1
+        habit_data = dataschema.get_habit_data(db, 'Overthinking')
+        assert habit_data[0]['check_off_dates'] == ["2024-04-02", "2024-04-03", "2024-04-04", "2024-04-05"]
+        db.close()
+
+    def test_journal_is_recovered(self, tmp_path):
+        db_path = str(tmp_path / 'crashed.db')
+        db = dataschema.get_db(name=db_path, journal=True)
+        dataschema.add_habit_to_db(db, name='Overthinking', descr='Thinking too much',
+                                   gen_date=date.fromisoformat("2024-04-01"), periodicity='Daily')
+        dataschema.increment_guilt(db, name='Overthinking', event_date="2024-04-02")
+        # Stopping without compacting, as a crash would, which also releases the lock on the journal
+        db.journal.close()
+        db.journal = None
+        recovered_db = dataschema.get_db(name=db_path)
+        assert dataschema.get_habit_data(recovered_db, 'Overthinking')[0]['check_off_dates'] == []
+        recovered_db.close()
+        # Opening the journal again compacts the events left behind
+        recovered_db = dataschema.get_db(name=db_path, journal=True)
+        assert dataschema.get_habit_data(recovered_db, 'Overthinking')[0]['check_off_dates'] == ["2024-04-02"]
+        assert recovered_db.journal.pending_count == 0
+        recovered_db.close()
+        db.close()
+
+    def test_recovered_events_follow_the_habit_name(self, tmp_path):
+        db_path = str(tmp_path / 'crashed.db')
+        db = dataschema.get_db(name=db_path, journal=True)
+        for name in ('Overthinking', 'Overanalyzing'):
+            dataschema.add_habit_to_db(db, name=name, descr='', gen_date=date.fromisoformat("2024-04-01"),
+                                       periodicity='Daily')
+        dataschema.increment_guilt(db, name='Overanalyzing', event_date="2024-04-02")
+        db.journal.close()
+        db.journal = None
+        # Without the journal, deleting the habit frees its rowid, and SQLite hands it to the next habit
+        plain_db = dataschema.get_db(name=db_path)
+        dataschema.delete_habit(plain_db, 'Overanalyzing')
+        dataschema.add_habit_to_db(plain_db, name='Binge watching', descr='',
+                                   gen_date=date.fromisoformat("2024-04-01"), periodicity='Daily')
+        plain_db.close()
+        recovered_db = dataschema.get_db(name=db_path, journal=True)
+        assert dataschema.get_habit_data(recovered_db, 'Binge watching')[0]['check_off_dates'] == []
+        recovered_db.close()
+        db.close()
+
+    def test_journal_is_locked_while_open(self):
+        with pytest.raises(ValueError):
+            EventJournal(self.test_db.journal.path)
+        # The events of the open journal are still there
+        assert self.test_db.journal.pending_count > 0
+        assert dataschema.get_habit_data(self.test_db, 'Rushing')[0]['check_off_dates'][-1] == "2024-04-22"
+
+    def test_foreign_journal_is_rejected(self, tmp_path):
+        # A file without the header of the journal is left alone rather than read as events
+        journal_path = str(tmp_path / 'foreign.db-events')
+        with open(journal_path, 'wb') as journal_file:
+            journal_file.write(LENGTH_PREFIX.pack(12) + bytes(12))
+        with pytest.raises(ValueError):
+            EventJournal(journal_path)
+        with open(journal_path, 'rb') as journal_file:
+            assert journal_file.read() == LENGTH_PREFIX.pack(12) + bytes(12)
+        # An empty file becomes a journal
+        open(journal_path, 'wb').close()
+        journal = EventJournal(journal_path)
+        journal.close()
+        with open(journal_path, 'rb') as journal_file:
+            assert journal_file.read() == FILE_HEADER.pack(MAGIC, VERSION)
+
+
+class TestWorkingSet:
+
+    def test_changes_reach_the_file_on_flush(self, tmp_path):
+        db_path = str(tmp_path / 'working_set.db')
+        db = dataschema.get_db(name=db_path, in_memory=True)
+        dataschema.add_habit_to_db(db, name='Overthinking', descr='Thinking too much',
+                                   gen_date=date.fromisoformat("2024-04-01"), periodicity='Daily')
+        dataschema.increment_guilt(db, name='Overthinking', event_date="2024-04-02")
+        # Nothing is written to the file before the working set is flushed
+        assert dataschema.get_habit_data(dataschema.get_db(name=db_path), None) == []
+        dataschema.flush_db(db)
+        habit_data = dataschema.get_habit_data(dataschema.get_db(name=db_path), 'Overthinking')
+        assert habit_data[0]['check_off_dates'] == ["2024-04-02"]
+        db.close()
+
+    def test_pending_changes_are_recovered(self, tmp_path):
+        db_path = str(tmp_path / 'working_set.db')
+        db = dataschema.get_db(name=db_path, in_memory=True)
+        dataschema.add_habit_to_db(db, name='Overthinking', descr='Thinking too much',
+                                   gen_date=date.fromisoformat("2024-04-01"), periodicity='Daily')
+        dataschema.increment_guilt(db, name='Overthinking', event_date="2024-04-02")
+        # Opening the file again without flushing, as after a crash, replays the pending log
+        recovered_db = dataschema.get_db(name=db_path, in_memory=True)
+        habit_data = dataschema.get_habit_data(recovered_db, 'Overthinking')
+        assert habit_data[0]['check_off_dates'] == ["2024-04-02"]
+        recovered_db.close()
+
+
+class TestMigration:
+
+    def test_single_user_database_is_migrated(self, tmp_path):
+        # Testing that a database file from before tenants existed is moved to the default tenant
+        db_path = str(tmp_path / 'single_user.db')
+        conn = sqlite3.connect(db_path)
+        conn.execute("CREATE TABLE habit(name TEXT PRIMARY KEY, descr TEXT, gen_date TEXT, periodicity TEXT, "
+                     "check_off_dates TEXT DEFAULT '[]');")
+        conn.execute("INSERT INTO habit VALUES ('Overthinking', 'Thinking too much', '2024-04-01', 'Daily', "
+                     "'[\"2024-04-02\"]');")
+        conn.commit()
+        conn.close()
+        db = dataschema.get_db(name=db_path)
+        habit_data = dataschema.get_habit_data(db, 'Overthinking')
+        assert habit_data[0]['check_off_dates'] == ["2024-04-02"]
+        # The search index is filled with the habits that were there before it
+        assert dataschema.search_habits(db, "thinking") == [('Overthinking', 'Thinking too much')]
+        dataschema.add_habit_to_db(db, name='Overthinking', descr='', gen_date=date.fromisoformat("2024-04-01"),
+                                   periodicity='Daily', user_id='bob')
+        assert dataschema.get_habit_names(db, user_id='bob') == ['Overthinking']
+        db.close()
+
+    def test_change_feed_starts_with_the_existing_habits(self, tmp_path):
+        # Testing that a database from before the change feed existed gets its habits and check-offs recorded
+        db_path = str(tmp_path / 'before_feed.db')
+        conn = sqlite3.connect(db_path)
+        conn.execute("CREATE TABLE habit(user_id TEXT NOT NULL DEFAULT 'default', name TEXT NOT NULL, descr TEXT, "
+                     "gen_date TEXT, periodicity TEXT, check_off_dates TEXT DEFAULT '[]', "
+                     "PRIMARY KEY (user_id, name));")
+        conn.execute("INSERT INTO habit VALUES ('default', 'Overthinking', 'Thinking too much', '2024-04-01', 'Daily', "
+                     "'[\"2024-04-03\", \"2024-04-02\", \"2024-04-03\"]');")
+        conn.execute("INSERT INTO habit VALUES ('bob', 'Rushing', 'Doing things in a hurry', '2024-01-01', 'Weekly', "
+                     "'[]');")
+        conn.commit()
+        conn.close()
+        db = dataschema.get_db(name=db_path)
+        assert [(change['seq'], change['user_id'], change['name'], change['operation'], change['value'])
+                for change in dataschema.changes_since(db)] == [
+            (1, 'default', 'Overthinking', 'add_habit',
+             {'descr': 'Thinking too much', 'gen_date': '2024-04-01', 'periodicity': 'Daily'}),
+            (2, 'default', 'Overthinking', 'check_off', '2024-04-02'),
+            (3, 'default', 'Overthinking', 'check_off', '2024-04-03'),
+            (4, 'bob', 'Rushing', 'add_habit',
+             {'descr': 'Doing things in a hurry', 'gen_date': '2024-01-01', 'periodicity': 'Weekly'})]
+        db.close()
+        # Opening the database again records nothing twice
+        db = dataschema.get_db(name=db_path)
+        assert len(list(dataschema.changes_since(db))) == 4
+        db.close()
+
 
 if __name__ == "__main__":
     pytest.main()
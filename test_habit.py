@@ -0,0 +1,106 @@
+from project_setup import setup_test_database
+from datetime import date
+import pytest
+import dataschema
+from freezegun import freeze_time
+import habit as habit_module
+from habit import Habit
+from oracle import ENGINES, diff_stats, random_cases, reference_stats
+from registry import HabitRegistry
+
+
+class TestHabitRegistry:
+    def setup_method(self):
+        self.test_db = setup_test_database()
+
+    def teardown_method(self):
+        dataschema.clear_database(self.test_db)
+
+    def test_get_habit_by_name_returns_live_object(self):
+        habit = Habit.get_habit_by_name(self.test_db, 'Swearstorming')
+        assert Habit.get_habit_by_name(self.test_db, 'Swearstorming') is habit
+        # Loading all habits should reuse the registered object as well
+        assert habit in Habit.get_all_habits(self.test_db)
+
+    def test_get_all_habits_reads_all_records_at_once(self, monkeypatch):
+        habit = Habit.get_habit_by_name(self.test_db, 'Swearstorming')
+        queried_names, parsed_names = [], []
+        get_habit_data, from_record = habit_module.get_habit_data, Habit.from_record
+
+        def counting_get_habit_data(db, name, user_id):
+            queried_names.append(name)
+            return get_habit_data(db, name, user_id)
+
+        def counting_from_record(**record):
+            parsed_names.append(record['name'])
+            return from_record(**record)
+
+        monkeypatch.setattr(habit_module, 'get_habit_data', counting_get_habit_data)
+        monkeypatch.setattr(Habit, 'from_record', counting_from_record)
+        habits = Habit.get_all_habits(self.test_db)
+        # One query for all habits, even with a habit registered, and only the other habits parsed
+        assert queried_names == [None]
+        assert habit in habits and len(habits) == 5
+        assert sorted(parsed_names) == sorted(other.name for other in habits if other is not habit)
+        assert Habit.get_all_habits(self.test_db) == habits
+
+    def test_registry_stays_in_sync_on_add_event(self):
+        habit = Habit.get_habit_by_name(self.test_db, 'Overanalyzing')
+        habit.add_event(self.test_db, date.fromisoformat("2024-04-10"))
+        registered_habit = Habit.get_habit_by_name(self.test_db, 'Overanalyzing')
+        assert registered_habit is habit
+        assert date.fromisoformat("2024-04-10") in registered_habit.marked_complete
+        assert registered_habit.marked_complete == sorted(registered_habit.marked_complete)
+
+    def test_registry_drops_habit_on_write_and_delete(self):
+        habit = Habit.get_habit_by_name(self.test_db, 'Rushing')
+        # Writing through dataschema directly should make the next lookup reload the habit
+        dataschema.increment_guilt(self.test_db, name='Rushing', event_date="2024-04-08")
+        reloaded_habit = Habit.get_habit_by_name(self.test_db, 'Rushing')
+        assert reloaded_habit is not habit
+        assert date.fromisoformat("2024-04-08") in reloaded_habit.marked_complete
+        dataschema.delete_habit(self.test_db, 'Rushing')
+        assert Habit.get_habit_by_name(self.test_db, 'Rushing') is None
+
+    def test_registry_evicts_least_recently_used(self):
+        registry = HabitRegistry(max_habits=2, max_events=10)
+        swearstorming = Habit.from_record('Swearstorming', '', '2024-03-23', 'Daily', ["2024-03-23"])
+        overanalyzing = Habit.from_record('Overanalyzing', '', '2024-03-23', 'Daily', [])
+        rushing = Habit.from_record('Rushing', '', '2024-01-01', 'Weekly', [])
+        registry.put(swearstorming)
+        registry.put(overanalyzing)
+        registry.get('Swearstorming')
+        registry.put(rushing)
+        assert 'Overanalyzing' not in registry
+        assert 'Swearstorming' in registry and 'Rushing' in registry
+        # Exceeding the event budget should evict as well
+        procrastipondering = Habit.from_record('Procrastipondering', '', '2023-01-01', 'Monthly',
+                                               [f"2023-{month:02d}-01" for month in range(1, 13)])
+        registry.put(procrastipondering)
+        assert len(registry) == 1
+
+
+class TestStatsOracle:
+    def test_oracle_on_known_habit(self):
+        weeks = [date(2024, 3, 25), date(2024, 4, 1), date(2024, 4, 15), date(2024, 4, 22)]
+        stats = reference_stats("Rushing", date(2024, 3, 20), "Weekly", weeks, date(2024, 4, 23))
+        assert (stats['Current streak'], stats['Total periods of guilt'], stats['Total periods of innocence'],
+                stats['Longest streak'], stats['Average streak']) == (2, 4, 2, 2, 2.0)
+
+    @pytest.mark.parametrize('engine', sorted(ENGINES))
+    def test_engines_match_oracle_on_random_histories(self, engine, tmp_path):
+        for today, habits in random_cases(seed=7, rounds=25, habit_count=20):
+            expected = [reference_stats(habit['name'], habit['gen_date'], habit['periodicity'],
+                                        habit['check_off_dates'], today) for habit in habits]
+            calculate = ENGINES[engine](habits, str(tmp_path))
+            with freeze_time(today):
+                actual = sorted(calculate(today), key=lambda row: int(row['Name'].split()[-1]))
+            assert diff_stats(expected, actual) == [], f"{engine} differs from the oracle on {today}"
+
+    def test_differences_are_reported_per_metric(self):
+        row = reference_stats("Rushing", date(2024, 4, 1), "Daily", [date(2024, 4, 23)], date(2024, 4, 23))
+        assert diff_stats([row], [dict(row, **{'Longest streak': 2})]) == [("Rushing", 'Longest streak', 1, 2)]
+
+
+if __name__ == "__main__":
+    pytest.main()
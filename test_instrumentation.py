@@ -0,0 +1,107 @@
+import json
+import pytest
+import dataframe
+import dataschema
+from instrumentation import metrics
+from project_setup import setup_test_database
+from profiling import profiled
+from querylog import query_log, parameter_shape
+
+
+class TestInstrumentation:
+    def setup_method(self):
+        metrics.reset()
+        metrics.enable()
+
+    def teardown_method(self):
+        metrics.disable()
+        metrics.reset()
+
+    def test_operations_are_timed_and_counted(self, tmp_path):
+        db = setup_test_database(name=str(tmp_path / 'test.db'))
+        dataframe.display_all_habits_tracked(db)
+        summary = {row['Operation']: row for row in metrics.summary()}
+        assert summary['dataschema.increment_guilt']['Calls'] == 28
+        # The report reads all habits with one statement, and the stats need no SQL at all
+        assert summary['dataframe.display_all_habits_tracked']['SQL statements'] == 1
+        assert summary['dataframe.display_all_habits_tracked']['SQL rows'] == 5
+        assert summary['habit.Habit.calc_individual_stats_row']['Calls'] == 5
+        assert summary['habit.Habit.calc_individual_stats_row']['SQL statements'] == 0
+        assert summary['storage.json_decode']['Calls'] == 1
+        assert json.loads(metrics.format_summary('json'))[0]['Operation'] in summary
+        db.close()
+
+    def test_nothing_is_recorded_while_disabled(self):
+        metrics.disable()
+        db = setup_test_database(backend='memory')
+        dataframe.display_all_habits_tracked(db)
+        assert metrics.summary() == []
+
+
+class TestQueryLog:
+    def setup_method(self):
+        query_log.reset()
+        # Logging every statement as slow
+        query_log.enable(threshold_ms=0)
+
+    def teardown_method(self):
+        query_log.disable()
+        query_log.reset()
+
+    def test_statements_are_traced(self, tmp_path, caplog):
+        db = setup_test_database(name=str(tmp_path / 'test.db'))
+        dataschema.get_habit_data(db, 'Rushing')
+        dataschema.get_habit_data(db, 'Swearstorming')
+        summary = {entry['sql']: entry for entry in query_log.summary()}
+        lookup = summary["SELECT rowid, name, descr, gen_date, periodicity, check_off_dates FROM habit "
+                         "WHERE user_id=? AND name=?;"]
+        assert lookup['executions'] == 2
+        assert sum(lookup['histogram'].values()) == 2
+        # The lookup by primary key is planned as a search, not a scan
+        assert lookup['plan'] and not lookup['full_scans']
+        assert "parameters (str, str)" in caplog.text
+        # The parameter values themselves are never logged
+        assert "Swearstorming" not in caplog.text
+        db.close()
+
+    def test_full_scans_are_flagged(self, tmp_path, caplog):
+        db = dataschema.get_db(name=str(tmp_path / 'test.db'))
+        cur = db.cursor()
+        cur.execute("SELECT name FROM habit WHERE descr=?;", ("",))
+        cur.fetchall()
+        cur.close()
+        entry = next(entry for entry in query_log.summary() if entry['sql'].startswith("SELECT name FROM habit"))
+        assert entry['full_scans'] == ["SCAN habit"]
+        assert "Full scan (SCAN habit)" in caplog.text
+        db.close()
+
+    def test_parameter_shape(self):
+        assert parameter_shape(("a", 1, None)) == "(str, int, NoneType)"
+        assert parameter_shape({'user_id': "a"}) == "{user_id: str}"
+
+
+class TestProfiling:
+    def test_profile_reports_are_written(self, tmp_path):
+        output_dir = str(tmp_path / 'profile')
+        with profiled(output_dir, trace_allocations=True, top=5):
+            db = setup_test_database(backend='memory')
+            dataframe.display_all_habits_tracked(db)
+        with open(tmp_path / 'profile' / 'profile.txt') as text_file:
+            assert 'display_all_habits_tracked' in text_file.read()
+        with open(tmp_path / 'profile' / 'allocations.txt') as allocations_file:
+            # A header line and the top 5 source lines
+            assert len(allocations_file.readlines()) == 6
+        with open(tmp_path / 'profile' / 'profile.collapsed') as collapsed_file:
+            for line in collapsed_file:
+                stack, samples = line.rsplit(" ", 1)
+                assert int(samples) > 0
+
+    def test_profile_is_written_on_exit(self, tmp_path):
+        with pytest.raises(SystemExit):
+            with profiled(str(tmp_path / 'profile')):
+                raise SystemExit()
+        assert (tmp_path / 'profile' / 'profile.pstats').exists()
+
+
+if __name__ == "__main__":
+    pytest.main()
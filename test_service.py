@@ -0,0 +1,90 @@
+import json
+import threading
+from urllib.error import HTTPError
+from urllib.parse import quote
+from urllib.request import Request, urlopen
+import pytest
+from dataschema import get_db, increment_guilt
+from project_setup import setup_test_database
+from service import make_server
+
+
+class TestService:
+    def setup_method(self):
+        # The in-memory backend can be used from the server thread
+        self.test_db = setup_test_database(backend='memory')
+        self.server = make_server(self.test_db, port=0)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def teardown_method(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request(self, path, data=None, headers=None):
+        request = Request(self.base_url + path, data=data, headers=headers or {})
+        with urlopen(request) as response:
+            return response.status, response.headers.get('ETag'), json.loads(response.read() or b'null')
+
+    def test_list_habits_and_reports(self):
+        status, _, habits = self.request('/habits')
+        assert status == 200
+        assert len(habits) == 5
+        _, _, stats = self.request('/habits/' + quote('Binge watching') + '/stats')
+        assert stats['Periodicity'] == 'Weekly'
+        assert stats['Total periods of guilt'] == 2
+        _, _, report = self.request('/reports/longest-historical-streak')
+        assert report == [{'Name': 'Procrastipondering', 'Longest historical streak': 9}]
+        _, _, report = self.request('/reports/same-periodicity?periodicity=Monthly')
+        assert [row['name'] for row in report] == ['Procrastipondering']
+
+    def test_etag_changes_only_on_writes(self):
+        _, etag, _ = self.request('/habits/Rushing/stats')
+        # Sending the ETag back should give 304 Not Modified while nothing changed
+        with pytest.raises(HTTPError) as not_modified:
+            self.request('/habits/Rushing/stats', headers={'If-None-Match': etag})
+        assert not_modified.value.code == 304
+        status, _, body = self.request('/habits/Rushing/complete', data=json.dumps({'date': '2024-04-10'}).encode())
+        assert status == 200
+        assert body['marked'] == '2024-04-08'
+        _, new_etag, stats = self.request('/habits/Rushing/stats', headers={'If-None-Match': etag})
+        assert new_etag != etag
+        assert stats['Total periods of guilt'] == 6
+
+    def test_writes_of_other_processes_are_seen(self, tmp_path):
+        db_path = str(tmp_path / 'served.db')
+        db = setup_test_database(name=db_path)
+        db.close()
+        server = make_server(get_db(name=db_path, check_same_thread=False), port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        try:
+            _, etag, stats = self.request('/habits/Rushing/stats')
+            # Checking the habit off through a connection of its own, as the command-line interface would
+            other_db = get_db(name=db_path)
+            increment_guilt(other_db, 'Rushing', '2024-04-08')
+            other_db.close()
+            _, new_etag, new_stats = self.request('/habits/Rushing/stats')
+            assert new_etag != etag
+            assert new_stats['Total periods of guilt'] == stats['Total periods of guilt'] + 1
+            _, _, habit = self.request('/habits/Rushing')
+            assert '2024-04-08' in habit['check_off_dates']
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_tenant_header_scopes_requests(self):
+        _, _, habits = self.request('/habits', headers={'X-User-Id': 'alice'})
+        assert habits == []
+        with pytest.raises(HTTPError) as not_found:
+            self.request('/habits/Rushing/complete', data=b'{}', headers={'X-User-Id': 'alice'})
+        assert not_found.value.code == 404
+
+    def test_unknown_habit(self):
+        with pytest.raises(HTTPError) as not_found:
+            self.request('/habits/Nothing/stats')
+        assert not_found.value.code == 404
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,155 @@
+# Rolling-window guilt trends of all habits, calculated for all habits at once with array operations
+from datetime import date, timedelta
+from itertools import chain
+import numpy as np
+import pandas as pd
+import dataschema
+from instrumentation import instrumented
+from periods import period_ordinal
+from snapshot import PERIODICITIES
+from storage import DEFAULT_USER
+
+# The numbers of periods the guilt rates are calculated over
+TREND_WINDOWS = (7, 30, 90)
+# The date ordinal of 1970-01-01, where NumPy starts counting days and months
+EPOCH_ORDINAL = 719163
+EPOCH_MONTH = 1970 * 12
+
+
+def period_ordinals(days, periodicity_codes):
+    """
+    Calculates the period ordinals of many days at once, the same as periods.period_ordinal.
+    :param days: NumPy array of datetime64 days
+    :param periodicity_codes: NumPy array with the index in PERIODICITIES of the habit of each day
+    :return: NumPy array of int64 period ordinals
+    """
+    ordinals = days.astype('datetime64[D]').astype(np.int64) + EPOCH_ORDINAL
+    months = days.astype('datetime64[M]').astype(np.int64) + EPOCH_MONTH
+    return np.select([periodicity_codes == 1, periodicity_codes == 2], [(ordinals - 1) // 7, months], ordinals)
+
+
+def period_starts(ordinals, periodicity_codes):
+    """
+    Turns many period ordinals back into the starts of their periods at once, see periods.period_from_ordinal.
+    :return: NumPy array of datetime64 days
+    """
+    days = np.select([periodicity_codes == 1, periodicity_codes == 2],
+                     [ordinals * 7 + 1 - EPOCH_ORDINAL, 0], ordinals - EPOCH_ORDINAL).astype('datetime64[D]')
+    months = (ordinals - EPOCH_MONTH).astype('datetime64[M]').astype('datetime64[D]')
+    return np.where(periodicity_codes == 2, months, days)
+
+
+@instrumented
+def load_check_offs(db, user_id=DEFAULT_USER):
+    """
+    Loads the check-offs of all habits of a tenant at once into a long-format frame with one row per check-off.
+    Habits with a periodicity other than those in PERIODICITIES are left out, as they have no periods to count.
+    :param db: An SQLite database connection object or a habit store
+    :param user_id: the tenant whose habits are loaded
+    :return: tuple of two DataFrames: the habits with columns for name, periodicity, periodicity code and the period
+             ordinal of gen_date, and the check-offs with columns for the position of their habit in the first
+             frame and their period ordinal
+    """
+    habit_data = [habit_info for habit_info in dataschema.get_habit_data(db, None, user_id) or []
+                  if habit_info['periodicity'] in PERIODICITIES]
+    periodicity_codes = np.array([PERIODICITIES.index(habit_info['periodicity']) for habit_info in habit_data],
+                                 dtype=np.int64)
+    gen_days = np.array([habit_info['gen_date'] for habit_info in habit_data], dtype='datetime64[D]')
+    counts = np.array([len(habit_info['check_off_dates']) for habit_info in habit_data], dtype=np.int64)
+    habits = pd.DataFrame({
+        'Name': [habit_info['name'] for habit_info in habit_data],
+        'Periodicity': [habit_info['periodicity'] for habit_info in habit_data],
+        'Periodicity code': periodicity_codes,
+        'Gen period': period_ordinals(gen_days, periodicity_codes),
+    })
+    habit_indexes = np.repeat(np.arange(len(habit_data)), counts)
+    # Parsing all check-off dates with one conversion instead of one per habit
+    days = np.array(list(chain.from_iterable(habit_info['check_off_dates'] for habit_info in habit_data)),
+                    dtype='datetime64[D]')
+    check_offs = pd.DataFrame({
+        'Habit': habit_indexes,
+        'Period': period_ordinals(days, periodicity_codes[habit_indexes]),
+    })
+    return habits, check_offs
+
+
+def rolling_guilt_rates(habits, check_offs, today=None, windows=TREND_WINDOWS):
+    """
+    Calculates the rolling guilt rates of all habits in one pass: the check-offs are laid out on one grid holding
+    every period of every habit from its creation up to the current period, habit after habit, and the number of
+    guilty periods in any window is the difference of two entries of the running total over that grid.
+    Windows reaching back before the creation of a habit are cut short at its first period.
+    :param habits: DataFrame of the habits, see load_check_offs
+    :param check_offs: DataFrame of the check-offs, see load_check_offs
+    :param today: the date of the current period (default is today)
+    :param windows: the numbers of periods the rates are calculated over
+    :return: DataFrame with one row per habit and period, with columns for name, periodicity, period start,
+             whether the period was guilty and the guilt rate over each window as a share between 0 and 1
+    """
+    today = today or date.today()
+    periodicity_codes = habits['Periodicity code'].to_numpy()
+    today_periods = np.array([period_ordinal(today, periodicity) for periodicity in PERIODICITIES])[
+        periodicity_codes]
+    first_periods = habits['Gen period'].to_numpy()
+    lengths = np.maximum(today_periods - first_periods + 1, 0)
+    starts = np.cumsum(lengths) - lengths
+    # Marking the guilty periods on the grid, ignoring check-offs outside the periods of their habit
+    habit_indexes, periods = check_offs['Habit'].to_numpy(), check_offs['Period'].to_numpy()
+    offsets = periods - first_periods[habit_indexes]
+    inside = (offsets >= 0) & (offsets < lengths[habit_indexes])
+    guilty = np.zeros(int(lengths.sum()), dtype=bool)
+    guilty[starts[habit_indexes[inside]] + offsets[inside]] = True
+    running_total = np.concatenate(([0], np.cumsum(guilty)))
+    grid_habits = np.repeat(np.arange(len(habits)), lengths)
+    positions = np.arange(len(guilty))
+    periods_so_far = positions - starts[grid_habits] + 1
+    trends = pd.DataFrame({
+        'Name': pd.Categorical.from_codes(grid_habits, habits['Name']),
+        'Periodicity': pd.Categorical.from_codes(periodicity_codes[grid_habits], PERIODICITIES),
+        'Period': period_starts(first_periods[grid_habits] + periods_so_far - 1, periodicity_codes[grid_habits]),
+        'Guilty': guilty,
+    })
+    for window in windows:
+        window_lengths = np.minimum(window, periods_so_far)
+        trends[f"{window}-period guilt rate"] = (
+            running_total[positions + 1] - running_total[positions + 1 - window_lengths]) / window_lengths
+    return trends
+
+
+@instrumented
+def calculate_guilt_trends(db, windows=TREND_WINDOWS, user_id=DEFAULT_USER):
+    """
+    Reports the current rolling guilt rates of all habits and how they changed since a week ago, comparing the
+    windows ending in the current period with those ending in the period of the day a week ago. For monthly
+    habits, that is the same period for most of the month, with no change.
+    :param db: An SQLite database connection object or a habit store
+    :param windows: the numbers of periods the rates are calculated over
+    :param user_id: the tenant whose habits are reported
+    :return: DataFrame with columns for name, periodicity, and the guilt rate in percent and its change in
+             percentage points for each window, or None if there are no habits
+    """
+    habits, check_offs = load_check_offs(db, user_id)
+    if habits.empty:
+        print("No habits found in the database.")
+        return None
+    today = date.today()
+    trends = rolling_guilt_rates(habits, check_offs, today, windows)
+    periodicity_codes = habits['Periodicity code'].to_numpy()
+    periods_back = np.array([period_ordinal(today, periodicity) - period_ordinal(today - timedelta(weeks=1),
+                                                                                periodicity)
+                             for periodicity in PERIODICITIES])[periodicity_codes]
+    lengths = np.bincount(trends['Name'].cat.codes, minlength=len(habits))
+    ends = np.cumsum(lengths) - 1
+    # Habits created after today have no rates yet, habits created since a week ago no change yet
+    has_periods = lengths > 0
+    had_periods = lengths > periods_back
+    report = pd.DataFrame({'Name': habits['Name'], 'Periodicity': habits['Periodicity']})
+    for window in windows:
+        rates = trends[f"{window}-period guilt rate"].to_numpy()
+        current = np.full(len(habits), np.nan)
+        current[has_periods] = rates[ends[has_periods]]
+        week_ago = np.full(len(habits), np.nan)
+        week_ago[had_periods] = rates[(ends - periods_back)[had_periods]]
+        report[f"{window}-period guilt rate"] = (current * 100).round(2)
+        report[f"{window}-period change"] = ((current - week_ago) * 100).round(2)
+    return report